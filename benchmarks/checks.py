@@ -0,0 +1,412 @@
+"""
+Correctness checks for climstats.  Each check creates small synthetic datasets (see synthetic.py), runs them
+through one of the output or grouping paths and compares the result with a reference calculated another way.
+Exits with an error if any check fails so it can gate a build alongside startup.py.
+
+usage: python benchmarks/checks.py [--checks REGEX]
+"""
+
+import os
+import re
+import sys
+import shutil
+import json
+import argparse
+import threading
+import tempfile
+import traceback
+from collections import OrderedDict
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import numpy as np
+import netCDF4
+
+from climstats import dataset, functions, chunkstore, multifile, service, batch
+import synthetic
+
+
+# Registered checks, see check
+checks = OrderedDict()
+
+
+def check(name):
+	"""Register a check, the decorated function takes a scratch directory and raises Failed on a mismatch"""
+
+	def register(func):
+		checks[name] = func
+		return func
+
+	return register
+
+
+class Failed(Exception):
+	pass
+
+
+def expect(condition, message):
+	if not condition:
+		raise Failed(message)
+
+
+def monthly_total(filename, writer=None, tolerance=0.5, prefetch=0):
+	"""Monthly totals of pr in filename, streamed to writer if given"""
+
+	variable = dataset.NetCDF4Dataset([filename]).variables['pr']
+	return variable.groupby('time.yearmonth').apply(functions.total, name='pr', tolerance=tolerance, prefetch=prefetch, writer=writer)
+
+
+# Packed output
+
+@check('pack_streaming_netcdf')
+def pack_streaming_netcdf(directory):
+	"""Streamed results packed to int16 without explicit parameters keep their values"""
+
+	source = synthetic.make_gridded(os.path.join(directory, 'gridded.nc'), years=1, ny=10, nx=12)
+
+	output = os.path.join(directory, 'packed.nc')
+	writer = dataset.NetCDF4Writer(output, encoding={'pr': {'pack': 'int16'}})
+	monthly_total(source, writer)
+	writer.close()
+
+	reference = monthly_total(source).variables['pr'][:]
+
+	packed = dataset.NetCDF4Dataset([output]).ncfile.variables['pr']
+	expect(packed.dtype == np.int16, "stored as {}, expected int16".format(packed.dtype))
+
+	values = dataset.NetCDF4Dataset([output]).variables['pr'][:]
+	compare_packed(values, reference)
+
+
+@check('pack_streaming_chunkstore')
+def pack_streaming_chunkstore(directory):
+	"""The same for a chunk store"""
+
+	source = synthetic.make_gridded(os.path.join(directory, 'gridded.nc'), years=1, ny=10, nx=12)
+
+	output = os.path.join(directory, 'packed.zarr')
+	writer = chunkstore.ChunkStoreWriter(output, encoding={'pr': {'pack': 'int16'}})
+	monthly_total(source, writer)
+	writer.close()
+
+	reference = monthly_total(source).variables['pr'][:]
+
+	array = chunkstore.read_json(os.path.join(output, 'pr', '.zarray'))
+	expect(array['dtype'] == '<i2', "stored as {}, expected <i2".format(array['dtype']))
+
+	values = dataset.NetCDF4Dataset([output]).variables['pr'][:]
+	compare_packed(values, reference)
+
+
+@check('encoding_defaults')
+def encoding_defaults(directory):
+	"""A variable's own encoding adds to the '*' defaults, for both writers"""
+
+	source = synthetic.make_gridded(os.path.join(directory, 'gridded.nc'), years=1, ny=10, nx=12)
+	encoding = {'*': {'zlib': True, 'complevel': 1}, 'pr': {'least_significant_digit': 1}}
+
+	netcdf = os.path.join(directory, 'encoded.nc')
+	writer = dataset.NetCDF4Writer(netcdf, encoding=encoding)
+	monthly_total(source, writer)
+	writer.close()
+
+	store = os.path.join(directory, 'encoded.zarr')
+	writer = chunkstore.ChunkStoreWriter(store, encoding=encoding)
+	monthly_total(source, writer)
+	writer.close()
+
+	reference = monthly_total(source).variables['pr'][:]
+
+	variable = dataset.NetCDF4Dataset([netcdf]).ncfile.variables['pr']
+	expect(variable.filters()['complevel'] == 1, "netCDF complevel {}, expected 1".format(variable.filters()['complevel']))
+
+	array = chunkstore.read_json(os.path.join(store, 'pr', '.zarray'))
+	expect(array['compressor']['level'] == 1, "chunk store complevel {}, expected 1".format(array['compressor']['level']))
+
+	for name in [netcdf, store]:
+		values = dataset.NetCDF4Dataset([name]).variables['pr'][:]
+		expect(np.ma.count(values) == np.ma.count(reference), "{}: {} values written, expected {}".format(os.path.basename(name), np.ma.count(values), np.ma.count(reference)))
+		expect(0 < np.abs(values - reference).max() <= 0.1, "{}: quantization error {}".format(os.path.basename(name), np.abs(values - reference).max()))
+
+
+@check('chunkstore_rewrite')
+def chunkstore_rewrite(directory):
+	"""Writing over an existing chunk store leaves nothing of the old one behind"""
+
+	source = synthetic.make_gridded(os.path.join(directory, 'gridded.nc'), years=1, ny=10, nx=12)
+	store = os.path.join(directory, 'result.zarr')
+
+	variable = dataset.NetCDF4Dataset([source]).variables['pr']
+
+	writer = chunkstore.ChunkStoreWriter(store)
+	variable.groupby('time.yearmonth').apply(functions.total, name='old', writer=writer)
+	writer.close()
+
+	writer = chunkstore.ChunkStoreWriter(store)
+	variable.groupby('time.year').apply(functions.total, name='new', writer=writer)
+	writer.close()
+
+	result = dataset.NetCDF4Dataset([store])
+	expect('old' not in result._allvariables, "variable of the old store left behind")
+	expect(result.variables['new'].shape[0] == 1, "{} years, expected 1".format(result.variables['new'].shape[0]))
+
+
+# Batch jobs
+
+@check('batch_duplicate_outputs')
+def batch_duplicate_outputs(directory):
+	"""Job files with two jobs writing the same output are rejected when they are loaded"""
+
+	jobfile = os.path.join(directory, 'jobs.json')
+	defaults = {'source': 'pr.nc', 'variable': 'pr', 'aggregation': 'time.yearmonth'}
+
+	with open(jobfile, 'w') as output:
+		json.dump({'defaults': defaults, 'jobs': [
+			{'name': 'totals', 'statistic': 'total', 'output': 'out.nc'},
+			{'name': 'means', 'statistic': 'mean', 'output': './out.nc'},
+		]}, output)
+
+	try:
+		batch.load(jobfile)
+	except batch.BatchException as e:
+		expect('totals' in str(e) and 'means' in str(e), "message doesn't name both jobs: {}".format(e))
+	else:
+		raise Failed("duplicate outputs accepted")
+
+	with open(jobfile, 'w') as output:
+		json.dump({'defaults': defaults, 'jobs': [
+			{'statistic': 'total', 'output': 'total.nc'},
+			{'statistic': 'mean', 'output': 'mean.nc'},
+		]}, output)
+
+	expect(len(batch.load(jobfile)) == 2, "distinct outputs rejected")
+
+
+# Statistics service
+
+@check('service_bad_requests')
+def service_bad_requests(directory):
+	"""Malformed statistic requests get a JSON 400 (or 404) response rather than a failed handler"""
+
+	import urllib2
+
+	source = synthetic.make_gridded(os.path.join(directory, 'gridded.nc'), years=1, ny=10, nx=12)
+	good = {'source': source, 'variable': 'pr', 'aggregation': 'time.yearmonth', 'statistic': 'total'}
+
+	cases = [
+		({'statistic': ['total']}, 400),
+		({'source': ['a']}, 400),
+		({'subset': 'x'}, 400),
+		({'params': [1]}, 400),
+		({'tolerance': 'high'}, 400),
+		({'aggregation': 'time.nosuch'}, 400),
+		({'aggregation': 'nodot'}, 400),
+		({'aggregation': 'depth.yearmonth'}, 404),
+		({'subset': {'latitude': 'x'}}, 400),
+		({}, 200),
+	]
+
+	httpd = service.serve(service.Service(), port=0)
+	thread = threading.Thread(target=httpd.serve_forever)
+	thread.daemon = True
+	thread.start()
+
+	try:
+		for change, expected in cases:
+			request = dict(good)
+			request.update(change)
+
+			try:
+				response = urllib2.urlopen('http://127.0.0.1:{}/statistic'.format(httpd.server_address[1]), json.dumps(request), timeout=60)
+				status, body = response.getcode(), response.read()
+			except urllib2.HTTPError as e:
+				status, body = e.code, e.read()
+
+			expect(status == expected, "{}: status {}, expected {}: {}".format(change, status, expected, body))
+			json.loads(body)
+
+	finally:
+		httpd.shutdown()
+		httpd.server_close()
+
+
+# Multi-file aggregations
+
+def write_member(filename, first, count):
+	"""Write daily values for days [first, first + count) along an unlimited time dimension"""
+
+	ncfile = netCDF4.Dataset(filename, 'w')
+	ncfile.createDimension('time', None)
+	ncfile.createDimension('x', 3)
+
+	time = ncfile.createVariable('time', 'f8', ('time',))
+	time.units = 'days since 1950-01-01 00:00'
+	time.calendar = 'standard'
+	ncfile.createVariable('pr', 'f4', ('time', 'x'))
+
+	ncfile.close()
+	return append_member(filename, first, count)
+
+
+def append_member(filename, first, count):
+	"""Append days [first, first + count) to a member file, the values are the day numbers"""
+
+	ncfile = netCDF4.Dataset(filename, 'a')
+	size = len(ncfile.dimensions['time'])
+
+	days = np.arange(first, first + count, dtype=np.float64)
+	ncfile.variables['time'][size:size + count] = days
+	ncfile.variables['pr'][size:size + count] = np.repeat(days[:, None], 3, axis=1)
+
+	ncfile.close()
+	return filename
+
+
+@check('multifile_growing_member')
+def multifile_growing_member(directory):
+	"""An indexed aggregation whose last member has been appended to is reopened with the new values"""
+
+	members = [write_member(os.path.join(directory, 'a.nc'), 0, 10), write_member(os.path.join(directory, 'b.nc'), 10, 10)]
+	index = os.path.join(directory, 'index.json')
+
+	expect(multifile.MultiFileDataset(members, index=index).variables['pr'].shape == (20, 3), "wrong initial shape")
+
+	# Make sure the mtime changes even on file systems with coarse timestamps
+	append_member(members[1], 20, 5)
+	os.utime(members[1], (os.path.getmtime(members[1]) + 1,) * 2)
+
+	for run in range(2):
+		values = multifile.MultiFileDataset(members, index=index).variables['pr'][:]
+		expect(values.shape == (25, 3), "run {}: shape {}, expected (25, 3)".format(run, values.shape))
+		expect((np.asarray(values)[:, 0] == np.arange(25)).all(), "run {}: wrong values".format(run))
+
+	expect(multifile.MultiFileIndex.load(index).size == 25, "saved index not updated")
+
+
+# Prefetching
+
+@check('prefetch_streaming_netcdf')
+def prefetch_streaming_netcdf(directory):
+	"""Groups read ahead on the prefetch thread while results are written to a NetCDF file give the same results"""
+
+	source = synthetic.make_gridded(os.path.join(directory, 'gridded.nc'), years=3, ny=20, nx=24)
+
+	output = os.path.join(directory, 'prefetched.nc')
+	writer = dataset.NetCDF4Writer(output)
+	monthly_total(source, writer, prefetch=4)
+	writer.close()
+
+	reference = monthly_total(source).variables['pr'][:]
+
+	values = dataset.NetCDF4Dataset([output]).variables['pr'][:]
+	expect((np.ma.getmaskarray(values) == np.ma.getmaskarray(reference)).all() and np.ma.allequal(values, reference), "prefetched results differ")
+
+
+# Station layouts
+
+def write_stations(filename, values, ragged):
+	"""
+	Write (time, station) daily values from 1950-01-01 as a dense file, or as a contiguous ragged array of
+	each station's run from its first to its last unmasked value
+	"""
+
+	ncfile = netCDF4.Dataset(filename, 'w')
+	ncfile.createDimension('feature', values.shape[1])
+
+	days = np.arange(values.shape[0], dtype=np.float64)
+
+	if ragged:
+		runs = []
+		for station in range(values.shape[1]):
+			valid = np.nonzero(~np.ma.getmaskarray(values[:, station]))[0]
+			runs.append(np.arange(valid[0], valid[-1] + 1))
+
+		ncfile.createDimension('obs', sum([len(run) for run in runs]))
+		time = ncfile.createVariable('time', 'f8', ('obs',))
+		data = ncfile.createVariable('pr', 'f4', ('obs',), fill_value=1e10)
+
+		rowsize = ncfile.createVariable('row_size', 'i4', ('feature',))
+		rowsize.sample_dimension = 'obs'
+		rowsize[:] = [len(run) for run in runs]
+
+		time[:] = np.concatenate([days[run] for run in runs])
+		data[:] = np.ma.concatenate([values[run, station] for station, run in enumerate(runs)])
+
+	else:
+		ncfile.createDimension('time', None)
+		time = ncfile.createVariable('time', 'f8', ('time',))
+		data = ncfile.createVariable('pr', 'f4', ('time', 'feature'), fill_value=1e10)
+
+		time[:] = days
+		data[:] = values
+
+	time.units = 'days since 1950-01-01 00:00'
+	time.calendar = 'standard'
+
+	ncfile.close()
+	return filename
+
+
+@check('ragged_gaps')
+def ragged_gaps(directory):
+	"""
+	Ragged stations give the same monthly totals as their dense layout, also around days that no station has
+	(here 1950-03-06 to 1950-03-19) which still count as missing
+	"""
+
+	values = np.ma.masked_array(np.arange(120 * 2, dtype=np.float32).reshape(120, 2) % 7)
+	values[64:, 0] = np.ma.masked
+	values[:78, 1] = np.ma.masked
+	values[20:25, 0] = np.ma.masked
+
+	dense = monthly_total(write_stations(os.path.join(directory, 'dense.nc'), values, False), tolerance=0.7).variables['pr'][:]
+	ragged = monthly_total(write_stations(os.path.join(directory, 'ragged.nc'), values, True), tolerance=0.7).variables['pr'][:]
+
+	expect(dense.shape == ragged.shape, "ragged shape {}, dense {}".format(ragged.shape, dense.shape))
+	expect((np.ma.getmaskarray(dense) == np.ma.getmaskarray(ragged)).all(), "masks differ, dense {} ragged {}".format(dense.tolist(), ragged.tolist()))
+	expect(np.ma.allclose(dense, ragged), "values differ, dense {} ragged {}".format(dense.tolist(), ragged.tolist()))
+
+
+def compare_packed(values, reference):
+	"""Packed values must match the reference to within one int16 step of its range"""
+
+	step = float(reference.max() - reference.min()) / 65534
+
+	expect(np.ma.count(values) == np.ma.count(reference), "{} values written, expected {}".format(np.ma.count(values), np.ma.count(reference)))
+	expect(np.abs(values - reference).max() <= step * 1.01, "packing error {} over one packed step {}".format(np.abs(values - reference).max(), step))
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser('Run the climstats correctness checks')
+	parser.add_argument('--checks', type=str, help='only run checks matching this regular expression')
+	args = parser.parse_args()
+
+	failed = False
+
+	for name, func in checks.items():
+
+		if args.checks and not re.search(args.checks, name):
+			continue
+
+		directory = tempfile.mkdtemp(prefix='climstats_check_')
+
+		try:
+			func(directory)
+			status = 'ok'
+
+		except Failed as e:
+			status = 'FAILED: {}'.format(e)
+			failed = True
+
+		except Exception:
+			status = 'ERROR: {}'.format(traceback.format_exc().strip().splitlines()[-1])
+			failed = True
+
+		finally:
+			shutil.rmtree(directory, True)
+
+		print('{:<32} {}'.format(name, status))
+
+	sys.exit(1 if failed else 0)
@@ -0,0 +1,88 @@
+"""
+Startup time benchmark.  Times a bare `climstats --help` and the import of the climstats package (with the
+statistics registry) in fresh interpreters, and checks that the import doesn't pull in any of the heavy
+optional dependencies that are only needed by particular statistics or output modes.  Exits with an error if
+the median time of either goes over its budget or a heavy module is loaded, so it can gate a build.
+
+usage: python benchmarks/startup.py [--repeat N] [--help-budget SECONDS] [--import-budget SECONDS]
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+
+# Modules that must only be imported when the statistic, grouping or output that needs them is used
+heavy = ['scipy', 'matplotlib', 'mpl_toolkits', 'seaborn', 'shapely', 'fiona', 'cfunits']
+
+# Imports the package the way bin/climstats does once its arguments are parsed, and reports the heavy
+# modules that got loaded along the way (some, like mpl_toolkits, can be preloaded by .pth files)
+import_script = """
+import sys
+def loaded():
+	return set(name.split('.')[0] for name in sys.modules if name.split('.')[0] in {heavy!r})
+before = loaded()
+import numpy
+from climstats import dataset, functions, chunkstore, instrument
+print(' '.join(sorted(loaded() - before)))
+""".format(heavy=heavy)
+
+
+def environment():
+
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.pathsep.join([root] + [path for path in env.get('PYTHONPATH', '').split(os.pathsep) if path])
+
+	return env
+
+
+def timed(command, repeat):
+	"""Run command repeat times and return the median wall time and the output of the last run"""
+
+	times = []
+	output = None
+
+	for i in range(repeat):
+		start = time.time()
+		output = subprocess.check_output(command, env=environment(), stderr=open(os.devnull, 'w'))
+		times.append(time.time() - start)
+
+	times.sort()
+
+	return times[len(times) // 2], output
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser('Check the start up time of climstats')
+	parser.add_argument('--repeat', type=int, default=11)
+	parser.add_argument('--help-budget', type=float, default=0.25, help='seconds allowed for climstats --help')
+	parser.add_argument('--import-budget', type=float, default=1.0, help='seconds allowed for importing the package')
+	args = parser.parse_args()
+
+	failed = False
+
+	baseline, output = timed([sys.executable, '-c', 'pass'], args.repeat)
+	print('{:<24} {:8.3f}s'.format('interpreter', baseline))
+
+	elapsed, output = timed([sys.executable, os.path.join(root, 'bin', 'climstats'), '--help'], args.repeat)
+	status = 'ok' if elapsed <= args.help_budget else 'OVER BUDGET'
+	failed = failed or elapsed > args.help_budget
+	print('{:<24} {:8.3f}s  budget {:.3f}s  {}'.format('climstats --help', elapsed, args.help_budget, status))
+
+	elapsed, output = timed([sys.executable, '-c', import_script], args.repeat)
+	status = 'ok' if elapsed <= args.import_budget else 'OVER BUDGET'
+	failed = failed or elapsed > args.import_budget
+	print('{:<24} {:8.3f}s  budget {:.3f}s  {}'.format('import climstats', elapsed, args.import_budget, status))
+
+	loaded = output.decode().split()
+	if loaded:
+		print('heavy modules loaded on import: {}'.format(', '.join(loaded)))
+		failed = True
+
+	sys.exit(1 if failed else 0)
@@ -0,0 +1,517 @@
+"""
+Benchmark suite for climstats.  Synthetic datasets (see synthetic.py) are generated at the requested size and
+every case is run in a fresh process so that the peak memory reported belongs to that case alone.  Results
+are saved as JSON, by default in benchmarks/results/ named after the current git commit, and two result files
+can be compared to spot regressions.
+
+usage: python benchmarks/suite.py run [--size small|medium|large] [--workers 1,2,4] [--cases REGEX]
+                                      [--repeat N] [--data DIR] [--output FILE]
+       python benchmarks/suite.py compare OLD.json NEW.json [--threshold 0.1] [--strict]
+       python benchmarks/suite.py list
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import glob
+import shutil
+import logging
+import argparse
+import datetime
+import tempfile
+import platform
+import resource
+import traceback
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import numpy as np
+
+from climstats import dataset, functions, chunkstore
+import synthetic
+
+
+# Dataset sizes, grid is (ny, nx) of the daily gridded data, the hourly grid is smaller
+sizes = {
+	'small': {'years': 2, 'grid': (20, 25), 'hourly_grid': (5, 5), 'features': 50, 'polygons': 5},
+	'medium': {'years': 10, 'grid': (100, 120), 'hourly_grid': (20, 25), 'features': 500, 'polygons': 20},
+	'large': {'years': 30, 'grid': (200, 240), 'hourly_grid': (50, 60), 'features': 2000, 'polygons': 50},
+}
+
+calendars = ['standard', 'noleap', '360_day']
+
+groupings = ['yearmonth', 'year', 'month', 'season', 'yearseason']
+
+# Parameters for the registry statistics that need them
+statistic_params = {
+	'rolling_maximum': {'window': 5},
+	'rolling_days': {'window': 5},
+}
+
+
+# Registered cases, see case
+cases = OrderedDict()
+
+
+def case(name, **params):
+	"""
+	Register a benchmark case.  The decorated function takes the data files and the case parameters, does any
+	setup and returns a function without arguments that is what gets timed.
+	"""
+
+	def register(func):
+		cases[name] = (func, params)
+		return func
+
+	return register
+
+
+class Skip(Exception):
+	"""Raised by a case that can't run here (eg. a missing optional dependency)"""
+	pass
+
+
+def generate(directory, size, workers):
+	"""Generate the synthetic datasets for size in directory, existing files are reused"""
+
+	spec = sizes[size]
+	files = {}
+
+	def make(name, func, *args, **kwargs):
+		path = os.path.join(directory, '{}_{}.nc'.format(name, size))
+		if not os.path.exists(path):
+			func(path, *args, **kwargs)
+		files[name] = path
+
+	ny, nx = spec['grid']
+
+	for calendar in calendars:
+		make('gridded_{}'.format(calendar), synthetic.make_gridded, spec['years'], 'daily', ny, nx, calendar)
+
+	hy, hx = spec['hourly_grid']
+	make('hourly', synthetic.make_gridded, 1, 'hourly', hy, hx)
+
+	make('stations', synthetic.make_stations, spec['years'], 'daily', spec['features'])
+
+	# One file per year for multi-file reads
+	pattern = os.path.join(directory, 'multifile_{}_*.nc'.format(size))
+	if len(glob.glob(pattern)) != spec['years']:
+		for year in range(spec['years']):
+			synthetic.make_gridded(pattern.replace('*', '{:04d}'.format(1980 + year)), 1, 'daily', ny, nx, start=1980 + year, seed=year)
+
+	files['multifile'] = sorted(glob.glob(pattern))
+	files['output'] = directory
+	files['polygons'] = spec['polygons']
+
+	return files
+
+
+def gridded(files, calendar='standard'):
+	return dataset.NetCDF4Dataset([files['gridded_{}'.format(calendar)]])
+
+
+# Opening and grouping
+
+@case('open_gridded')
+def open_gridded(files):
+	return lambda: gridded(files)
+
+
+@case('open_stations')
+def open_stations(files):
+	return lambda: dataset.NetCDF4Dataset([files['stations']])
+
+
+for grouping in groupings:
+	for calendar in calendars:
+
+		@case('group_{}_{}'.format(grouping, calendar), grouping=grouping, calendar=calendar)
+		def group(files, grouping, calendar):
+			variable = gridded(files, calendar).variables['pr']
+			return lambda: variable.groupby('time.{}'.format(grouping))
+
+
+# Statistics
+
+for statistic in sorted(functions.registry.keys()):
+	if statistic != 'spi':
+
+		@case('statistic_{}'.format(statistic), statistic=statistic)
+		def apply_statistic(files, statistic):
+			groups = gridded(files).variables['pr'].groupby('time.yearmonth')
+			entry = functions.registry[statistic]
+			return lambda: groups.apply(entry['function'], outunits=entry['units'], **statistic_params.get(statistic, {}))
+
+
+@case('statistic_total_stations')
+def apply_stations(files):
+	groups = dataset.NetCDF4Dataset([files['stations']]).variables['pr'].groupby('time.yearmonth')
+	return lambda: groups.apply(functions.total)
+
+
+@case('statistic_mean_hourly')
+def apply_hourly(files):
+	groups = dataset.NetCDF4Dataset([files['hourly']]).variables['pr'].groupby('time.yearmonth')
+	return lambda: groups.apply(functions.mean)
+
+
+@case('spi')
+def spi(files):
+	monthly = gridded(files).variables['pr'].groupby('time.yearmonth').apply(functions.total)
+	data = monthly.variables['pr_total'][:, :10, :10]
+	return lambda: functions.spi(data, 3)
+
+
+# Subsetting
+
+@case('subset')
+def subset(files):
+	variable = gridded(files).variables['pr']
+	return lambda: variable.subset(latitude=(-30.0, -20.0), longitude=(20.0, 30.0), time=('1981-01-01', '1981-12-31'))[:]
+
+
+# Area statistics weighting, needs shapely
+
+@case('areastats_weights')
+def areastats_weights(files):
+
+	try:
+		from shapely.geometry import Point
+		from climstats import gridfunctions
+	except ImportError as e:
+		raise Skip(str(e))
+
+	variable = gridded(files).variables['pr']
+	lats, lons = variable.coords['latitude'][:], variable.coords['longitude'][:]
+
+	random = np.random.RandomState(0)
+	polygons = [Point(x, y).buffer(r) for x, y, r in zip(random.uniform(18, 32, files['polygons']), random.uniform(-32, -18, files['polygons']), random.uniform(0.5, 3.0, files['polygons']))]
+
+	def run():
+		shape, polys = gridfunctions.makegrid(lats, lons)
+		return gridfunctions.grid_weights(polys, polygons)
+
+	return run
+
+
+@case('areastats_means')
+def areastats_means(files):
+
+	try:
+		from shapely.geometry import Point
+		from climstats import gridfunctions
+	except ImportError as e:
+		raise Skip(str(e))
+
+	variable = gridded(files).variables['pr']
+	lats, lons = variable.coords['latitude'][:], variable.coords['longitude'][:]
+
+	random = np.random.RandomState(0)
+	polygons = [Point(x, y).buffer(r) for x, y, r in zip(random.uniform(18, 32, files['polygons']), random.uniform(-32, -18, files['polygons']), random.uniform(0.5, 3.0, files['polygons']))]
+
+	shape, polys = gridfunctions.makegrid(lats, lons)
+	weights = gridfunctions.weights_matrix(*gridfunctions.grid_weights(polys, polygons), shape=(len(polygons),) + shape)
+
+	return lambda: gridfunctions.area_means(weights, variable[:])
+
+
+@case('locate_stations')
+def locate_stations(files):
+
+	try:
+		from shapely.geometry import Point
+		from climstats import spatial
+	except ImportError as e:
+		raise Skip(str(e))
+
+	variable = dataset.NetCDF4Dataset([files['stations']]).variables['pr']
+	lats, lons = variable.coords['latitude'][:], variable.coords['longitude'][:]
+
+	random = np.random.RandomState(0)
+	polygons = [Point(x, y).buffer(r) for x, y, r in zip(random.uniform(18, 32, files['polygons']), random.uniform(-32, -18, files['polygons']), random.uniform(0.5, 3.0, files['polygons']))]
+
+	return lambda: spatial.locate_points(lons, lats, polygons)
+
+
+# Writing
+
+def monthly(files):
+	return gridded(files).variables['pr'].groupby('time.yearmonth').apply(functions.total)
+
+
+@case('write_netcdf')
+def write_netcdf(files):
+	result = monthly(files)
+	return lambda: dataset.NetCDF4Dataset.write(result, os.path.join(files['output'], 'write_netcdf.nc'))
+
+
+@case('write_netcdf_zlib')
+def write_netcdf_zlib(files):
+	result = monthly(files)
+	encoding = {'*': {'zlib': True, 'complevel': 4, 'chunks': 'map'}}
+	return lambda: dataset.NetCDF4Dataset.write(result, os.path.join(files['output'], 'write_netcdf_zlib.nc'), encoding=encoding)
+
+
+@case('write_streaming')
+def write_streaming(files):
+	groups = gridded(files).variables['pr'].groupby('time.yearmonth')
+
+	def run():
+		with dataset.NetCDF4Writer(os.path.join(files['output'], 'write_streaming.nc')) as writer:
+			groups.apply(functions.total, writer=writer)
+
+	return run
+
+
+def worker_cases(workers):
+	"""Register the cases that scale with the number of workers"""
+
+	for count in workers:
+
+		@case('write_chunkstore_w{}'.format(count), workers=count)
+		def write_chunkstore(files, workers):
+			result = monthly(files)
+			path = os.path.join(files['output'], 'write_chunkstore_w{}.zarr'.format(workers))
+
+			def run():
+				shutil.rmtree(path, True)
+				chunkstore.write(result, path, workers=workers)
+
+			return run
+
+		@case('multifile_read_w{}'.format(count), workers=count)
+		def multifile_read(files, workers):
+			def run():
+				source = dataset.NetCDF4Dataset(files['multifile'], workers=workers)
+				try:
+					return source.variables['pr'][:]
+				finally:
+					source.ncfile.close()
+			return run
+
+
+def current_rss():
+	"""Current resident set size in bytes"""
+
+	try:
+		with open('/proc/self/statm') as statm:
+			return int(statm.read().split()[1]) * resource.getpagesize()
+	except IOError:
+		return peak_rss()
+
+
+def peak_rss():
+	"""Peak resident set size of this process in bytes"""
+
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_case(name, files, repeat, connection):
+	"""Run one case in this (child) process and send the result back through connection"""
+
+	func, params = cases[name]
+	result = {'params': params}
+
+	# The library prints progress and warnings, keep them out of the report
+	devnull = os.open(os.devnull, os.O_WRONLY)
+	stdout, stderr = os.dup(1), os.dup(2)
+	os.dup2(devnull, 1)
+	os.dup2(devnull, 2)
+
+	try:
+		run = func(files, **params)
+
+		before = current_rss()
+		times = []
+
+		for i in range(repeat):
+			start = time.time()
+			run()
+			times.append(time.time() - start)
+
+		sys.stdout.flush()
+
+		result.update({
+			'status': 'ok',
+			'seconds': min(times),
+			'mean_seconds': sum(times) / len(times),
+			'repeat': repeat,
+			'peak_mb': peak_rss() / 1e6,
+			'delta_mb': max(0, peak_rss() - before) / 1e6,
+		})
+
+	except Skip as e:
+		result.update({'status': 'skipped', 'reason': str(e)})
+
+	except Exception as e:
+		result.update({'status': 'error', 'reason': repr(e), 'traceback': traceback.format_exc()})
+
+	finally:
+		sys.stdout.flush()
+		sys.stderr.flush()
+		os.dup2(stdout, 1)
+		os.dup2(stderr, 2)
+
+	connection.send(result)
+	connection.close()
+
+
+def run(args):
+
+	workers = [int(count) for count in args.workers.split(',')]
+	worker_cases(workers)
+
+	directory = args.data if args.data else tempfile.mkdtemp(prefix='climstats_bench_')
+	if not os.path.exists(directory):
+		os.makedirs(directory)
+
+	started = time.time()
+	files = generate(directory, args.size, workers)
+	print('generated datasets in {} ({:.1f}s)'.format(directory, time.time() - started))
+
+	selected = [name for name in cases.keys() if not args.cases or re.search(args.cases, name)]
+
+	results = OrderedDict()
+
+	for name in selected:
+
+		# Every case gets its own process so the peak memory is its own
+		receive, send = multiprocessing.Pipe(duplex=False)
+		process = multiprocessing.Process(target=run_case, args=(name, files, args.repeat, send))
+		process.start()
+		send.close()
+
+		try:
+			result = receive.recv()
+		except EOFError:
+			result = {'status': 'error', 'reason': 'case process died with exit code {}'.format(process.exitcode)}
+
+		process.join()
+		results[name] = result
+
+		if result['status'] == 'ok':
+			print('{:40s} {:10.4f}s {:10.1f}MB peak {:10.1f}MB'.format(name, result['seconds'], result['delta_mb'], result['peak_mb']))
+		else:
+			print('{:40s} {}: {}'.format(name, result['status'], result['reason']))
+
+	if not args.data:
+		shutil.rmtree(directory, True)
+
+	commit = git_commit()
+	report = OrderedDict([
+		('commit', commit),
+		('date', datetime.datetime.now().isoformat()),
+		('size', args.size),
+		('workers', workers),
+		('repeat', args.repeat),
+		('python', platform.python_version()),
+		('numpy', np.__version__),
+		('platform', platform.platform()),
+		('cpus', multiprocessing.cpu_count()),
+		('cases', results),
+	])
+
+	output = args.output
+	if not output:
+		output = os.path.join(here, 'results', '{}_{}.json'.format(commit, args.size))
+
+	if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+		os.makedirs(os.path.dirname(output))
+
+	with open(output, 'w') as jsonfile:
+		json.dump(report, jsonfile, indent=1)
+
+	print('results saved to {}'.format(output))
+
+
+def git_commit():
+	"""Short hash of the current commit (with + appended if the tree has changes), or 'unknown'"""
+
+	try:
+		commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here).strip()
+		dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=here)
+	except (OSError, subprocess.CalledProcessError):
+		return 'unknown'
+
+	return commit + ('+' if dirty else '')
+
+
+def compare(args):
+	"""Compare two result files, returns the number of cases that got slower by more than the threshold"""
+
+	with open(args.old) as jsonfile:
+		old = json.load(jsonfile)
+	with open(args.new) as jsonfile:
+		new = json.load(jsonfile)
+
+	print('{} ({}) -> {} ({})'.format(old['commit'], old['size'], new['commit'], new['size']))
+	print('{:40s} {:>10s} {:>10s} {:>8s} {:>10s} {:>10s}'.format('case', 'old s', 'new s', 'ratio', 'old MB', 'new MB'))
+
+	slower = 0
+
+	for name, result in new['cases'].items():
+
+		before = old['cases'].get(name)
+
+		if not before or before['status'] != 'ok' or result['status'] != 'ok':
+			print('{:40s} {:>10s} {:>10s}'.format(name, before['status'] if before else '-', result['status']))
+			continue
+
+		ratio = result['seconds'] / before['seconds'] if before['seconds'] else float('inf')
+
+		flag = ''
+		if ratio > 1 + args.threshold:
+			flag = 'SLOWER'
+			slower += 1
+		elif ratio < 1 - args.threshold:
+			flag = 'faster'
+
+		print('{:40s} {:10.4f} {:10.4f} {:8.2f} {:10.1f} {:10.1f} {}'.format(name, before['seconds'], result['seconds'], ratio, before['delta_mb'], result['delta_mb'], flag))
+
+	return slower
+
+
+if __name__ == '__main__':
+
+	logging.basicConfig(level=logging.WARNING)
+
+	parser = argparse.ArgumentParser('climstats benchmarks')
+	commands = parser.add_subparsers(dest='command')
+
+	runner = commands.add_parser('run', help='run the benchmarks')
+	runner.add_argument('--size', type=str, default='small', choices=sorted(sizes.keys()))
+	runner.add_argument('--workers', type=str, default='1,2', help='comma separated worker counts')
+	runner.add_argument('--cases', type=str, help='only run cases matching this regular expression')
+	runner.add_argument('--repeat', type=int, default=3)
+	runner.add_argument('--data', type=str, help='directory for the synthetic datasets, kept for reuse')
+	runner.add_argument('--output', type=str, help='results file, defaults to results/<commit>_<size>.json')
+
+	comparer = commands.add_parser('compare', help='compare two results files')
+	comparer.add_argument('old', type=str)
+	comparer.add_argument('new', type=str)
+	comparer.add_argument('--threshold', type=float, default=0.1, help='relative change reported as slower/faster')
+	comparer.add_argument('--strict', action='store_true', help='exit with an error if any case got slower')
+
+	commands.add_parser('list', help='list the cases')
+
+	args = parser.parse_args()
+
+	if args.command == 'run':
+		run(args)
+
+	elif args.command == 'compare':
+		slower = compare(args)
+		if args.strict and slower:
+			sys.exit(1)
+
+	elif args.command == 'list':
+		worker_cases([1])
+		for name in cases.keys():
+			print(name)
@@ -0,0 +1,170 @@
+"""
+Synthetic CF compliant NetCDF datasets for benchmarking.  Gridded datasets have (time, lat, lon) variables,
+station datasets follow the (time, feature) layout written by util/bruce2nc.py.  Values are gamma
+distributed (like daily rainfall) with a configurable fraction of missing values and any of the CF calendars
+can be used.
+
+usage: python synthetic.py [--stations N | --grid NYxNX] [--years N] [--frequency daily|hourly]
+                           [--calendar standard|noleap|360_day] [--missing FRACTION] output
+"""
+
+import argparse
+import datetime
+
+import numpy as np
+import netCDF4
+
+
+# Time steps per day for each frequency
+frequencies = {'daily': 1, 'hourly': 24}
+
+fill_value = 1e10
+
+
+def time_values(years, frequency='daily', calendar='standard', start=1980):
+	"""
+	Return the time units and the time values for years of data at frequency in calendar
+	"""
+
+	steps = frequencies[frequency]
+	units = '{} since {:04d}-01-01 00:00:00'.format('days' if steps == 1 else 'hours', start)
+
+	first = netCDF4.date2num(datetime.datetime(start, 1, 1), units, calendar=calendar)
+	last = netCDF4.date2num(datetime.datetime(start + years, 1, 1), units, calendar=calendar)
+
+	return units, np.arange(first, last, dtype=np.float64)
+
+
+def values(shape, missing=0.1, seed=0):
+	"""Gamma distributed values with a fraction of them masked"""
+
+	random = np.random.RandomState(seed)
+
+	data = random.gamma(0.5, 8.0, shape).astype(np.float32)
+	mask = random.random_sample(shape) < missing
+
+	return np.ma.masked_array(data, mask=mask)
+
+
+def write_time(ncfile, units, times, calendar, unlimited=True):
+
+	ncfile.createDimension('time', None if unlimited else len(times))
+
+	timevar = ncfile.createVariable('time', 'f8', ('time',))
+	timevar.units = units
+	timevar.calendar = calendar
+	timevar.standard_name = 'time'
+	timevar[:] = times
+
+
+def write_data(ncfile, varname, dimensions, times, shape, missing, seed, chunks=None, block=None):
+	"""Write the data variable a block of time steps at a time so large files don't need to fit in memory"""
+
+	var = ncfile.createVariable(varname, 'f4', dimensions, fill_value=fill_value, zlib=True, chunksizes=chunks)
+	var.units = 'mm'
+	var.standard_name = 'precipitation_amount'
+
+	if block is None:
+		block = max(1, (16 * 1024 * 1024) // (4 * int(np.prod(shape))))
+
+	for start in range(0, len(times), block):
+		stop = min(start + block, len(times))
+		var[start:stop] = values((stop - start,) + tuple(shape), missing=missing, seed=seed + start)
+
+	return var
+
+
+def make_gridded(filename, years=2, frequency='daily', ny=50, nx=60, calendar='standard', missing=0.1, chunks=None, seed=0, varname='pr', start=1980):
+	"""
+	Create a gridded (time, lat, lon) dataset covering a region of southern Africa
+	"""
+
+	units, times = time_values(years, frequency, calendar, start=start)
+
+	ncfile = netCDF4.Dataset(filename, 'w', format='NETCDF4')
+	ncfile.Conventions = 'CF-1.6'
+	ncfile.title = 'synthetic gridded {} data'.format(frequency)
+
+	write_time(ncfile, units, times, calendar)
+
+	ncfile.createDimension('lat', ny)
+	ncfile.createDimension('lon', nx)
+
+	lat = ncfile.createVariable('lat', 'f4', ('lat',))
+	lat.units = 'degrees_north'
+	lat.standard_name = 'latitude'
+	lat[:] = np.linspace(-35.0, -15.0, ny)
+
+	lon = ncfile.createVariable('lon', 'f4', ('lon',))
+	lon.units = 'degrees_east'
+	lon.standard_name = 'longitude'
+	lon[:] = np.linspace(15.0, 35.0, nx)
+
+	write_data(ncfile, varname, ('time', 'lat', 'lon'), times, (ny, nx), missing, seed, chunks=chunks)
+
+	ncfile.close()
+
+	return filename
+
+
+def make_stations(filename, years=2, frequency='daily', features=200, calendar='standard', missing=0.1, seed=0, varname='pr', start=1980):
+	"""
+	Create a station dataset in the (time, feature) layout of util/bruce2nc.py
+	"""
+
+	units, times = time_values(years, frequency, calendar, start=start)
+	random = np.random.RandomState(seed)
+
+	ncfile = netCDF4.Dataset(filename, 'w', format='NETCDF4')
+	ncfile.Conventions = 'CF-1.6'
+	ncfile.featureType = 'timeSeries'
+	ncfile.title = 'synthetic station {} data'.format(frequency)
+
+	write_time(ncfile, units, times, calendar, unlimited=False)
+	ncfile.createDimension('feature', features)
+
+	latitude = ncfile.createVariable('latitude', 'f4', ('feature',))
+	latitude.units = 'degrees_north'
+	latitude[:] = random.uniform(-35.0, -15.0, features)
+
+	longitude = ncfile.createVariable('longitude', 'f4', ('feature',))
+	longitude.units = 'degrees_east'
+	longitude[:] = random.uniform(15.0, 35.0, features)
+
+	elevation = ncfile.createVariable('elevation', 'f4', ('feature',))
+	elevation.units = 'meters'
+	elevation.positive = 'up'
+	elevation[:] = random.uniform(0.0, 2500.0, features)
+
+	ids = ncfile.createVariable('id', str, ('feature',))
+	names = ncfile.createVariable('name', str, ('feature',))
+	for i in range(features):
+		ids[i] = '{:07d}'.format(i)
+		names[i] = 'STATION {}'.format(i)
+
+	var = write_data(ncfile, varname, ('time', 'feature'), times, (features,), missing, seed)
+	var.coordinates = 'latitude longitude'
+
+	ncfile.close()
+
+	return filename
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser('Create synthetic CF compliant datasets')
+	parser.add_argument('output', type=str)
+	parser.add_argument('--stations', type=int, help='number of stations (features)')
+	parser.add_argument('--grid', type=str, default='50x60', help='grid size as NYxNX')
+	parser.add_argument('--years', type=int, default=2)
+	parser.add_argument('--frequency', type=str, default='daily', choices=sorted(frequencies.keys()))
+	parser.add_argument('--calendar', type=str, default='standard')
+	parser.add_argument('--missing', type=float, default=0.1, help='fraction of missing values')
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	if args.stations:
+		make_stations(args.output, args.years, args.frequency, args.stations, args.calendar, args.missing, args.seed)
+	else:
+		ny, nx = [int(size) for size in args.grid.split('x')]
+		make_gridded(args.output, args.years, args.frequency, ny, nx, args.calendar, args.missing, seed=args.seed)
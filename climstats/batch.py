@@ -0,0 +1,412 @@
+"""
+Batch processing of many statistics jobs over a few source datasets.  Jobs are read from a YAML or JSON job
+file, each job being the equivalent of one bin/climstats command line:
+
+	defaults:
+		source: /data/pr_*.nc
+		tolerance: 0.9
+		encoding: ["zlib=true,complevel=4"]
+
+	jobs:
+		- variable: pr
+		  aggregation: time.yearmonth
+		  statistic: total
+		  output: out/pr_monthly_total.nc
+
+		- variable: pr
+		  aggregation: time.yearmonth
+		  statistic: days
+		  above: 1.0
+		  output: out/pr_monthly_raindays.nc
+
+Job options are source, variable, aggregation, statistic and output (all required) and name, outname,
+scale, offset, tolerance, above, below, params (extra function parameters), format (a NetCDF format or
+ZARR), encoding (a list of --encoding specifications or an encoding dictionary), index, scratch and prefetch.
+Options in defaults apply to every job that doesn't set them.
+
+Jobs are planned so that each source is opened once and jobs on the same variable and aggregation share the
+grouping and the reads (see GroupBy.applymany).  Those shared units can also be run in a pool of worker
+processes, each unit then opens its source itself.  A job that fails is reported and the rest carry on.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import logging
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+import dataset
+import functions
+import chunkstore
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchException(Exception):
+	"""
+	Raised for job files that can't be read
+	"""
+
+	def __init__(self, value):
+		self.value = value
+
+	def __str__(self):
+		return repr(self.value)
+
+
+required = ['source', 'variable', 'aggregation', 'statistic', 'output']
+
+optional = {
+	'name': None,
+	'outname': None,
+	'scale': 1.0,
+	'offset': 0.0,
+	'tolerance': 1.0,
+	'above': None,
+	'below': None,
+	'params': {},
+	'format': 'NETCDF4',
+	'encoding': [],
+	'index': None,
+	'scratch': None,
+	'prefetch': 0,
+}
+
+
+def load(filename):
+	"""
+	Read a job file and return the list of jobs with the defaults filled in.  YAML needs PyYAML, files ending
+	in .json are read as JSON.
+	"""
+
+	with open(filename) as jobfile:
+
+		if filename.endswith('.json'):
+			content = json.load(jobfile)
+
+		else:
+			try:
+				import yaml
+			except ImportError:
+				raise BatchException("PyYAML is needed to read {}, or use a JSON job file".format(filename))
+
+			content = yaml.safe_load(jobfile)
+
+	# A plain list of jobs is also accepted
+	if isinstance(content, list):
+		content = {'jobs': content}
+
+	if not isinstance(content, dict) or not isinstance(content.get('jobs'), list):
+		raise BatchException("{} has no list of jobs".format(filename))
+
+	defaults = dict(optional)
+	defaults.update(content.get('defaults', {}))
+
+	jobs = []
+	for number, job in enumerate(content['jobs']):
+
+		if not isinstance(job, dict):
+			raise BatchException("job {} in {} is not a mapping".format(number, filename))
+
+		full = dict(defaults)
+		full.update(job)
+
+		if not full['name']:
+			full['name'] = full.get('output') or 'job{}'.format(number)
+
+		jobs.append(full)
+
+	# Jobs sharing an output would overwrite (or fail to open) each other's results
+	outputs = {}
+	for number, job in enumerate(jobs):
+		if not job.get('output'):
+			continue
+
+		path = os.path.abspath(job['output'])
+		if path in outputs:
+			first = outputs[path]
+			raise BatchException("jobs {} ({}) and {} ({}) in {} both write {}".format(first, jobs[first]['name'], number, job['name'], filename, job['output']))
+
+		outputs[path] = number
+
+	return jobs
+
+
+def validate(job):
+	"""Return why a job can't be run, or None if it looks good"""
+
+	missing = [key for key in required if not job.get(key)]
+	if missing:
+		return "missing {}".format(', '.join(missing))
+
+	if job['statistic'] not in functions.registry:
+		return "unknown statistic {}".format(job['statistic'])
+
+	if '.' not in job['aggregation']:
+		return "aggregation {} is not of the form coordinate.grouping".format(job['aggregation'])
+
+	return None
+
+
+def plan(jobs):
+	"""
+	Split jobs into units of work that share a source, variable and aggregation.  Returns a list of
+	(source, index, variable, aggregation, jobs) tuples in the order the units first appear.
+	"""
+
+	units = OrderedDict()
+
+	for job in jobs:
+		key = (job['source'], job['index'], job['variable'], job['aggregation'])
+		units.setdefault(key, []).append(job)
+
+	return [key + (unitjobs,) for key, unitjobs in units.items()]
+
+
+def coerce(value):
+	"""Try and coerce a string to an integer, then a float, or leave it as it is"""
+
+	if not isinstance(value, basestring):
+		return value
+
+	for kind in (int, float):
+		try:
+			return kind(value)
+		except ValueError:
+			pass
+
+	return value
+
+
+def threshold(variable, value, scale, offset, cache):
+	"""
+	Resolve an above or below value like bin/climstats does.  Numbers are used as they are, a value such as
+	90th is that percentile of the (scaled) source along the first axis and file:variable[:timestep] is a
+	field from another dataset.  Percentiles are cached so jobs sharing a variable read it only once.
+	"""
+
+	value = coerce(value)
+
+	if not isinstance(value, basestring):
+		return value
+
+	if value[-2:] == 'th':
+		key = (float(value[:-2]), scale, offset)
+
+		if key not in cache:
+			data = variable[:] * scale + offset
+			if type(data) == np.ma.MaskedArray:
+				cache[key] = np.nanpercentile(data.filled(np.nan), key[0], axis=0)
+			else:
+				cache[key] = np.percentile(data, key[0], axis=0)
+
+		return cache[key]
+
+	parts = value.split(':')
+	if len(parts) < 2:
+		raise ValueError("can't interpret threshold {}".format(value))
+
+	timestep = int(parts[2]) if len(parts) > 2 else 0
+
+	return dataset.NetCDF4Dataset([parts[0]]).variables[parts[1]][timestep]
+
+
+def writer(job):
+	"""Create the streaming writer for a job's output"""
+
+	directory = os.path.dirname(job['output'])
+	if directory and not os.path.exists(directory):
+		os.makedirs(directory)
+
+	encoding = job['encoding']
+	if isinstance(encoding, basestring):
+		encoding = [encoding]
+	if isinstance(encoding, list):
+		encoding = dataset.NetCDF4Writer.parse_encoding(encoding)
+
+	if job['format'] == 'ZARR':
+		return chunkstore.ChunkStoreWriter(job['output'], encoding=encoding)
+
+	return dataset.NetCDF4Writer(job['output'], format=job['format'], encoding=encoding)
+
+
+def discard(job, output):
+	"""Close a failed job's writer and remove its partial output"""
+
+	try:
+		output.close()
+	except Exception:
+		pass
+
+	if os.path.isdir(job['output']):
+		shutil.rmtree(job['output'], True)
+	elif os.path.exists(job['output']):
+		os.remove(job['output'])
+
+
+def report(job, error=None, seconds=0.0):
+	"""The report entry for a job"""
+
+	if error:
+		logger.error("{} failed: {}".format(job['name'], error))
+	else:
+		logger.info("{} done in {:.2f}s".format(job['name'], seconds))
+
+	return {'name': job['name'], 'output': job.get('output'), 'status': 'failed' if error else 'ok', 'error': error, 'seconds': seconds}
+
+
+def describe(exc_info):
+	return "{}: {}".format(exc_info[0].__name__, exc_info[1])
+
+
+def run_unit(unit, sources=None, workers=1):
+	"""
+	Run the jobs of one unit (see plan), returns their report entries.  sources is an optional dictionary
+	of datasets already opened, keyed on (source, index).  This is a module level function so that it can
+	be run by a process pool.
+	"""
+
+	source, index, varname, aggregation, jobs = unit
+	start = time.time()
+
+	reports = OrderedDict()
+
+	def fail(job, error):
+		reports[id(job)] = report(job, error)
+
+	# Open (or reuse) the source and group the variable, a failure here fails every job of the unit
+	try:
+		if sources is not None and (source, index) in sources:
+			ds = sources[(source, index)]
+		else:
+			filenames = glob.glob(source)
+			if not filenames:
+				raise IOError("no files match {}".format(source))
+
+			ds = dataset.NetCDF4Dataset(filenames, index=index, workers=workers)
+			if sources is not None:
+				sources[(source, index)] = ds
+
+		variable = ds.variables[varname]
+		groups = variable.groupby(aggregation)
+
+	except Exception:
+		error = describe(sys.exc_info())
+		return [report(job, error) for job in jobs]
+
+	# Set up the tasks, a job that can't be set up fails on its own
+	tasks, taskjobs = [], []
+	cache = {}
+
+	for job in jobs:
+
+		try:
+			params = dict(job['params'])
+
+			for name in ['above', 'below']:
+				if job[name] is not None:
+					params[name] = threshold(variable, job[name], job['scale'], job['offset'], cache)
+
+			statistic = functions.registry[job['statistic']]
+
+			task = {
+				'func': statistic['function'],
+				'name': job['outname'] or varname,
+				'outunits': statistic['units'],
+				'tolerance': job['tolerance'],
+				'scale': job['scale'],
+				'offset': job['offset'],
+				'scratch': job['scratch'],
+				'params': params,
+				'writer': writer(job),
+			}
+
+		except Exception:
+			fail(job, describe(sys.exc_info()))
+			continue
+
+		tasks.append(task)
+		taskjobs.append(job)
+
+	setup = time.time() - start
+
+	# Every group is read once for all the tasks
+	failed = {}
+	prefetch = max([job['prefetch'] for job in taskjobs] or [0])
+
+	try:
+		groups.applymany(tasks, prefetch=prefetch, failed=failed)
+
+	except Exception:
+		error = describe(sys.exc_info())
+		for job, task in zip(taskjobs, tasks):
+			discard(job, task['writer'])
+			fail(job, error)
+
+		return [reports[id(job)] for job in jobs]
+
+	seconds = time.time() - start
+
+	for number, (job, task) in enumerate(zip(taskjobs, tasks)):
+
+		if number in failed:
+			discard(job, task['writer'])
+			fail(job, describe(failed[number]))
+			continue
+
+		try:
+			task['writer'].close()
+		except Exception:
+			discard(job, task['writer'])
+			fail(job, describe(sys.exc_info()))
+			continue
+
+		# The time of the shared reads is split between the jobs
+		reports[id(job)] = report(job, seconds=setup / len(jobs) + (seconds - setup) / len(tasks))
+
+	return [reports[id(job)] for job in jobs]
+
+
+def run(jobs, workers=1, read_workers=1):
+	"""
+	Run a list of jobs (see load) and return a report entry for each, in the order of jobs.  With workers > 1
+	the units of shared work are run in a pool of processes.
+	"""
+
+	reports = {}
+
+	valid = []
+	for job in jobs:
+		error = validate(job)
+		if error:
+			reports[id(job)] = report(job, error)
+		else:
+			valid.append(job)
+
+	units = plan(valid)
+	logger.info("{} jobs in {} units".format(len(valid), len(units)))
+
+	if workers > 1 and len(units) > 1:
+		pool = multiprocessing.Pool(min(workers, len(units)))
+		try:
+			results = pool.map(run_unit, units, chunksize=1)
+		finally:
+			pool.close()
+			pool.join()
+
+	else:
+		sources = {}
+		results = [run_unit(unit, sources, workers=read_workers) for unit in units]
+
+	for unit, unitreports in zip(units, results):
+		for job, entry in zip(unit[-1], unitreports):
+			reports[id(job)] = entry
+
+	return [reports[id(job)] for job in jobs]
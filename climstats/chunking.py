@@ -0,0 +1,331 @@
+"""
+Storage chunk aware read planning.  A ReadPlanner looks at the chunking of a NetCDF4/HDF5 variable and aligns
+streaming blocks and tiles to whole chunks, sizes the HDF5 chunk cache to the planned working set and, when
+profiling (see instrument), keeps count of how many bytes had to be decompressed to deliver the bytes actually
+asked for.
+"""
+
+import itertools
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+import instrument
+
+logger = logging.getLogger(__name__)
+
+
+# Upper limit for the chunk cache of a single variable
+cache_limit = 1024 * 1024 * 1024
+
+# Above this many chunks in a single read we don't simulate the cache
+max_simulated = 100000
+
+
+def chunk_shape(ncvar):
+	"""
+	Return the storage chunk shape of a NetCDF variable or None if it is contiguous (or we can't tell)
+	"""
+
+	try:
+		chunks = ncvar.chunking()
+	except (AttributeError, RuntimeError):
+		return None
+
+	if chunks == 'contiguous' or chunks is None:
+		return None
+
+	return tuple([int(c) for c in chunks])
+
+
+def align(start, stop, chunk):
+	"""Expand [start, stop) outwards to whole chunks"""
+	return (start // chunk) * chunk, -(-stop // chunk) * chunk
+
+
+def blocks(start, stop, chunk, size):
+	"""
+	Split [start, stop) into blocks of (about) size elements whose boundaries fall on chunk boundaries.
+	Blocks are always at least one chunk long.  Returns a list of slices.
+	"""
+
+	if chunk is None or chunk < 1:
+		chunk = 1
+
+	size = max(chunk, (size // chunk) * chunk)
+
+	result = []
+	first = start
+
+	while first < stop:
+
+		# The first block ends on a chunk boundary, the rest are whole multiples of the chunk size
+		last = min(((first // chunk) * chunk) + size, stop)
+		result.append(slice(first, last))
+		first = last
+
+	return result
+
+
+def chunk_sizes(shape, itemsize, access='map', target=1024 * 1024):
+	"""
+	Suggest output chunk sizes for a variable whose leading dimension is time.  'map' access chunks one time step
+	of the full grid, 'timeseries' access chunks the full time extent of a small block of grid points.  Chunks
+	are kept to about target bytes.
+	"""
+
+	shape = [max(1, int(size)) for size in shape]
+
+	if len(shape) < 2:
+		return [min(shape[0], max(1, target // itemsize))] if shape else []
+
+	if access == 'map':
+		chunks = [1] + shape[1:]
+		remaining = max(1, target // itemsize)
+
+		# Shrink the slowest varying grid dimensions first if a single map is too big
+		for i in range(1, len(shape)):
+			other = int(np.prod(chunks[i+1:])) if i+1 < len(chunks) else 1
+			chunks[i] = max(1, min(shape[i], remaining // other))
+			remaining = max(1, remaining // chunks[i])
+
+		return chunks
+
+	if access == 'timeseries':
+		chunks = [shape[0]] + [1] * (len(shape) - 1)
+		remaining = max(1, target // (shape[0] * itemsize))
+
+		# Grow the fastest varying dimensions first
+		for i in reversed(range(1, len(shape))):
+			chunks[i] = max(1, min(shape[i], remaining))
+			remaining = max(1, remaining // chunks[i])
+
+		return chunks
+
+	raise ValueError("unknown access pattern {}".format(access))
+
+
+class ReadPlanner(object):
+	"""
+	Plans reads of one NetCDF variable around its storage chunks and records decompressed versus useful bytes
+	"""
+
+	def __init__(self, ncvar, shape, itemsize):
+		"""
+		ncvar: the netCDF4.Variable (or equivalent with chunking/set_var_chunk_cache methods)
+		shape: the full shape of the variable
+		itemsize: bytes per value
+		"""
+
+		self.ncvar = ncvar
+		self.shape = tuple(shape)
+		self.itemsize = itemsize
+		self.chunks = chunk_shape(ncvar)
+
+		if self.chunks:
+			self.chunkbytes = int(np.prod(self.chunks)) * itemsize
+		else:
+			self.chunkbytes = 0
+
+		self.cachebytes = 0
+		self._cached = OrderedDict()
+
+		self.stats = {'reads': 0, 'useful_bytes': 0, 'decompressed_bytes': 0}
+
+	@property
+	def amplification(self):
+		"""Ratio of decompressed to useful bytes read"""
+
+		if not self.stats['useful_bytes']:
+			return 0.0
+
+		return float(self.stats['decompressed_bytes']) / self.stats['useful_bytes']
+
+	def set_cache(self, nbytes):
+		"""Size the HDF5 chunk cache of the variable to hold nbytes"""
+
+		if not self.chunks:
+			return
+
+		nbytes = int(min(max(nbytes, self.chunkbytes), cache_limit))
+		nchunks = max(1, nbytes // self.chunkbytes)
+
+		try:
+			# nelems should be a prime number well above the number of chunks, a large odd number will do
+			self.ncvar.set_var_chunk_cache(size=nbytes, nelems=nchunks * 10 + 1, preemption=0.75)
+		except (AttributeError, RuntimeError):
+			logger.debug("cannot set chunk cache on {}".format(self.ncvar))
+			return
+
+		self.cachebytes = nbytes
+		logger.debug("chunk cache set to {} bytes ({} chunks)".format(nbytes, nchunks))
+
+	def _chunk_ranges(self, indices):
+		"""Return, for each dimension, the sorted chunk indices touched by a (normalized) tuple of indices"""
+
+		ranges = []
+
+		for i, index in enumerate(indices):
+			chunk = self.chunks[i]
+
+			if isinstance(index, slice):
+				start, stop, step = index.indices(self.shape[i])
+				if stop <= start:
+					return None
+				if step == 1:
+					ranges.append(range(start // chunk, (stop - 1) // chunk + 1))
+				else:
+					ranges.append(sorted(set(np.arange(start, stop, step) // chunk)))
+
+			elif isinstance(index, (int, long, np.integer)):
+				ranges.append([int(index) // chunk])
+
+			else:
+				index = np.asarray(index)
+				if index.dtype == bool:
+					index = index.nonzero()[0]
+				if not len(index):
+					return None
+				ranges.append(sorted(set((index // chunk).tolist())))
+
+		return ranges
+
+	def touched(self, indices):
+		"""Return the number of chunks touched by a read of indices"""
+
+		if not self.chunks:
+			return 0
+
+		ranges = self._chunk_ranges(indices)
+
+		if ranges is None:
+			return 0
+
+		return int(np.prod([len(r) for r in ranges]))
+
+	def record(self, indices, useful):
+		"""
+		Record a read of indices that returned useful bytes.  When instrumentation is enabled the decompressed
+		bytes are estimated by replaying the touched chunks through a LRU model of the chunk cache, which is too
+		slow to run on every read otherwise.
+		"""
+
+		self.stats['reads'] += 1
+		self.stats['useful_bytes'] += useful
+
+		if not instrument.enabled:
+			return
+
+		# Contiguous storage only reads what is asked for
+		if not self.chunks:
+			self.stats['decompressed_bytes'] += useful
+			return
+
+		ranges = self._chunk_ranges(indices)
+		if ranges is None:
+			return
+
+		count = int(np.prod([len(r) for r in ranges]))
+		capacity = self.cachebytes // self.chunkbytes if self.cachebytes else 0
+
+		if count > max_simulated or not capacity:
+			self.stats['decompressed_bytes'] += count * self.chunkbytes
+			return
+
+		misses = 0
+		for key in itertools.product(*ranges):
+			if key in self._cached:
+				self._cached.pop(key)
+			else:
+				misses += 1
+
+			self._cached[key] = True
+
+			if len(self._cached) > capacity:
+				self._cached.popitem(last=False)
+
+		self.stats['decompressed_bytes'] += misses * self.chunkbytes
+
+	def blocks(self, axis, start, stop, budget):
+		"""
+		Split [start, stop) along axis into chunk aligned blocks such that a block spanning the full extent of
+		the other dimensions holds about budget bytes
+		"""
+
+		other = int(np.prod([s for i, s in enumerate(self.shape) if i != axis])) * self.itemsize
+		size = max(1, budget // max(other, 1))
+		chunk = self.chunks[axis] if self.chunks else 1
+
+		return blocks(start, stop, chunk, size)
+
+	def plan(self, groups, axis, extents, limit=None):
+		"""
+		Plan reading a list of groups (index lists or slices along axis) over extents, a list of (start, stop)
+		absolute ranges for each dimension.  Returns a list of tiles, each a list of (start, stop) ranges over the
+		dimensions other than axis (None for axis), and sizes the chunk cache so that the chunks of one group
+		within a tile stay cached while consecutive groups are read.  Tiles are only used when the full width
+		working set doesn't fit in limit bytes.
+		"""
+
+		full = [None if i == axis else extent for i, extent in enumerate(extents)]
+
+		if not self.chunks:
+			return [full]
+
+		if limit is None:
+			limit = cache_limit
+
+		# The most chunks any one group touches along the grouping axis
+		depth = 1
+		offset = extents[axis][0]
+		for indices in groups:
+			if isinstance(indices, slice):
+				positions = np.arange(indices.start + offset, indices.stop + offset)
+			else:
+				positions = np.asarray(indices) + offset
+
+			if len(positions):
+				depth = max(depth, len(np.unique(positions // self.chunks[axis])))
+
+		# Chunk grid of the other dimensions
+		grid = []
+		for i, (start, stop) in enumerate(extents):
+			if i != axis:
+				first, last = align(start, stop, self.chunks[i])
+				grid.append((i, first // self.chunks[i], last // self.chunks[i]))
+
+		total = int(np.prod([last - first for i, first, last in grid])) if grid else 1
+
+		if depth * total * self.chunkbytes <= limit:
+			self.set_cache(depth * total * self.chunkbytes)
+			return [full]
+
+		# Too big, so tile the other dimensions keeping the fastest varying dimensions whole where possible
+		allowed = max(1, limit // (depth * self.chunkbytes))
+		sizes = {}
+		for i, first, last in reversed(grid):
+			count = last - first
+			sizes[i] = max(1, min(count, allowed))
+			allowed = max(1, allowed // count)
+
+		per_tile = int(np.prod(sizes.values()))
+		self.set_cache(depth * per_tile * self.chunkbytes)
+
+		# Tile boundaries fall on chunk boundaries clipped to the extents
+		dims = []
+		for i, first, last in grid:
+			start, stop = extents[i]
+			step = sizes[i] * self.chunks[i]
+			edges = [(max(start, e), min(stop, e + step)) for e in range(first * self.chunks[i], last * self.chunks[i], step)]
+			dims.append([edge for edge in edges if edge[0] < edge[1]])
+
+		tiles = []
+		for combination in itertools.product(*dims):
+			tile = list(combination)
+			tile.insert(axis, None)
+			tiles.append(tile)
+
+		logger.info("planned {} tiles of {} chunks for {} groups".format(len(tiles), per_tile, len(groups)))
+
+		return tiles
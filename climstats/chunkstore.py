@@ -0,0 +1,821 @@
+"""
+Chunked directory stores in the Zarr (version 2) layout.  Every variable is a directory holding a .zarray
+metadata file, a .zattrs file with its CF attributes and one file per chunk, each compressed independently.
+Chunks are compressed in a pool of processes so that writing large results isn't limited by single threaded
+NetCDF/HDF5 compression, and because every chunk is a separate file written atomically, several processes
+(eg. the workers of a tiled run) can write disjoint chunks of the same store without coordinating.
+
+ChunkStoreWriter has the same interface as dataset.NetCDF4Writer.  ChunkStore presents a store through the
+same interface as a netCDF4.Dataset so that dataset.NetCDF4Dataset can read it.
+"""
+
+import os
+import json
+import shutil
+import zlib
+import itertools
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+import chunking
+import instrument
+from packing import unpack, pack, pack_parameters, types as packed_types
+from multifile import jsonable, MultiFileDimension
+
+
+logger = logging.getLogger(__name__)
+
+
+# Attributes used to record the netCDF structure, following the xarray conventions
+dimensions_key = '_ARRAY_DIMENSIONS'
+unlimited_key = '_UNLIMITED_DIMENSIONS'
+
+
+class ChunkStoreException(Exception):
+	"""
+	General, very simple chunk store exception class
+	"""
+
+	def __init__(self, value):
+		self.value = value
+
+	def __str__(self):
+		return repr(self.value)
+
+
+def isstore(path):
+	"""Return True if path is a chunked directory store"""
+	return os.path.isdir(path) and os.path.exists(os.path.join(path, '.zgroup'))
+
+
+def chunk_key(position):
+	"""Return the chunk filename for a chunk grid position"""
+
+	if not len(position):
+		return '0'
+
+	return '.'.join([str(p) for p in position])
+
+
+def read_json(path):
+	with open(path) as jsonfile:
+		return json.load(jsonfile, object_pairs_hook=OrderedDict)
+
+
+def write_json(path, content):
+	"""Write a JSON file atomically"""
+
+	temp = "{}.tmp{}".format(path, os.getpid())
+
+	with open(temp, 'w') as jsonfile:
+		json.dump(content, jsonfile, indent=1)
+
+	os.rename(temp, path)
+
+
+def fill_json(value):
+	"""Fill values as they are stored in .zarray, NaN and infinities are stored as strings"""
+
+	if value is None:
+		return None
+
+	value = jsonable(value)
+
+	if isinstance(value, float) and not np.isfinite(value):
+		return 'NaN' if np.isnan(value) else ('Infinity' if value > 0 else '-Infinity')
+
+	return value
+
+
+def fill_value(value, dtype):
+	"""Inverse of fill_json"""
+
+	if value is None:
+		return None
+
+	if value in ('NaN', 'Infinity', '-Infinity'):
+		value = float(value.replace('inity', ''))
+
+	return np.array(value, dtype=dtype)[()]
+
+
+def write_chunk(chunk):
+	"""
+	Compress and write one chunk.  This is a module level function so that it can be run by a process pool,
+	chunk is a (path, raw bytes, compression level) tuple.  The chunk is written to a temporary file and then
+	renamed so readers (and other writers) never see a partial chunk.
+	"""
+
+	path, raw, level = chunk
+
+	if level:
+		raw = zlib.compress(raw, level)
+
+	temp = "{}.tmp{}".format(path, os.getpid())
+
+	with open(temp, 'wb') as chunkfile:
+		chunkfile.write(raw)
+
+	os.rename(temp, path)
+
+	return len(raw)
+
+
+def quantize(values, digits):
+	"""
+	Round values to a power of two precision finer than the given number of decimal digits so that they
+	compress better, as netCDF4 does for least_significant_digit
+	"""
+
+	exponent = np.floor(-digits) if -digits < 0 else np.ceil(-digits)
+	scale = 2.0 ** np.ceil(np.log2(10.0 ** -exponent))
+
+	return np.ma.round(values * scale) / scale
+
+
+def read_chunk(path, dtype, shape, compressed):
+	"""Read one chunk, returns None if the chunk has never been written"""
+
+	try:
+		with open(path, 'rb') as chunkfile:
+			raw = chunkfile.read()
+	except IOError:
+		return None
+
+	if compressed:
+		raw = zlib.decompress(raw)
+
+	return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+class ChunkStoreWriter(object):
+	"""
+	Writes datasets to a chunked directory store.  Like NetCDF4Writer the structure is created from a Dataset
+	with define and data is then written with write_variable or piece by piece with write.  Writes that cover
+	whole chunks are compressed and written straight away, partial chunks are held until they are complete or
+	the writer is closed.
+
+	Opening an existing store with mode='w' first removes its variables and metadata.  Opening it with mode='a'
+	writes chunks into the variables already defined there, which is how independent processes write their
+	own (disjoint) parts of a result.  Partial chunks are merged with the stored chunk on flush by reading,
+	merging and rewriting it, so a chunk must only have one writer at a time: processes writing the same
+	variable concurrently should split it on chunk boundaries.  Variables packed there need
+	explicit scale_factor and add_offset as every process has to pack with the same parameters.
+
+	The encoding options understood are zlib (True/False), complevel, chunks ('map', 'timeseries' or a tuple
+	of sizes), least_significant_digit, pack with optional scale_factor and add_offset, see NetCDF4Writer.
+	Like there, packed variables without explicit parameters are held in memory and written on close.  The
+	HDF5 only options shuffle and significant_digits raise a ChunkStoreException.
+	"""
+
+	# Encoding options of NetCDF4Writer that have no equivalent here
+	unsupported = ['shuffle', 'significant_digits']
+
+	# Default block size in bytes
+	blocksize = 64 * 1024 * 1024
+
+	# Default zlib compression level
+	complevel = 4
+
+	# Maximum number of chunks queued for compression per worker before we wait
+	queued = 4
+
+	def __init__(self, path, mode='w', encoding=None, workers=1, blocksize=None):
+		"""
+		path: directory of the store
+		mode: 'w' to create (or replace) a store, 'a' to write to the variables of an existing store
+		encoding: per variable output options
+		workers: number of processes compressing chunks
+		blocksize: approximate number of bytes written per call by write_variable
+		"""
+
+		self.path = path
+		self.mode = mode
+		self.encoding = encoding if encoding else {}
+		self.workers = workers
+
+		if blocksize:
+			self.blocksize = blocksize
+
+		# Metadata of each variable and the partially filled chunks
+		self.arrays = {}
+		self.partial = {}
+
+		# Packing parameters and least significant digits of the variables that have them, and the values of
+		# packed variables held until close
+		self.packed = {}
+		self.digits = {}
+		self.deferred = {}
+
+		self._pool = None
+		self._pending = []
+
+		if mode == 'a':
+			if not isstore(path):
+				raise ChunkStoreException("{} is not a chunk store".format(path))
+
+			for name in os.listdir(path):
+				if os.path.exists(os.path.join(path, name, '.zarray')):
+					self.arrays[name] = read_json(os.path.join(path, name, '.zarray'))
+					if os.path.exists(os.path.join(path, name, '.zattrs')):
+						self._encoded(name, read_json(os.path.join(path, name, '.zattrs')))
+
+		elif mode == 'w':
+			if os.path.exists(path) and not isstore(path):
+				raise ChunkStoreException("{} exists and is not a chunk store".format(path))
+
+			if not os.path.exists(path):
+				os.makedirs(path)
+			else:
+				self._clear()
+
+			write_json(os.path.join(path, '.zgroup'), {'zarr_format': 2})
+
+		else:
+			raise ChunkStoreException("unsupported mode {}".format(mode))
+
+	def _clear(self):
+		"""Remove the variables and metadata of an existing store so that nothing of the old one is left behind"""
+
+		for name in os.listdir(self.path):
+			entry = os.path.join(self.path, name)
+
+			if os.path.isdir(entry) and (os.path.exists(os.path.join(entry, '.zarray')) or os.path.exists(os.path.join(entry, '.zattrs'))):
+				shutil.rmtree(entry)
+			elif name in ('.zgroup', '.zattrs'):
+				os.remove(entry)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def options(self, variable):
+		"""Return the encoding options for a variable"""
+
+		if variable.dtype in (object, str):
+			return {}
+
+		options = dict(self.encoding.get('*', {}))
+		options.update(self.encoding.get(variable.name, {}))
+
+		for key in self.unsupported:
+			if options.get(key):
+				raise ChunkStoreException("encoding option {} of {} is not supported by chunk stores".format(key, variable.name))
+
+		return options
+
+	def _encoded(self, name, attributes):
+		"""Record the packing parameters and least significant digit found in the attributes of a variable"""
+
+		if 'scale_factor' in attributes or 'add_offset' in attributes:
+			self.packed[name] = (attributes.get('scale_factor', 1.0), attributes.get('add_offset', 0.0))
+
+		if 'least_significant_digit' in attributes:
+			self.digits[name] = attributes['least_significant_digit']
+
+	@property
+	def pool(self):
+		"""The compression pool, created on first use"""
+
+		if self._pool is None:
+			from multiprocessing import Pool
+			self._pool = Pool(self.workers)
+
+		return self._pool
+
+	def define(self, dataset):
+		"""
+		Create the global attributes and the variables of dataset.  Unlimited dimensions are recorded so that
+		they are unlimited again when the store is read.
+		"""
+
+		attributes = OrderedDict([(key, jsonable(value)) for key, value in dataset.attributes.items()])
+		attributes[unlimited_key] = [name for name, dim in dataset.dimensions.items() if dim.isunlimited]
+
+		write_json(os.path.join(self.path, '.zattrs'), attributes)
+
+		for name, variable in dataset._allvariables.items():
+			self.create(variable)
+
+	def create(self, variable):
+		"""
+		Create the directory and metadata of a single variable.  The storage type of string variables depends on
+		the longest string so their metadata is only written with their values, see write_variable.
+		"""
+
+		options = self.options(variable)
+		shape = [int(size) for size in variable.shape]
+
+		directory = os.path.join(self.path, variable.name)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+		attributes = OrderedDict([(key, jsonable(value)) for key, value in variable.attributes.items() if key != '_FillValue'])
+		attributes[dimensions_key] = [dim.name for dim in variable.dimensions]
+
+		if variable.dtype in (object, str):
+			write_json(os.path.join(directory, '.zattrs'), attributes)
+			self.arrays[variable.name] = None
+			return
+
+		dtype = np.dtype(variable.dtype)
+
+		fill = variable.attributes.get('_FillValue')
+		if fill is None and dtype.kind == 'f':
+			fill = variable._fillvalue
+
+		if 'least_significant_digit' in options:
+			attributes['least_significant_digit'] = int(options['least_significant_digit'])
+
+		# Packing into integers replaces the type, fill value and packing attributes
+		packed = options.get('pack')
+		if packed:
+			if packed not in packed_types:
+				raise ChunkStoreException("unsupported packing {} for variable {}".format(packed, variable.name))
+
+			dtype, fill = np.dtype(packed_types[packed][0]), packed_types[packed][1]
+
+			for key in ['valid_min', 'valid_max', 'valid_range', 'missing_value']:
+				attributes.pop(key, None)
+
+			# Without explicit parameters the values are held until close when their range is known
+			if 'scale_factor' in options or 'add_offset' in options:
+				attributes['scale_factor'] = float(options.get('scale_factor', 1.0))
+				attributes['add_offset'] = float(options.get('add_offset', 0.0))
+			else:
+				self.deferred[variable.name] = (np.ma.masked_all(variable.shape, dtype=variable.dtype), packed)
+
+		write_json(os.path.join(directory, '.zattrs'), attributes)
+		self._encoded(variable.name, attributes)
+
+		# Chunk shapes can be given, default to whole maps
+		chunks = options.get('chunks', 'map')
+		if chunks in ['map', 'timeseries']:
+			chunks = chunking.chunk_sizes(shape, dtype.itemsize, access=chunks) if shape else []
+
+		chunks = [int(size) for size in chunks]
+		if len(chunks) != len(shape):
+			raise ChunkStoreException("chunks {} don't match the shape {} of {}".format(chunks, shape, variable.name))
+
+		if options.get('zlib', True):
+			compressor = {'id': 'zlib', 'level': int(options.get('complevel', self.complevel))}
+		else:
+			compressor = None
+
+		self._define(variable.name, shape, chunks, dtype, fill, compressor)
+
+	def _define(self, name, shape, chunks, dtype, fill, compressor):
+		"""Write the .zarray metadata of a variable"""
+
+		array = OrderedDict([
+			('zarr_format', 2),
+			('shape', shape),
+			('chunks', [max(1, size) for size in chunks]),
+			('dtype', dtype.str),
+			('compressor', compressor),
+			('fill_value', fill_json(fill)),
+			('order', 'C'),
+			('filters', None),
+		])
+
+		write_json(os.path.join(self.path, name, '.zarray'), array)
+		self.arrays[name] = array
+
+	def _normalize(self, shape, indices):
+		"""Return indices as a list of (start, stop) ranges, integer indices become ranges of length one"""
+
+		if type(indices) != tuple:
+			indices = (indices,)
+
+		indices = list(indices)
+
+		ellipsis = [i for i in range(len(indices)) if indices[i] is Ellipsis]
+		if ellipsis:
+			i = ellipsis[0]
+			indices[i:i+1] = [slice(None)] * (len(shape) - len(indices) + 1)
+
+		indices.extend([slice(None)] * (len(shape) - len(indices)))
+
+		ranges = []
+		for index, size in zip(indices, shape):
+
+			if isinstance(index, slice):
+				start, stop, step = index.indices(size)
+				if step != 1:
+					raise ChunkStoreException("strided writes are not supported")
+				ranges.append((start, max(start, stop)))
+
+			elif isinstance(index, (int, long, np.integer)):
+				index = int(index) + size if index < 0 else int(index)
+				if not 0 <= index < size:
+					raise ChunkStoreException("index {} out of range for dimension of size {}".format(index, size))
+				ranges.append((index, index + 1))
+
+			else:
+				raise ChunkStoreException("unsupported index {}".format(index))
+
+		return ranges
+
+	def write(self, name, indices, values):
+		"""Write values to indices of variable name"""
+
+		if name in self.deferred:
+			self.deferred[name][0][indices] = values
+			return
+
+		array = self.arrays.get(name)
+		if not array:
+			raise ChunkStoreException("variable {} is not defined in {}".format(name, self.path))
+
+		shape, chunks = array['shape'], array['chunks']
+		dtype = np.dtype(str(array['dtype']))
+		fill = fill_value(array['fill_value'], dtype)
+
+		ranges = self._normalize(shape, indices)
+		count = [stop - start for start, stop in ranges]
+
+		if name in self.digits:
+			values = quantize(values, self.digits[name])
+
+		if name in self.packed:
+			values = pack(values, self.packed[name][0], self.packed[name][1], dtype)
+
+		# Masked values are stored as the fill value
+		if np.ma.isMaskedArray(values) and fill is not None:
+			values = values.filled(fill)
+
+		# Integer indices keep their dimension here so values may need reshaping (or broadcasting)
+		values = np.asarray(values, dtype=dtype)
+		if values.size == np.prod(count):
+			values = values.reshape(count)
+		else:
+			values = np.broadcast_to(values, count)
+
+		# Every chunk touched by the write
+		grid = [range(start // chunk, -(-stop // chunk)) for (start, stop), chunk in zip(ranges, chunks)]
+
+		for position in itertools.product(*grid):
+
+			origin = [p * chunk for p, chunk in zip(position, chunks)]
+
+			# The region of the chunk written and the matching region of values
+			target = tuple([slice(max(start, o) - o, min(stop, o + chunk) - o) for (start, stop), o, chunk in zip(ranges, origin, chunks)])
+			source = tuple([slice(max(start, o) - start, min(stop, o + chunk) - start) for (start, stop), o, chunk in zip(ranges, origin, chunks)])
+
+			# The part of the chunk that lies inside the array
+			valid = tuple([slice(0, min(chunk, size - o)) for o, chunk, size in zip(origin, chunks, shape)])
+			complete = all([t.start == 0 and t.stop == v.stop for t, v in zip(target, valid)])
+
+			key = (name, position)
+
+			if complete and key not in self.partial:
+				data = np.empty(chunks, dtype=dtype)
+				if fill is not None:
+					data.fill(fill)
+				data[target] = values[source]
+				self._submit(name, position, data)
+				continue
+
+			# Partial chunks are assembled in memory until they are complete
+			if key not in self.partial:
+				data = np.empty(chunks, dtype=dtype)
+				if fill is not None:
+					data.fill(fill)
+				written = np.zeros(chunks, dtype=bool)
+				self.partial[key] = (data, written)
+
+			data, written = self.partial[key]
+			data[target] = values[source]
+			written[target] = True
+
+			if written[valid].all():
+				del self.partial[key]
+				self._submit(name, position, data)
+
+	def _submit(self, name, position, data):
+		"""Queue a complete chunk for compression and writing"""
+
+		array = self.arrays[name]
+		level = array['compressor']['level'] if array['compressor'] else 0
+
+		chunk = (os.path.join(self.path, name, chunk_key(position)), np.ascontiguousarray(data).tostring(), level)
+
+		if self.workers <= 1:
+			with instrument.stage('write') as timer:
+				timer.bytes = data.nbytes
+				write_chunk(chunk)
+			return
+
+		instrument.record('write', 0.0, data.nbytes)
+
+		self._pending.append(self.pool.apply_async(write_chunk, (chunk,)))
+
+		# Bound the memory held by queued chunks
+		while len(self._pending) > self.queued * self.workers:
+			self._pending.pop(0).get()
+
+	def write_variable(self, variable):
+		"""Write all the values of variable in blocks along its leading dimension"""
+
+		logger.debug("writing variable {}".format(variable))
+
+		# String variables are written as a single chunk of fixed length unicode
+		if variable.dtype in (object, str):
+			values = np.array(variable[:] if len(variable.shape) else variable[()], dtype=unicode)
+			shape = [int(size) for size in variable.shape]
+			dtype = np.dtype('<U{}'.format(max(1, values.dtype.itemsize // 4)))
+
+			self._define(variable.name, shape, shape, dtype, None, {'id': 'zlib', 'level': self.complevel})
+			self.write(variable.name, Ellipsis, values)
+			return
+
+		# Scalar variables are written in one go
+		if not len(variable.shape):
+			self.write(variable.name, Ellipsis, variable[()])
+			return
+
+		# Blocks follow the chunks of the store so that chunks are written whole
+		chunks = self.arrays[variable.name]['chunks']
+		row = int(np.prod(variable.shape[1:])) * np.dtype(variable.dtype).itemsize
+		size = max(1, self.blocksize // max(row, 1))
+
+		for block in chunking.blocks(0, variable.shape[0], chunks[0], size):
+			self.write(variable.name, block, variable[block])
+
+	def flush(self):
+		"""
+		Write out partially filled chunks, merging with any values already in the store so that separate
+		writers can fill different parts of the same chunk one after another.  The merge is an unlocked read,
+		modify and write of the chunk so writers sharing a chunk must not flush at the same time.
+		"""
+
+		for (name, position), (data, written) in self.partial.items():
+			array = self.arrays[name]
+
+			path = os.path.join(self.path, name, chunk_key(position))
+			existing = read_chunk(path, np.dtype(str(array['dtype'])), array['chunks'], array['compressor'])
+
+			if existing is not None:
+				data = np.where(written, data, existing)
+
+			self._submit(name, position, data)
+
+		self.partial = {}
+
+		while self._pending:
+			self._pending.pop(0).get()
+
+	def close(self):
+
+		# Packed variables held until now get their parameters from their full range
+		for name, (values, packed) in self.deferred.items():
+			scale_factor, add_offset = pack_parameters(values, packed)
+
+			path = os.path.join(self.path, name, '.zattrs')
+			attributes = read_json(path)
+			attributes['scale_factor'], attributes['add_offset'] = scale_factor, add_offset
+			write_json(path, attributes)
+
+			self.packed[name] = (scale_factor, add_offset)
+			del self.deferred[name]
+
+			if not len(values.shape):
+				self.write(name, Ellipsis, values)
+				continue
+
+			row = int(np.prod(values.shape[1:])) * values.dtype.itemsize
+			for block in chunking.blocks(0, values.shape[0], self.arrays[name]['chunks'][0], max(1, self.blocksize // max(row, 1))):
+				self.write(name, block, values[block])
+
+		# String variables that were never written still need their metadata
+		for name, array in self.arrays.items():
+			if array is None:
+				self._define(name, [0], [1], np.dtype('<U1'), None, None)
+
+		self.flush()
+
+		if self._pool is not None:
+			self._pool.close()
+			self._pool.join()
+			self._pool = None
+
+
+def write(dataset, path, encoding=None, workers=1):
+	"""
+	Write a complete dataset to a chunk store at path, see ChunkStoreWriter
+	"""
+
+	with ChunkStoreWriter(path, encoding=encoding, workers=workers) as writer:
+		writer.define(dataset)
+
+		for name, variable in dataset._allvariables.items():
+			writer.write_variable(variable)
+
+
+class ChunkStoreVariable(object):
+	"""
+	Stand in for netCDF4.Variable that reads hyperslabs from the chunks of a store variable
+	"""
+
+	def __init__(self, name, store):
+
+		self.name = name
+		self.store = store
+		self.path = os.path.join(store.path, name)
+
+		array = read_json(os.path.join(self.path, '.zarray'))
+		attributes = read_json(os.path.join(self.path, '.zattrs')) if os.path.exists(os.path.join(self.path, '.zattrs')) else OrderedDict()
+
+		self.shape = tuple(array['shape'])
+		self.chunks = tuple(array['chunks'])
+		self.compressed = array['compressor'] is not None
+		self._storage = np.dtype(str(array['dtype']))
+
+		self.dimensions = tuple(attributes.pop(dimensions_key, ['dim_{}_{}'.format(name, i) for i in range(len(self.shape))]))
+
+		if self._storage.kind == 'U':
+			self.dtype = str
+		else:
+			self.dtype = self._storage
+
+		# The fill value is part of the array metadata rather than the attributes
+		fill = fill_value(array['fill_value'], self._storage) if self._storage.kind != 'U' else None
+		if fill is not None:
+			attributes['_FillValue'] = fill
+
+		self._attributes = attributes
+
+		# Decoded chunks, see set_var_chunk_cache
+		self._cache = OrderedDict()
+		self._cachesize = 16 * 1024 * 1024
+		self._cached = 0
+
+	def ncattrs(self):
+		return list(self._attributes.keys())
+
+	def getncattr(self, key):
+		return self._attributes[key]
+
+	def __getattr__(self, key):
+		try:
+			return self.__dict__['_attributes'][key]
+		except KeyError:
+			raise AttributeError(key)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def chunking(self):
+		return list(self.chunks)
+
+	def set_var_chunk_cache(self, size=None, nelems=None, preemption=None):
+		"""Set the number of bytes of decoded chunks held in memory"""
+
+		if size is not None:
+			self._cachesize = size
+
+	def chunk(self, position):
+		"""Return the decoded chunk at a chunk grid position"""
+
+		if position in self._cache:
+			data = self._cache.pop(position)
+			self._cache[position] = data
+			return data
+
+		data = read_chunk(os.path.join(self.path, chunk_key(position)), self._storage, self.chunks, self.compressed)
+
+		# Chunks that were never written hold the fill value
+		if data is None:
+			data = np.empty(self.chunks, dtype=self._storage)
+			fill = self._attributes.get('_FillValue')
+			data.fill(fill if fill is not None else 0)
+
+		self._cache[position] = data
+		self._cached += data.nbytes
+
+		while self._cached > self._cachesize and len(self._cache) > 1:
+			self._cached -= self._cache.popitem(last=False)[1].nbytes
+
+		return data
+
+	def _normalize(self, indices):
+		"""Return a list of position arrays, one for each dimension, and the axes to remove from the result"""
+
+		if type(indices) != tuple:
+			indices = (indices,)
+
+		indices = list(indices)
+
+		ellipsis = [i for i in range(len(indices)) if indices[i] is Ellipsis]
+		if ellipsis:
+			i = ellipsis[0]
+			indices[i:i+1] = [slice(None)] * (len(self.shape) - len(indices) + 1)
+
+		indices.extend([slice(None)] * (len(self.shape) - len(indices)))
+
+		positions = []
+		squeeze = []
+
+		for axis, (index, size) in enumerate(zip(indices, self.shape)):
+
+			if isinstance(index, slice):
+				positions.append(np.arange(*index.indices(size)))
+
+			elif isinstance(index, (int, long, np.integer)):
+				index = int(index) + size if index < 0 else int(index)
+				if not 0 <= index < size:
+					raise IndexError("index {} out of range for dimension of size {}".format(index, size))
+				positions.append(np.array([index]))
+				squeeze.append(axis)
+
+			else:
+				index = np.asarray(index)
+				if index.dtype == bool:
+					index = index.nonzero()[0]
+				positions.append(np.where(index < 0, index + size, index))
+
+		return positions, squeeze
+
+	def __getitem__(self, indices):
+
+		positions, squeeze = self._normalize(indices)
+
+		result = np.empty([len(p) for p in positions], dtype=self._storage)
+
+		# For each dimension, the chunks touched and which result positions come from each of them
+		groups = []
+		for p, chunk in zip(positions, self.chunks):
+			ids = p // chunk
+			groups.append([(c, np.nonzero(ids == c)[0]) for c in np.unique(ids)])
+
+		for combination in itertools.product(*groups):
+
+			position = tuple([int(c) for c, where in combination])
+			data = self.chunk(position)
+
+			local = [positions[i][where] - c * self.chunks[i] for i, (c, where) in enumerate(combination)]
+			target = [where for c, where in combination]
+
+			if local:
+				result[np.ix_(*target)] = data[np.ix_(*local)]
+			else:
+				result[()] = data[()]
+
+		if squeeze:
+			result = result.reshape([len(p) for i, p in enumerate(positions) if i not in squeeze])
+
+		if self.dtype == str:
+			return result.astype(object)
+
+		return unpack(result, self._attributes, self.dtype)
+
+
+class ChunkStore(object):
+	"""
+	Stand in for netCDF4.Dataset reading a chunked directory store
+	"""
+
+	def __init__(self, path):
+
+		if not isstore(path):
+			raise ChunkStoreException("{} is not a chunk store".format(path))
+
+		self.path = path
+
+		group = read_json(os.path.join(path, '.zgroup'))
+		if group.get('zarr_format') != 2:
+			raise ChunkStoreException("unsupported store format {}".format(group.get('zarr_format')))
+
+		attributes = read_json(os.path.join(path, '.zattrs')) if os.path.exists(os.path.join(path, '.zattrs')) else OrderedDict()
+		unlimited = attributes.pop(unlimited_key, [])
+		self._attributes = attributes
+
+		self.variables = OrderedDict()
+		for name in sorted(os.listdir(path)):
+			if os.path.exists(os.path.join(path, name, '.zarray')):
+				self.variables[name] = ChunkStoreVariable(name, self)
+
+		# Dimensions are implied by the variables that use them
+		self.dimensions = OrderedDict()
+		for variable in self.variables.values():
+			for name, size in zip(variable.dimensions, variable.shape):
+				if name not in self.dimensions:
+					self.dimensions[name] = MultiFileDimension(name, size, name in unlimited)
+
+	def ncattrs(self):
+		return list(self._attributes.keys())
+
+	def getncattr(self, key):
+		return self._attributes[key]
+
+	def close(self):
+		for variable in self.variables.values():
+			variable._cache = OrderedDict()
+			variable._cached = 0
+
+	def __repr__(self):
+		return "<{}: {} variables in {}>".format(self.__class__.__name__, len(self.variables), self.path)
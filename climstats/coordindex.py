@@ -0,0 +1,151 @@
+"""
+Coordinate indices map coordinate values (numbers, datetimes or date strings) onto array indices.  An index is
+built once per coordinate variable and then answers nearest value and range queries without rescanning the
+coordinate values.
+"""
+
+import re
+import datetime
+
+import numpy as np
+import netCDF4
+
+
+# Seconds per unit for the CF time units we can offset directly
+unit_seconds = {
+	'second': 1.0, 'seconds': 1.0, 'sec': 1.0, 'secs': 1.0, 's': 1.0,
+	'minute': 60.0, 'minutes': 60.0, 'min': 60.0, 'mins': 60.0,
+	'hour': 3600.0, 'hours': 3600.0, 'hr': 3600.0, 'hrs': 3600.0, 'h': 3600.0,
+	'day': 86400.0, 'days': 86400.0, 'd': 86400.0,
+}
+
+# ISO like date strings: YYYY-MM-DD[ HH[:MM[:SS]]]
+isodate = re.compile(r'^\s*(-?\d{1,4})-(\d{1,2})(?:-(\d{1,2}))?(?:[ T](\d{1,2})(?::(\d{1,2})(?::(\d{1,2}(?:\.\d*)?))?)?)?\s*Z?\s*$')
+
+
+def datestring_to_num(value, units, calendar='standard'):
+	"""
+	Convert a date string straight to a numeric time value in the given CF units and calendar.  ISO style
+	dates are converted without constructing a datetime for the actual day so that dates that are only valid
+	in some calendars (eg. 2000-02-30 in a 360_day calendar) work.  Anything else is passed to dateutil.
+	"""
+
+	match = isodate.match(value)
+	step = units.split()[0].lower()
+
+	if match and step in unit_seconds:
+
+		year, month, day, hour, minute, second = match.groups()
+		day = int(day) if day else 1
+		hour = int(hour) if hour else 0
+		minute = int(minute) if minute else 0
+		second = float(second) if second else 0.0
+
+		# Month start is valid in every calendar, the rest is a plain offset
+		base = netCDF4.date2num(datetime.datetime(int(year), int(month), 1), units, calendar=calendar)
+		offset = (day - 1) * 86400.0 + hour * 3600.0 + minute * 60.0 + second
+
+		return base + offset / unit_seconds[step]
+
+	from dateutil import parser
+	return netCDF4.date2num(parser.parse(value), units, calendar=calendar)
+
+
+class CoordinateIndex(object):
+	"""
+	A CoordinateIndex holds the values of a one dimensional coordinate variable and answers nearest value
+	and range queries.  Monotonic (increasing or decreasing) coordinates are searched with np.searchsorted,
+	anything else falls back to a full scan.  Indices are always absolute indices into the values the index
+	was built from.
+	"""
+
+	def __init__(self, values, units=None, calendar='standard'):
+		"""
+		values: one dimensional array of coordinate values
+		units: CF units string, used to convert dates and date strings
+		calendar: CF calendar name, used to convert dates and date strings
+		"""
+
+		self.values = np.asarray(np.ma.getdata(values)).ravel()
+		self.units = units
+		self.calendar = calendar if calendar else 'standard'
+
+		# Detect monotonic coordinates, order is 1 for increasing, -1 for decreasing and 0 otherwise
+		diffs = np.diff(self.values)
+		if (diffs >= 0).all():
+			self.order = 1
+			self._sorted = self.values
+		elif (diffs <= 0).all():
+			self.order = -1
+			self._sorted = self.values[::-1]
+		else:
+			self.order = 0
+			self._sorted = None
+
+	def __len__(self):
+		return len(self.values)
+
+	@property
+	def ismonotonic(self):
+		"""Return True if the coordinate values are monotonic"""
+		return self.order != 0
+
+	def parse(self, value):
+		"""
+		Convert a query value to the coordinate's numeric space.  Date strings and datetimes are converted
+		using the coordinate units and calendar, anything else must be numeric.
+		"""
+
+		if isinstance(value, basestring):
+			if not self.units:
+				raise ValueError("cannot convert {} without coordinate units".format(repr(value)))
+			return datestring_to_num(value, self.units, self.calendar)
+
+		if hasattr(value, 'year') and hasattr(value, 'month'):
+			return netCDF4.date2num(value, self.units, calendar=self.calendar)
+
+		return float(value)
+
+	def nearest(self, value):
+		"""Return the index of the coordinate value nearest to value"""
+
+		value = self.parse(value)
+		size = len(self.values)
+
+		if not size:
+			raise IndexError("cannot search an empty coordinate")
+
+		if not self.order:
+			return int(np.argmin(np.abs(self.values - value)))
+
+		# Binary search and then pick the closer of the two neighbours
+		i = int(np.searchsorted(self._sorted, value))
+		i = min(max(i, 1), size - 1) if size > 1 else 0
+
+		if i > 0:
+			before, after = value - self._sorted[i-1], self._sorted[i] - value
+
+			# Ties resolve to the lowest original index as a full argmin scan would
+			if before < after or (before == after and self.order > 0):
+				i -= 1
+
+		if self.order < 0:
+			i = size - 1 - i
+
+		return i
+
+	def range(self, start, stop=None):
+		"""
+		Return the (first, last) indices of the coordinate values nearest to start and stop.  The indices are
+		always returned in increasing order.
+		"""
+
+		if stop is None:
+			stop = start
+
+		first, last = self.nearest(start), self.nearest(stop)
+
+		if last < first:
+			first, last = last, first
+
+		return first, last
@@ -1,18 +1,31 @@
 import numpy as np
-import cfunits
 import copy
 import sys
-from dateutil import parser
-import datetime
+import contextlib
+from collections import OrderedDict
+import time
+import threading
 
 import netCDF4
 import grouping
+import coordindex
+import multifile
+import packing
+from prefetch import Prefetcher
+import chunking
+import chunkstore
+import scratch
+import spatial
+import instrument
 
 import logging
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# The NetCDF/HDF5 library isn't thread safe, every read and write of a file goes through this lock so that a
+# Prefetcher reading on its background thread never overlaps with writes (or coordinate reads) on the main one
+netcdf_lock = threading.RLock()
+
 class DatasetException(Exception):
 	"""
 	General, very simple Dataset exception class
@@ -45,7 +58,7 @@ class GroupBy(object):
 		self.variable = variable
 		self.coordinate = coordinate
 
-	def apply(self, func, name=None, outunits=None, tolerance=0.0, scale=1.0, offset=0.0, **params):
+	def apply(self, func, name=None, outunits=None, tolerance=0.0, scale=1.0, offset=0.0, prefetch=0, prefetch_memory=None, writer=None, scratch=None, **params):
 		"""
 		Apply a function to a list of groups and return a new in memory Dataset instance
 		func: The function to call, must be a callable and take an numpy array or equivalent as its first argument
@@ -53,28 +66,171 @@ class GroupBy(object):
 		tolerance: The fraction of masked source values (along the axis) tolerated before masking the result
 		scale: Scale factor to apply to source values
 		offset: Offset to apply to source values
+		prefetch: Number of groups to read ahead on a background thread while the function runs
+		prefetch_memory: Soft limit on the bytes of groups read ahead, one group more can be held
+		writer: Optional NetCDF4Writer, results are then written out as each group is done rather than held in
+		the returned dataset which only describes the structure of the result
+		scratch: Optional scratch directory, the result variable is then held in memory mapped files there
 		"""
 
-		logger.debug("{}.apply({}, {}, {}, {}, {}".format(self.__class__.__name__, func.__name__, name, tolerance, scale, offset, params))
+		task = {'func': func, 'name': name, 'outunits': outunits, 'tolerance': tolerance, 'scale': scale, 'offset': offset,
+			'writer': writer, 'scratch': scratch, 'params': params}
+
+		return self.applymany([task], prefetch=prefetch, prefetch_memory=prefetch_memory)[0]
+
+	def applymany(self, tasks, prefetch=0, prefetch_memory=None, failed=None):
+		"""
+		Apply several functions to the groups reading each group only once.  tasks is a list of dictionaries
+		with the func, name, outunits, tolerance, scale, offset, writer, scratch and params (a dictionary of
+		extra function parameters) arguments of apply, only func is required.  Returns a list of result
+		datasets in the order of tasks.
+
+		If failed is a dictionary then an exception raised by a task's function doesn't stop the others, the
+		task is dropped, its exc_info stored in failed under the task's index and its result is None.
+		Otherwise the exception is raised.
+		"""
+
+		debug = logger.isEnabledFor(logging.DEBUG)
 
 		# Identify the axis index of the coordinate variable (would this work with a 2D coordinate variable? 
 		# We currently can't group on > 1D coordinate variables
 		axis = self.variable.dimensions.index(self.coordinate.dimensions[0])
 		logger.debug("axis = {}".format(axis))
 
-		# Create dimensions for the resultant dataset and construct matching slices
-		dims = []
-		slices = []
-		for i in range(0, len(self.variable.dimensions)):
+		tasks = self._prepare(tasks)
+		active = list(enumerate(tasks))
+
+		# Plan the reads, large variables may need to be read in tiles to make good use of storage chunks
+		groups = list(self.groups.values())
+		tiles = self.variable.plan(groups, axis)
+
+		keys = []
+		for tile in tiles:
+			for index, indices in enumerate(groups):
+				keys.append((tile, index, indices))
+
+		def read(key):
+			"""Read the source data for one group (within one tile)"""
+			tile, index, indices = key
+			source_slices = list(tile)
+			source_slices[axis] = indices        # source slice comes from indices for this group
+			if debug:
+				logger.debug("source[{}]".format(tuple(source_slices)))
+			return self.variable[tuple(source_slices)]
+
+		# Now we loop through the groups, reading ahead if requested
+		for (tile, index, indices), data in Prefetcher(read, keys, depth=prefetch, memory=prefetch_memory):
+			
+			# Set the target slices
+			target_slices = list(tile)
+			target_slices[axis] = index 		 # target slice is just the group index
+
+			self._apply_group(active, data, axis, tuple(target_slices), index, self.coordinate[indices][-1], failed)
+
+		return self._results(tasks, failed)
+
+	def _prepare(self, tasks):
+		"""Fill in the task defaults and create the result dataset of each task, see applymany"""
+
+		debug = logger.isEnabledFor(logging.DEBUG)
+
+		tasks = [dict(task) for task in tasks]
+		for task in tasks:
+			for key, default in [('name', None), ('outunits', None), ('tolerance', 0.0), ('scale', 1.0), ('offset', 0.0), ('writer', None), ('scratch', None), ('params', {})]:
+				if task.get(key) is None:
+					task[key] = default
+
+			if debug:
+				logger.debug("{}.apply({}, {}, {}, {}, {}, {})".format(self.__class__.__name__, task['func'].__name__, task['name'], task['tolerance'], task['scale'], task['offset'], task['params']))
+
+			task['dataset'], task['result'], task['newcoord'] = self._create(task['func'], task['name'], task['outunits'], task['writer'], task['scratch'])
+
+		return tasks
+
+	def _apply_group(self, active, data, axis, target, index, coordvalue, failed):
+		"""
+		Apply the active tasks to the data of one group and store (or stream) the results at target.  index is
+		the group index and coordvalue the value of the grouped coordinate for the group.  Tasks that fail are
+		removed from active, see applymany.
+		"""
+
+		# Tasks with the same scale and offset share the scaled source data and the mask
+		sources = {}
+		count = None
+
+		for number, task in list(active):
+
+			try:
+				# Apply scale and offset to the source data
+				key = (task['scale'], task['offset'])
+				if key not in sources:
+					sources[key] = data * task['scale'] + task['offset']
+				source = sources[key]
+
+				# Call the function on the source data
+				with instrument.stage('statistic') as timer:
+					timer.bytes = source.nbytes
+					unmasked = task['func'](source, axis=axis, **task['params'])
+
+				# Calculate a mask based on the missing value tolerance
+				if count is None:
+					count = np.ma.count(data, axis=axis)/float(source.shape[axis])
+				mask = count < task['tolerance']
+
+				# Construct a masked array version of the result and assign to the result variable instance (or stream it out)
+				if task['writer']:
+					task['writer'].write(task['result'].name, target, np.ma.masked_array(unmasked, mask=mask))
+				else:
+					task['result'][target] = np.ma.masked_array(unmasked, mask=mask)
+
+				# Get coordinate variable values for this group
+				task['newcoord'][(index,)] = coordvalue
+
+			except Exception:
+				if failed is None:
+					raise
+
+				logger.error("{} failed: {}".format(task['result'].name, sys.exc_info()[1]))
+				failed[number] = sys.exc_info()
+				active.remove((number, task))
+
+	def _results(self, tasks, failed):
+		"""Finish the tasks and return their result datasets (None for failed tasks), see applymany"""
+
+		results = []
+		for number, task in enumerate(tasks):
 
-			dim = self.variable.dimensions[i]
-			slices.append(slice(0, dim.size))
+			if failed is not None and number in failed:
+				results.append(None)
+				continue
 
-			# The axis dimension size is the number of groups, others are original size
+			# The grouped coordinate is small so it is written in one go
+			if task['writer']:
+				task['writer'].write_variable(task['newcoord'])
+
+			results.append(task['dataset'])
+
+		# Return the new Datasets
+		return results
+
+	def _create(self, func, name, outunits, writer, scratch):
+		"""
+		Create the in memory dataset for the result of applying func to the groups, returns the dataset, the
+		result variable and the grouped coordinate variable.  When streaming to writer the output is defined
+		and everything but the results written.
+		"""
+
+		axis = self.variable.dimensions.index(self.coordinate.dimensions[0])
+
+		# Create dimensions for the resultant dataset
+		dims = []
+		for i, dim in enumerate(self.variable.dimensions):
+
+			# The axis dimension size is the number of groups, others are the (possibly subset) variable's size
 			if i == axis:
 				dims.append((dim.name, len(self.groups), dim.isunlimited))
 			else:
-				dims.append((dim.name, dim.size, dim.isunlimited))
+				dims.append((dim.name, self.variable.shape[i], dim.isunlimited))
 
 		# Create an in memory dataset and copy source dataset global attributes
 		ds = Dataset(dimensions=dims)
@@ -85,80 +241,206 @@ class GroupBy(object):
 		if not name:
 			name = "{}_{}".format(self.variable.name, func.__name__)
 
-		# Make the results variable and copy source variable attributes
-		result = Variable(name, ds, [dim.name for dim in self.variable.dimensions], dtype=self.variable.dtype, attributes=self.variable.attributes)
-		result.attributes = copy.copy(self.variable.attributes)
-		
-		# If we are overriding the units then set the units attribute
-		if outunits:
-			result.attributes['units'] = outunits
+		# Create all the variables in one batch so that coordinates are only classified once
+		with ds.batch():
 
-		logger.debug("Created {}".format(result))
+			# Make the results variable and copy source variable attributes
+			result = Variable(name, ds, [dim.name for dim in self.variable.dimensions], dtype=self.variable.dtype, attributes=self.variable.attributes, scratch=scratch)
+			result.attributes = copy.copy(self.variable.attributes)
+			
+			# If we are overriding the units then set the units attribute
+			if outunits:
+				result.attributes['units'] = outunits
 
-		# Make the new coordinate variable
-		newcoord = Variable(self.coordinate.name, ds, [self.coordinate.dimensions[0].name], dtype=self.coordinate.dtype)
-		newcoord.attributes = copy.copy(self.coordinate.attributes)
-		logger.debug("Created {}".format(newcoord))
+			logger.debug("Created {}".format(result))
 
-		# Initialize the source and target slices
-		source_slices = copy.copy(slices)
-		target_slices = copy.copy(slices)
+			# Make the new coordinate variable
+			newcoord = Variable(self.coordinate.name, ds, [self.coordinate.dimensions[0].name], dtype=self.coordinate.dtype)
+			newcoord.attributes = copy.copy(self.coordinate.attributes)
+			logger.debug("Created {}".format(newcoord))
 
-		# Now we loop through the groups 
-		index = 0
-		for group, indices in self.groups.items():
-			
-			# Set the source and target slices
-			source_slices[axis] = indices        # source slice comes from indices for this group
-			target_slices[axis] = index 		 # target slice is just the looping index
+			# Create the other coordinate variables
+			for coordname, variable in self.variable.coords.items():
 
-			logger.debug("source[{}]".format(tuple(source_slices)))
-			
-			# Get source data, applying scale and offset
-			source = self.variable[tuple(source_slices)] * scale + offset
+				# We don't re-create the grouping coordinate variable
+				if variable != self.coordinate:
+					newvar = Variable(variable.name, ds, [dim.name for dim in variable.dimensions], dtype=variable.dtype)
+					newvar.attributes = copy.copy(variable.attributes)
+					newvar[:] = variable[:]
 
-			# Call the function on the source data
-			unmasked = func(source, axis=axis, **params)
+			# Create the ancilary variables
+			for ancilname, variable in self.variable.dataset.ancil.items():
 
-			# Calculate a mask based on the missing value tolerance
-			mask = np.ma.count(self.variable[tuple(source_slices)], axis=axis)/float(source.shape[axis]) < tolerance
+				# Coordinate variables have already been created (subset to match the variable)
+				if ancilname in ds._allvariables:
+					continue
 
-			# Construct a masked array version of the result and assign to the result variable instance
-			result[tuple(target_slices)] = np.ma.masked_array(unmasked, mask=mask)
+				try:
+					newvar = Variable(ancilname, ds, [dim.name for dim in variable.dimensions], dtype=variable.dtype)
+					newvar[:] = variable[:]
+					newvar.attributes = copy.copy(variable.attributes)
+				
+				# This might fail if the ancil variable uses dimensions not defined through the source variable... ignore these
+				except:
+					print("WARNING: Error creating ancil variable {}".format(ancilname))
+					print(sys.exc_info()[0])
 
-			# Get coordinate variable values for this group
-			newcoord[(target_slices[axis],)] = self.coordinate[tuple(source_slices)[axis]][-1]
+		# When streaming, create the output file and write everything but the results up front
+		if writer:
+			writer.define(ds)
+			for variable in ds._allvariables.values():
+				if variable is not result and variable is not newcoord:
+					writer.write_variable(variable)
 
-			# Loop to next group
-			index += 1
+		return ds, result, newcoord
 
-		# Create the other coordinate variables
-		for name, variable in self.variable.coords.items():
 
-			# We don't re-create the grouping coordinate variable
-			if variable != self.coordinate:
-				newvar = Variable(variable.name, ds, [dim.name for dim in variable.dimensions], dtype=variable.dtype)
-				newvar.attributes = copy.copy(variable.attributes)
-				newvar[:] = variable[:]
-		
-		# Construct the coordinate variables dictionary
-		ds.make_coords()
+class RaggedGroupBy(GroupBy):
+	"""
+	Grouping of a variable stored as a CF contiguous ragged array, where the values of all the stations
+	(features) lie one after the other along a sample dimension and a row_size variable holds the number of
+	values of each station.  The grouping function is run on the values of the grouped coordinate (the full
+	regular axis they lie on if there is one) and each station's run of values is grouped where it lies, so the
+	source is never expanded to the dense (time, station) grid.  The results have the same (groups, stations) layout as for orthogonal station data.
+	"""
 
-		# Create the ancilary variables
-		for name, variable in self.variable.dataset.ancil.items():
-			try:
-				newvar = Variable(name, ds, [dim.name for dim in variable.dimensions], dtype=variable.dtype)
-				newvar[:] = variable[:]
+	# Bytes of source values read at a time, always in runs of whole stations
+	blocksize = 64 * 1024 * 1024
+
+	def __init__(self, name, variable, coordinate, func, rowsize):
+		"""
+		name, variable, coordinate: as for GroupBy
+		func: the grouping function
+		rowsize: the row_size variable of the sample dimension of coordinate
+		"""
+
+		self.rowsize = rowsize
+		self.instance = rowsize.dimensions[0]
+
+		# The distinct coordinate values, and the row of each sample in them
+		self.values, self.rows = np.unique(np.ma.getdata(coordinate[:]), return_inverse=True)
+
+		# Samples on a regular axis are placed on its full extent, as the dense layout would have them, so that
+		# steps missing from every station still count towards the group lengths used for the tolerance
+		if len(self.values) > 1:
+			step = np.diff(self.values).min()
+			steps = np.round((self.values - self.values[0]) / float(step)).astype(np.int64)
+
+			if np.allclose(self.values[0] + steps * step, self.values):
+				self.rows = steps[self.rows]
+				self.values = self.values[0] + np.arange(steps[-1] + 1) * step
+
+		# The grouping function only sees the distinct values
+		distinct = Dataset(dimensions=[(coordinate.name, len(self.values), False)])
+		values = Variable(coordinate.name, distinct, [coordinate.name], dtype=coordinate.dtype)
+		values[:] = self.values
+		values.units = coordinate.units
+		values.calendar = coordinate.calendar
+
+		super(RaggedGroupBy, self).__init__(name, variable, coordinate, func(values))
+
+	def applymany(self, tasks, prefetch=0, prefetch_memory=None, failed=None):
+		"""
+		As GroupBy.applymany.  The source is read in blocks of whole stations of about blocksize bytes, and
+		within each block the values of each group are gathered into a (group length, stations) array so the
+		functions work along axis 0 just as they do for orthogonal data.
+		"""
+
+		tasks = self._prepare(tasks)
+		active = list(enumerate(tasks))
+
+		groups = [np.asarray(indices, dtype=np.int64) for indices in self.groups.values()]
+
+		# The group of each distinct coordinate value and its position in the group
+		group_of = np.empty(len(self.values), dtype=np.int64)
+		group_of[:] = -1
+		position = np.zeros(len(self.values), dtype=np.int64)
+		for index, indices in enumerate(groups):
+			group_of[indices] = index
+			position[indices] = np.arange(len(indices))
+
+		# Offsets of the stations along the sample dimension
+		rowsize = np.ma.filled(self.rowsize[:], 0).astype(np.int64)
+		offsets = np.concatenate([[0], np.cumsum(rowsize)])
+
+		# Blocks of whole stations, at least one station each
+		samples = max(1, self.blocksize // np.dtype(self.variable.dtype).itemsize)
+		keys = []
+		first = 0
+		while first < len(rowsize):
+			last = min(max(int(np.searchsorted(offsets, offsets[first] + samples, side='right')) - 1, first + 1), len(rowsize))
+			keys.append((first, last))
+			first = last
+
+		def read(key):
+			"""Read the values of a block of stations"""
+			first, last = key
+			return self.variable[slice(int(offsets[first]), int(offsets[last]))]
+
+		for (first, last), data in Prefetcher(read, keys, depth=prefetch, memory=prefetch_memory):
+
+			data = np.ma.asarray(data)
+			rows = self.rows[offsets[first]:offsets[last]]
+			stations = np.repeat(np.arange(last - first), rowsize[first:last])
+
+			# Samples sorted by group
+			sampled = group_of[rows]
+			order = np.argsort(sampled, kind='mergesort')
+			bounds = np.searchsorted(sampled[order], np.arange(len(groups) + 1))
+
+			for index, indices in enumerate(groups):
+
+				members = order[bounds[index]:bounds[index+1]]
+
+				block = np.ma.masked_all((len(indices), last - first), dtype=data.dtype)
+				block[position[rows[members]], stations[members]] = data[members]
+
+				self._apply_group(active, block, 0, (index, slice(first, last)), index, self.values[indices][-1], failed)
+
+		return self._results(tasks, failed)
+
+	def _create(self, func, name, outunits, writer, scratch):
+		"""
+		As GroupBy._create but the result has the grouped coordinate and the station dimension, and the
+		station coordinates and ancillary variables are copied
+		"""
+
+		dims = [(self.coordinate.name, len(self.groups), False), (self.instance.name, self.instance.size, self.instance.isunlimited)]
+
+		ds = Dataset(dimensions=dims)
+		ds.attributes = copy.copy(self.variable.dataset.attributes)
+
+		if not name:
+			name = "{}_{}".format(self.variable.name, func.__name__)
+
+		with ds.batch():
+
+			result = Variable(name, ds, [self.coordinate.name, self.instance.name], dtype=self.variable.dtype, attributes=self.variable.attributes, scratch=scratch)
+			result.attributes = copy.copy(self.variable.attributes)
+
+			if outunits:
+				result.attributes['units'] = outunits
+
+			newcoord = Variable(self.coordinate.name, ds, [self.coordinate.name], dtype=self.coordinate.dtype)
+			newcoord.attributes = copy.copy(self.coordinate.attributes)
+
+			# Station variables, but not the row sizes which only describe the source layout
+			for varname, variable in self.variable.dataset._allvariables.items():
+
+				if variable is self.rowsize or varname in ds._allvariables or [dim.name for dim in variable.dimensions] != [self.instance.name]:
+					continue
+
+				newvar = Variable(varname, ds, [self.instance.name], dtype=variable.dtype)
 				newvar.attributes = copy.copy(variable.attributes)
-			
-			# This might fail if the ancil variable uses dimensions not defined through the source variable... ignore these
-			except:
-				print("WARNING: Error creating ancil variable {}".format(name))
-				print(sys.exc_info()[0])
+				newvar[:] = variable[:]
 
-		# Return the new Dataset
-		return ds
+		if writer:
+			writer.define(ds)
+			for variable in ds._allvariables.values():
+				if variable is not result and variable is not newcoord:
+					writer.write_variable(variable)
 
+		return ds, result, newcoord
 
 
 class Dimension(object):
@@ -224,6 +506,7 @@ class BaseVariable(object):
 		self.attributes = {}
 		self.coords = {}
 		self.iscoordinate = False
+		self._index = None
 
 		# Load dimensions
 		for dim in dimensions:
@@ -254,10 +537,10 @@ class BaseVariable(object):
 	def dtype(self):
 	    return self._dtype
 
-	def __getitem__(self, indices):
+	def _merge_indices(self, indices):
 		"""
-		returns a numpy array resulting from merging the current subset slices with the provided
-		indices.  
+		returns a tuple of indices resulting from merging the current subset slices with the provided
+		indices.
 		"""
 
 		# We need to construct new indices by merging the provided indices with the current subset
@@ -278,15 +561,24 @@ class BaseVariable(object):
 			elif type(indices[i]) == np.ndarray:
 				newindices[i] = indices[i] + self._subset[i].start
 
-			# For single integer indices add the subset start offset
+			# For single integer indices add the subset start offset, negative indices count from the end
 			elif type(indices[i]) == int:
-				newindices[i] = indices[i] + self._subset[i].start
+				index = indices[i] + self.shape[i] if indices[i] < 0 else indices[i]
+				newindices[i] = index + self._subset[i].start
 
 			# For slice indices we need to do more...
 			elif type(indices[i]) == slice:
 				start = indices[i].start
 				stop = indices[i].stop
 
+				# Storage may be larger than the variable so negative positions are made explicit
+				if start is not None and start < 0:
+					start = max(start + self.shape[i], 0)
+					if not start:
+						start = None
+				if stop is not None and stop < 0:
+					stop = max(stop + self.shape[i], 0)
+
 				# Start and stop might be None, in which case use use the subset start and stop
 				# otherwise we offset the start and stop using the subset start
 				if not start:
@@ -299,20 +591,38 @@ class BaseVariable(object):
 				else:
 					stop += self._subset[i].start
 
-				newindices[i] = (slice(start, stop))
+				newindices[i] = (slice(start, stop, indices[i].step))
 	
 
+		return tuple(newindices)
+
+	def __getitem__(self, indices):
+		"""
+		returns a numpy array resulting from merging the current subset slices with the provided
+		indices.  
+		"""
+
 		# Just return the data subset using the new merged indices
-		newindices = tuple(newindices)
-		#print "in __getitem__ ", newindices
-	
-		return self._data[newindices]
+		return self._data[self._merge_indices(indices)]
+
+	def _alldata(self):
+		"""Return all the underlying values ignoring any subset"""
+		return self._data[:]
 
 
 	def copy(self):
 		"""Should return a copy of the dataset but behavior is not yet clear so don't use this!"""
 		return copy.copy(self)
 
+	def _set_shape(self, newshape):
+		"""Set the shape of the variable, a subset that covered the whole variable keeps covering it"""
+
+		whole = tuple([slice(0, stop) for stop in self.shape])
+
+		self._shape = tuple(newshape)
+		if self._subset == whole:
+			self._subset = tuple([slice(0, stop) for stop in self._shape])
+
 	def resize(self, newshape, fill=None):
 		"""
 		Real implementations should implement this correctly given a particular storage model.  Resizing is
@@ -326,8 +636,25 @@ class BaseVariable(object):
 		the unlimited dimension(s)
 		"""
 
+		indices, newshape = self._setitem_indices(indices)
+
+		# Any coordinate index is now out of date
+		self._index = None
+		
+		# See if the shape has changed
+		if newshape != self.shape:
+			self._grow(newshape)
+
+		self._data[indices] = value
+
+	def _setitem_indices(self, indices):
+		"""
+		Return the indices of an assignment as a tuple with negative positions resolved against the current
+		shape, and the shape the variable needs to be for the assignment to fit
+		"""
+
 		# force indices to be a tuple
-		if type(indices) == slice or type(indices) == int:
+		if type(indices) != tuple:
 			indices = (indices,)
 
 		# Now make it a list
@@ -337,48 +664,79 @@ class BaseVariable(object):
 		newshape = list(self.shape)
 		for i in range(0, len(indices)):
 
-			if type(indices[i]) == slice:
-				start, stop = indices[i].start, indices[i].stop
-			elif type(indices[i]) == int:
-				start, stop = indices[i], indices[i]+1
+			if indices[i] is Ellipsis:
+				break
 
-			# replace Nones
-			if not start:
-				start = 0
-			if not stop:
-				stop = self.shape[i]
-
-			indices[i] = slice(start, stop)
+			if type(indices[i]) == slice:
+				start, stop, step = indices[i].start, indices[i].stop, indices[i].step
+
+				# replace Nones and resolve negative positions
+				if start is None:
+					start = 0
+				elif start < 0:
+					start += self.shape[i]
+				if stop is None:
+					stop = self.shape[i]
+				elif stop < 0:
+					stop += self.shape[i]
+
+				indices[i] = slice(start, stop, step)
+				last = stop
+
+			elif isinstance(indices[i], (int, long, np.integer)):
+				index = int(indices[i])
+				if index < 0:
+					index += self.shape[i]
+
+				indices[i] = slice(index, index+1)
+				last = index + 1
+
+			# Lists and arrays of positions
+			else:
+				positions = np.asarray(indices[i])
+				if positions.dtype == bool:
+					last = len(positions)
+				else:
+					positions = np.where(positions < 0, positions + self.shape[i], positions)
+					last = int(positions.max()) + 1 if positions.size else 0
+				indices[i] = positions
 
-			if indices[i].stop > self.shape[i]:
+			if last > self.shape[i]:
 
 				if self._dimensions[i].isunlimited:
-					newshape[i] = indices[i].stop
+					newshape[i] = last
 				else:
 					raise IndexError('index {} out of bounds for variable with shape {}'.format(indices[i], self.shape))
 
-		newshape = tuple(newshape)
-		
-		# See if the shape has changed
-		if newshape != self.shape:
+		return tuple(indices), tuple(newshape)
+
+	def _grow(self, newshape):
+		"""
+		Resize to newshape along with the coordinate variables that share the grown dimensions, and record the
+		new size of the dimensions
+		"""
 
-			self.resize(tuple(newshape))
+		oldshape = self.shape
+		self.resize(newshape)
 
-			# Resize associated coordinate variables
-			coord_indices = []
-			for coord, variable in self.coords.items():
-				for dim in variable.dimensions:
-					try:
-						coord_indices.append(variable.dimensions.index(dim))
-					except:
-						continue
+		for i, dim in enumerate(self._dimensions):
+			if newshape[i] > dim._size:
+				dim._size = newshape[i]
 
-				newshape = tuple([newshape[i] for i in coord_indices])
-				
-				if len(newshape):
-					variable.resize(newshape)
+		# Resize associated coordinate variables
+		for coord, variable in self.coords.items():
+			if variable is self:
+				continue
 
-		self._data[indices] = value
+			coordshape = list(variable.shape)
+			for j, dim in enumerate(variable.dimensions):
+				if dim in self._dimensions:
+					i = self._dimensions.index(dim)
+					if newshape[i] != oldshape[i] and newshape[i] > coordshape[j]:
+						coordshape[j] = newshape[i]
+
+			if tuple(coordshape) != variable.shape:
+				variable.resize(tuple(coordshape))
 
 	def makecoords(self):
 
@@ -449,6 +807,7 @@ class BaseVariable(object):
 		"""
 
 		newvar = self.copy()
+		newvar.coords = dict(newvar.coords)
 		newsubset = list(newvar._subset)
 
 
@@ -504,58 +863,163 @@ class BaseVariable(object):
 		return newvar
 
 
-	def subset(self, **kwargs):
+	@property
+	def index(self):
+		"""
+		Return the CoordinateIndex for this (one dimensional) variable.  The index is built once from the full
+		underlying values so it is shared by subset copies and only rebuilt when the values change.
+		"""
+
+		if self._index is None:
+
+			if len(self._data.shape) != 1:
+				raise NotImplementedError("multi dimensional coordinate indexing not yet implemented")
 
-		newargs = {}
+			self._index = coordindex.CoordinateIndex(self._alldata(), units=self.attributes.get('units'), calendar=self.attributes.get('calendar', 'standard'))
+
+		return self._index
+
+	def indices(self, **kwargs):
+		"""
+		Map coordinate values to index slices for any number of coordinates at once.  Each keyword is a
+		coordinate name and each value is either a single value or a (start, stop) tuple of values.  Values
+		can be numbers, datetimes or date strings.  Returns a dictionary of slices relative to the current subset.
+		"""
+
+		result = {}
 
 		for name, value in kwargs.items():
 			if name in self.coords:
 
 				coord = self.coords[name]
-				#print "subset ", name, " using ", coord[:], coord._subset, value
+
+				# For now we can't do multi dimensional coordinate variables
+				if len(coord.shape) > 1:
+					raise NotImplementedError("multi dimensional coordinate subsetting not yet implemented")
 
 				if type(value) == tuple:
 					start, stop = value
 				else:
 					start = stop = value
 
-				# try and coerce into datetimes
-				try:
-					start = netCDF4.date2num(parser.parse(start), coord.attributes['units'])
-				except:
-					pass
+				# The index works on absolute indices so shift into the coordinate subset and clip
+				first, last = coord.index.range(start, stop)
+				offset = coord._subset[0].start
+				first = min(max(first - offset, 0), coord.shape[0] - 1)
+				last = min(max(last - offset, 0), coord.shape[0] - 1)
 
-				try:
-					stop = netCDF4.date2num(parser.parse(stop), coord.attributes['units'])
-				except:
-					pass
+				result[name] = slice(first, last+1)
 
-				print "subset start, stop ", start, stop
+		return result
 
-				# Get the actual coordinate values
-				coord_vals = coord[:]
+	def subset(self, **kwargs):
+		"""
+		Subset using coordinate values rather than indices, see indices for the accepted values
+		"""
 
-				# If we have dates then we try and convert coordinate values to dates:
-				if type(start) == datetime.datetime:
-					try:
-						coord_vals = netCDF4.num2date(coord_vals, units=coord.units, calendar=coord.calendar)
-					except:
-						pass
+		return self.isubset_copy(**self.indices(**kwargs))
 
-				start_index = np.argmin(np.abs(coord_vals - start))
-				stop_index = np.argmin(np.abs(coord_vals - stop))
 
-				# We might need to swap around
-				if stop_index < start_index:
-					tmp = stop_index
-					stop_index = start_index
-					start_index = tmp
+	def plan(self, groups, axis):
+		"""
+		Plan reading groups (index lists or slices along axis).  Returns a list of tiles, each a list of slices
+		for the other dimensions (None for axis).  In memory variables are read in one tile.
+		"""
 
-				newargs[name] = slice(start_index, stop_index+1)
+		return [[None if i == axis else slice(0, size) for i, size in enumerate(self.shape)]]
 
-#		print 'newargs = ', newargs
-		return self.isubset_copy(**newargs)
+	def blocks(self, axis, budget):
+		"""
+		Return slices along axis for streaming through the variable in blocks of about budget bytes
+		"""
+
+		itemsize = 8 if self.dtype in (str, object) else np.dtype(self.dtype).itemsize
+		other = int(np.prod([size for i, size in enumerate(self.shape) if i != axis])) * itemsize
+
+		return chunking.blocks(0, self.shape[axis], 1, max(1, budget // max(other, 1)))
 
+	def point_chunks(self):
+		"""Storage chunk shape used to group point reads (see extract_points), in memory variables are one chunk"""
+
+		return self.shape
+
+	def extract_points(self, latitudes, longitudes, max_distance=None, blocksize=64 * 1024 * 1024):
+		"""
+		Extract the values at many (latitude, longitude) points at once.  Points are mapped to their nearest
+		cells (or features) with the dataset's PointIndex and the cells are read grouped by storage chunk, the
+		bounding box of the cells in each chunk being read in chunk aligned blocks of about blocksize bytes
+		along the first non spatial dimension.  Every chunk is therefore read only once however many points
+		fall in it.  Returns a masked array with the non spatial dimensions followed by a points dimension,
+		points further than max_distance km from any cell are masked.
+		"""
+
+		try:
+			latitude, longitude = self.coords['latitude'], self.coords['longitude']
+		except KeyError:
+			raise DatasetException("{} has no latitude and longitude coordinates".format(self.name))
+
+		index = self.dataset.point_index(latitude, longitude)
+		cells, distances = index.query(latitudes, longitudes, max_distance)
+
+		names = [dim.name for dim in self.dimensions]
+		spatial_axes = [names.index(name) for name in index.dimensions]
+		other_axes = [i for i in range(len(names)) if i not in spatial_axes]
+
+		result = np.ma.masked_all(tuple([self.shape[i] for i in other_axes]) + (len(cells[0]),), dtype=self.dtype)
+
+		found = np.flatnonzero(cells[0] >= 0)
+		if not len(found):
+			return result
+
+		# Distinct cells, and the storage chunks they fall in, in absolute indices
+		starts = np.array([self._subset[i].start or 0 for i in spatial_axes])
+		chunks = self.point_chunks()
+		sizes = np.array([max(1, chunks[i]) for i in spatial_axes])
+
+		points = np.column_stack([cell[found] for cell in cells])
+		unique, inverse = np.unique(points, axis=0, return_inverse=True)
+		groupkeys, groupinverse = np.unique((unique + starts) // sizes, axis=0, return_inverse=True)
+
+		# Points sorted by chunk group
+		pointgroups = groupinverse[inverse]
+		order = np.argsort(pointgroups, kind='mergesort')
+		bounds = np.searchsorted(pointgroups[order], np.arange(len(groupkeys) + 1))
+
+		# Blocks along the first non spatial dimension, sized for the largest bounding box
+		itemsize = 8 if self.dtype in (str, object) else np.dtype(self.dtype).itemsize
+		largest = max([int(np.prod(unique[groupinverse == g].ptp(axis=0) + 1)) for g in range(len(groupkeys))])
+
+		if other_axes:
+			axis = other_axes[0]
+			row = largest * int(np.prod([self.shape[i] for i in other_axes[1:]])) * itemsize
+			start = self._subset[axis].start or 0
+			blocks = [slice(b.start - start, b.stop - start) for b in chunking.blocks(start, start + self.shape[axis], chunks[axis], max(1, blocksize // max(row, 1)))]
+		else:
+			blocks = [None]
+
+		for block in blocks:
+			for g in range(len(groupkeys)):
+
+				members = order[bounds[g]:bounds[g+1]]
+				groupcells = points[members]
+				low, high = groupcells.min(axis=0), groupcells.max(axis=0) + 1
+
+				indices = [slice(None)] * len(names)
+				if block is not None:
+					indices[other_axes[0]] = block
+				for i, axis in enumerate(spatial_axes):
+					indices[axis] = slice(low[i], high[i])
+
+				data = np.ma.asarray(self[tuple(indices)]).transpose(other_axes + spatial_axes)
+				values = data[(Ellipsis,) + tuple((groupcells - low).T)]
+
+				target = [slice(None)] * len(other_axes)
+				if block is not None:
+					target[0] = block
+
+				result[tuple(target) + (found[members],)] = values
+
+		return result
 
 	def groupby(self, param):
 
@@ -568,20 +1032,27 @@ class BaseVariable(object):
 		try:
 			func = eval('grouping.{}'.format(funcname))
 		except:
-			logging.error("Can't find grouping function {}".format(funcname))
+			logger.error("Can't find grouping function {}".format(funcname))
 			pass
 		else:
-			logging.info("Using grouping function {}".format(func))
+			logger.info("Using grouping function {}".format(func))
+
+		with instrument.stage('group'):
+
+			# Values stored as a contiguous ragged array are grouped station by station
+			rowsize = self.dataset.ragged.get(coordinate.dimensions[0].name)
+			if rowsize is not None:
+				return RaggedGroupBy(funcname, self, coordinate, func, rowsize)
 
-		# Run the grouping funciton on the coordinate variable
-		groups = func(coordinate)
+			# Run the grouping funciton on the coordinate variable
+			groups = func(coordinate)
 
-		# Check if we can convert any groups to slices (1 dimensionsal coordinate only for now!)
-		if len(coordinate.shape) == 1:
+			# Check if we can convert any groups to slices (1 dimensionsal coordinate only for now!)
+			if len(coordinate.shape) == 1:
 
-			for key, indices in groups.items():
-				if (indices[-1] - indices[0] + 1) == len(indices):
-					groups[key] = slice(indices[0], indices[-1] + 1)
+				for key, indices in groups.items():
+					if (indices[-1] - indices[0] + 1) == len(indices):
+						groups[key] = slice(indices[0], indices[-1] + 1)
 
 		return GroupBy(funcname, self, coordinate, groups)
 
@@ -591,13 +1062,22 @@ class BaseVariable(object):
 
 
 class Variable(BaseVariable):
+	"""
+	In memory variable.  With scratch set to a directory the values (and mask) are held in memory mapped files
+	in that directory instead (see scratch.ScratchArray) so variables can be larger than memory.  String
+	variables are always held in memory.
+	"""
 
 	def __init__(self, *args, **kwargs):
 #		print("{}.__init__: {} {}".format(self.__class__.__name__, args,kwargs))
+		scratchdir = kwargs.pop('scratch', None)
+
 		super(Variable, self).__init__(*args, **kwargs)
 
 		if self.dtype == str:
 			self._data = np.empty(self.shape, dtype=object)
+		elif scratchdir and self.dtype != object:
+			self._data = scratch.ScratchArray(self.shape, dtype=self.dtype, directory=scratchdir, fill_value=self._fillvalue)
 		else:
 			self._data = np.ma.empty(self.shape, dtype=self.dtype)
 
@@ -613,15 +1093,64 @@ class Variable(BaseVariable):
 #		self._data[self._subset][indices] = value
 #		print 
 
+	# Factor by which storage grows when a variable outgrows it
+	growth = 2
+
 	def copy(self):
 		new  = super(Variable, self).copy()
 		new._data = self._data.copy()
 		return new
 
+	def _alldata(self):
+		# Storage can be larger than the variable
+		return self._data[tuple([slice(0, size) for size in self.shape])]
+
+	@property
+	def capacity(self):
+		"""The shape of the underlying storage, which can be larger than the shape of the variable"""
+		return tuple(self._data.shape)
+
 	def resize(self, newshape, fill=None):
-		self._data.resize(tuple(newshape), refcheck=False)
-		self._shape = tuple(newshape)
-		self._subset = tuple([slice(0,stop) for stop in self.shape])
+		"""
+		Resize the variable to newshape keeping the values that lie within both shapes, new values are masked
+		(or None for strings).  Storage grows geometrically so that extending a variable one step at a time
+		only copies the values O(log n) times, and shrinking keeps the storage for later growth.
+		"""
+
+		newshape = tuple(newshape)
+		oldshape = self.shape
+		capacity = self.capacity
+
+		if len(newshape) != len(capacity):
+			raise DatasetException("cannot resize {} from {} to {}".format(self.name, oldshape, newshape))
+
+		# Grow the storage if it is too small
+		if any([new > cap for new, cap in zip(newshape, capacity)]):
+
+			newcapacity = tuple([max(new, int(cap * self.growth)) if new > cap else cap for new, cap in zip(newshape, capacity)])
+			keep = tuple([slice(0, min(old, new)) for old, new in zip(oldshape, newshape)])
+
+			if isinstance(self._data, scratch.ScratchArray):
+				self._data.resize(newcapacity)
+
+			elif self.dtype == str:
+				data = np.empty(newcapacity, dtype=object)
+				data[keep] = self._data[keep]
+				self._data = data
+
+			else:
+				data = np.ma.masked_all(newcapacity, dtype=self._data.dtype)
+				data[keep] = self._data[keep]
+				self._data = data
+
+		# Newly exposed values are masked, storage may hold stale values from before a shrink
+		if all([new > 0 for new in newshape]):
+			for i in range(len(newshape)):
+				if newshape[i] > oldshape[i]:
+					exposed = tuple([slice(0, n) for n in newshape[:i]] + [slice(oldshape[i], newshape[i])] + [slice(0, n) for n in newshape[i+1:]])
+					self._data[exposed] = None if self.dtype == str else np.ma.masked
+
+		self._set_shape(newshape)
 
 
 class NetCDF4Variable(BaseVariable):
@@ -629,15 +1158,213 @@ class NetCDF4Variable(BaseVariable):
 	def __init__(self, *args, **kwargs):
 		super(NetCDF4Variable, self).__init__(*args, **kwargs)
 		self._data = self.dataset.ncfile.variables[self.name]
+		self._cache = None
+		self._planner = None
 
-#	def __getitem__(self, indices):
-#		print("{}.__getitem__: {}".format(self.__class__.__name__, indices))
-#		return self._data[self._subset][indices]
+		# Appended records waiting to be written, see append
+		self._pending = []
+		self._pending_bytes = 0
+
+	@property
+	def planner(self):
+		"""The chunking.ReadPlanner for this variable, which also records read statistics"""
+
+		if self._planner is None:
+			itemsize = 8 if self.dtype in (str, object) else np.dtype(self.dtype).itemsize
+			self._planner = chunking.ReadPlanner(self._data, self._data.shape, itemsize)
+
+		return self._planner
+
+	def point_chunks(self):
+		"""Storage chunk shape used to group point reads, contiguous variables are grouped by rows of the last dimension"""
+
+		if self.planner.chunks:
+			return self.planner.chunks
+
+		return tuple([1] * (len(self._data.shape) - 1) + list(self._data.shape[-1:]))
+
+	def cache(self):
+		"""
+		Read all the variable values once and serve all further reads from memory.  This is intended for
+		coordinate variables which are small but read over and over again.
+		"""
+
+		self.flush()
+
+		if self._cache is None:
+			with netcdf_lock:
+				self._cache = self._data[:]
+
+	def _alldata(self):
+		if self._cache is not None:
+			return self._cache
+
+		self.flush()
+
+		with netcdf_lock:
+			return self._data[:]
+
+	def __getitem__(self, indices):
+		if self._cache is not None:
+			return self._cache[self._merge_indices(indices)]
+
+		self.flush()
+
+		indices = self._merge_indices(indices)
+
+		with instrument.stage('read') as timer, netcdf_lock:
+			data = self._data[indices]
+			timer.bytes = getattr(data, 'nbytes', 0)
+
+		self.planner.record(indices, getattr(data, 'nbytes', 0))
+
+		return data
+
+	def plan(self, groups, axis, limit=None):
+		"""
+		Plan reading groups around the storage chunks of the file, see chunking.ReadPlanner.plan.  This also
+		sizes the chunk cache for the planned reads.
+		"""
+
+		self.flush()
+
+		extents = [(s.start, s.stop) for s in self._subset]
+		tiles = self.planner.plan(groups, axis, extents, limit=limit)
+
+		# Tiles are planned in absolute indices so make them relative to the subset
+		result = []
+		for tile in tiles:
+			result.append([None if i == axis else slice(tile[i][0] - extents[i][0], tile[i][1] - extents[i][0]) for i in range(len(tile))])
+
+		return result
+
+	def blocks(self, axis, budget):
+		"""
+		Return chunk aligned slices along axis for streaming through the variable in blocks of about budget
+		bytes
+		"""
+
+		self.flush()
+
+		start = self._subset[axis].start
+		return [slice(b.start - start, b.stop - start) for b in self.planner.blocks(axis, start, self._subset[axis].stop, budget)]
+
+	# Appended records are buffered and written in blocks of about this many bytes
+	flush_size = 32 * 1024 * 1024
+
+	def _appends(self, indices, value):
+		"""Return True if assigning value to indices just adds whole records to the end of the variable"""
+
+		if not len(self.shape) or not self._dimensions[0].isunlimited:
+			return False
+
+		if self._subset != tuple([slice(0, stop) for stop in self.shape]):
+			return False
+
+		if type(indices) != tuple:
+			indices = (indices,)
+
+		if not len(indices):
+			return False
+
+		first, rest = indices[0], indices[1:]
+
+		# The leading index has to start at the current end
+		if isinstance(first, (int, long, np.integer)):
+			if first != self.shape[0] or np.ndim(value) != len(self.shape) - 1:
+				return False
+
+		elif isinstance(first, slice):
+			if first.start != self.shape[0] or first.stop is None or first.step not in (None, 1):
+				return False
+			if np.ndim(value) != len(self.shape) or np.shape(value)[0] != first.stop - first.start:
+				return False
+
+		else:
+			return False
+
+		# All other dimensions have to be written in full
+		for index, size in zip(rest, self.shape[1:]):
+			if index is Ellipsis:
+				break
+			if not isinstance(index, slice) or index.start not in (None, 0) or index.stop not in (None, size) or index.step not in (None, 1):
+				return False
+
+		return tuple(np.shape(value)[-(len(self.shape) - 1):]) == self.shape[1:] if len(self.shape) > 1 else True
+
+	def append(self, values):
+		"""
+		Append one record (or several, if values has as many dimensions as the variable) along the leading
+		unlimited dimension.  Records are held in memory and written in large contiguous blocks once about
+		flush_size bytes are waiting, or when the variable is read or flushed, so that building a series one
+		step at a time doesn't mean one small write per step.
+		"""
+
+		if not len(self.shape) or not self._dimensions[0].isunlimited:
+			raise DatasetException("can only append to variables with a leading unlimited dimension, not {}".format(self.name))
+
+		records = np.ma.asanyarray(values)
+		if records.ndim == len(self.shape) - 1:
+			records = records.reshape((1,) + records.shape)
+
+		if records.shape[1:] != self.shape[1:]:
+			raise DatasetException("cannot append records of shape {} to {} with shape {}".format(records.shape[1:], self.name, self.shape))
+
+		self._cache = None
+		self._index = None
+
+		self._pending.append(records)
+		self._pending_bytes += records.nbytes
+
+		newshape = (self.shape[0] + records.shape[0],) + self.shape[1:]
+		self._set_shape(newshape)
+
+		if newshape[0] > self._dimensions[0]._size:
+			self._dimensions[0]._size = newshape[0]
+
+		if self._pending_bytes >= self.flush_size:
+			self.flush()
+
+	def flush(self):
+		"""Write any appended records in one contiguous write"""
+
+		if not self._pending:
+			return
+
+		records = self._pending[0] if len(self._pending) == 1 else np.ma.concatenate(self._pending)
+		start = self.shape[0] - records.shape[0]
+
+		self._pending = []
+		self._pending_bytes = 0
+
+		with netcdf_lock:
+			self._data[start:start + records.shape[0]] = records
+
+		if self._planner is not None:
+			self._planner.shape = tuple(self._data.shape)
 
 	def __setitem__(self, indices, value):
-#		print("{}.__setitem__: {}".format(self.__class__.__name__, indices))
-		super(NetCDF4Variable, self).__setitem__(indices, value)
-		self._data[self._subset][indices] = value
+		# Writing invalidates any cached values
+		self._cache = None
+
+		# Whole records just past the end are buffered
+		if self._appends(indices, value):
+			self.append(value)
+			return
+
+		self.flush()
+
+		with netcdf_lock:
+			super(NetCDF4Variable, self).__setitem__(indices, value)
+
+		if self._planner is not None:
+			self._planner.shape = tuple(self._data.shape)
+
+	def resize(self, newshape, fill=None):
+		"""NetCDF variables grow along unlimited dimensions as they are written so only the shape changes"""
+
+		self._cache = None
+		self._set_shape(newshape)
 
 
 
@@ -653,6 +1380,14 @@ class Dataset(object):
 		self.ancil = {}
 		self.coords = {}
 
+		# PointIndex instances keyed on the latitude and longitude coordinates, see point_index
+		self._point_indices = {}
+
+		# row_size variables of CF contiguous ragged arrays keyed on their sample dimension
+		self.ragged = {}
+
+		# While > 0 coordinate classification is deferred, see batch
+		self._deferred = 0
 
 		# Load dimensions
 		for dim in dimensions:
@@ -665,46 +1400,135 @@ class Dataset(object):
 				self.attributes[key] = value
 
 		# Load variables
-		for variable in variables:
-			
-			if not 'dtype' in variable:
-				dtype = np.float32
-			else:
-				dtype = eval('type({})'.format(variable['dtype']))
+		with self.batch():
+			for variable in variables:
+				
+				if not 'dtype' in variable:
+					dtype = np.float32
+				else:
+					dtype = eval('type({})'.format(variable['dtype']))
 
-			newvar = Variable(variable['name'], self, variable['dims'], dtype=dtype)
+				newvar = Variable(variable['name'], self, variable['dims'], dtype=dtype)
 
 	@property
 	def dimensions(self):
 	    return self._dimensions
-	
+
+	def point_index(self, latitude, longitude):
+		"""
+		Return the spatial.PointIndex of latitude and longitude coordinate variables, built on first use and
+		then kept
+		"""
+
+		key = (latitude.name, longitude.name, tuple([(s.start, s.stop) for s in latitude._subset]), tuple([(s.start, s.stop) for s in longitude._subset]))
+
+		if key not in self._point_indices:
+			dimensions = ([dim.name for dim in latitude.dimensions], [dim.name for dim in longitude.dimensions])
+			self._point_indices[key] = spatial.PointIndex(latitude[:], longitude[:], dimensions)
+
+		return self._point_indices[key]
+
+	def extract_points(self, latitudes, longitudes, variables=None, max_distance=None):
+		"""
+		Extract the values of variables (names, defaults to all variables with latitude and longitude
+		coordinates) at many points, see BaseVariable.extract_points.  Returns a dictionary of arrays keyed
+		on variable name.
+		"""
+
+		if variables is None:
+			variables = sorted([name for name, variable in self.variables.items() if 'latitude' in variable.coords and 'longitude' in variable.coords])
+
+		result = OrderedDict()
+		for name in variables:
+			result[name] = self.variables[name].extract_points(latitudes, longitudes, max_distance=max_distance)
+
+		return result
+
 
 	@classmethod
 	def cf_coordinate(cls, attrs):
 
 		if 'units' in attrs.keys():
 
+			# Units strings are shared by many variables so only parse each distinct string once
 			try:
-				units = cfunits.Units(attrs['units'])
-			except:
-				return False, False
-
-			if units.islatitude:
-				return units, 'latitude'
-			if units.islongitude:
-				return units, 'longitude'
-			if units.isreftime:
-				return units, 'time'
-			if units.ispressure:
-				return units, 'pressure'
-			else:
-				return units, False
+				return cls._units_cache[attrs['units']]
+			except KeyError:
+				pass
+			except TypeError:
+				return cls.parse_units(attrs['units'])
+
+			result = cls.parse_units(attrs['units'])
+			cls._units_cache[attrs['units']] = result
+			return result
 
 		else:
 			return False, False
 
+	# Parsed units keyed on units string, shared by all datasets
+	_units_cache = {}
+
+	@classmethod
+	def parse_units(cls, units):
+
+		# cfunits loads the udunits library, only pay for that once units are actually parsed
+		import cfunits
+
+		try:
+			units = cfunits.Units(units)
+		except:
+			return False, False
+
+		if units.islatitude:
+			return units, 'latitude'
+		if units.islongitude:
+			return units, 'longitude'
+		if units.isreftime:
+			return units, 'time'
+		if units.ispressure:
+			return units, 'pressure'
+		else:
+			return units, False
+
+	@contextlib.contextmanager
+	def batch(self):
+		"""
+		Context manager that defers coordinate classification while variables are added and then classifies
+		all variables once on exit, so that building a dataset is linear in the number of variables:
+
+		with ds.batch():
+			Variable('time', ds, ['time'])
+			...
+		"""
+
+		self._deferred += 1
+
+		try:
+			yield self
+		finally:
+			self._deferred -= 1
+
+		if not self._deferred:
+			try:
+				self.make_coords()
+			except:
+				pass
+
 	def make_coords(self):
 
+		started = time.time()
+
+		# Rebuild the classification from scratch
+		self.coords = {}
+		self.variables = {}
+		self.ancil = {}
+		self.ragged = {}
+
+		# Contiguous ragged arrays are described by a row_size variable naming the sample dimension
+		for name, variable in self._allvariables.items():
+			if 'sample_dimension' in variable.attributes:
+				self.ragged[variable.attributes['sample_dimension']] = variable
+
 		# Find the coordinate variables
 		for name, variable in self._allvariables.items():
 
@@ -747,6 +1571,8 @@ class Dataset(object):
 		for name, variable in self.variables.items():
 			variable.makecoords()
 
+		instrument.record('classify', time.time() - started)
+
 
 	def addVariable(self, variable):
 
@@ -754,6 +1580,11 @@ class Dataset(object):
 			raise DatasetException("ERROR: variable {} already exists in dataset {}".format(variable.name, self))
 		else:
 			self._allvariables[variable.name] = variable
+
+			# Classification is done once at the end of a batch
+			if self._deferred:
+				return
+
 			try:
 				self.make_coords()
 			except:
@@ -765,17 +1596,40 @@ class Dataset(object):
 
 class NetCDF4Dataset(Dataset):
 
-	def __init__(self, uri):
+	def __init__(self, uri, index=None, workers=1, mode='r'):
+		"""
+		Open a NetCDF4 dataset
+		uri: list of one or more filenames, or a single chunk store directory (see chunkstore.py)
+		index: optional path of a multi-file index sidecar file (see multifile.py), created if it doesn't
+		exist.  With an index large archives open without scanning all the member files.
+		workers: number of processes used to read multi-file datasets in parallel
+		mode: 'r' to read, 'a' to modify (or append to) a single existing file
+		"""
+
+		if mode != 'r' and len(uri) > 1:
+			raise DatasetException("only single files can be opened with mode {}".format(mode))
+
+		started = time.time()
 
+		# Chunked directory stores look like a single file
+		if len(uri) == 1 and chunkstore.isstore(uri[0]):
+			self.ncfile = chunkstore.ChunkStore(uri[0])
 
-		# If uri is a list then try MFDataset
+		# With an index or parallel readers use our own lazy multi-file aggregation
+		elif index or (workers > 1 and len(uri) > 1):
+			self.ncfile = multifile.MultiFileDataset(uri, index=index, workers=workers)
 
-		if len(uri) > 1:
-			self.ncfile = netCDF4.MFDataset(uri)
+		# If uri is a list then try MFDataset, which only supports some formats
+		elif len(uri) > 1:
+			try:
+				self.ncfile = netCDF4.MFDataset(uri)
+			except (ValueError, IOError):
+				logger.info("MFDataset cannot aggregate {} files, using MultiFileDataset".format(len(uri)))
+				self.ncfile = multifile.MultiFileDataset(uri)
 		else:
-			self.ncfile = netCDF4.Dataset(uri[0])
+			self.ncfile = netCDF4.Dataset(uri[0], mode)
 
-		print self.ncfile
+		logger.debug(repr(self.ncfile))
 
 		dimensions = []
 		for name, dim in self.ncfile.dimensions.items():
@@ -786,45 +1640,275 @@ class NetCDF4Dataset(Dataset):
 
 		super(NetCDF4Dataset, self).__init__(dimensions=dimensions)
 
-		for name, variable in self.ncfile.variables.items():
-			attrs = {}
-			for key in variable.ncattrs():
-				attrs[key] = variable.getncattr(key)
+		with self.batch():
+			for name, variable in self.ncfile.variables.items():
+				attrs = {}
+				for key in variable.ncattrs():
+					attrs[key] = variable.getncattr(key)
 
-			NetCDF4Variable(name, self, dimensions=variable.dimensions, attributes=attrs, dtype=variable.dtype)
+				NetCDF4Variable(name, self, dimensions=variable.dimensions, attributes=attrs, dtype=variable.dtype)
+
+		# Coordinate variables are small and read for every group and subset so hold them in memory
+		for name, variable in self.coords.items():
+			variable.cache()
+
+		instrument.record('open', time.time() - started)
+
+	def flush(self):
+		"""Write out the records appended to any variable"""
+
+		for variable in self._allvariables.values():
+			variable.flush()
+
+	def close(self):
+		self.flush()
+		self.ncfile.close()
 
 	@classmethod
-	def write(cls, dataset, filename, format='NETCDF4'):
+	def write(cls, dataset, filename, format='NETCDF4', encoding=None):
+		"""
+		Write a complete dataset to filename, see NetCDF4Writer for the encoding options
+		"""
 
-		ncfile = netCDF4.Dataset(filename, 'w', format='NETCDF4')
+		with NetCDF4Writer(filename, format=format, encoding=encoding) as writer:
+			writer.define(dataset)
 
-		for key, value in dataset.attributes:
-			ncfile.setncattr(key, value)
+			for name, variable in dataset._allvariables.items():
+				writer.write_variable(variable)
 
-		for name, dim in dataset.dimensions.items():
-			print 'writing dimension', name, dim
-			ncfile.createDimension(name, dim.size)
 
+class NetCDF4Writer(object):
+	"""
+	Writes datasets to NetCDF files in blocks along the leading dimension so that variables never have to be
+	held in memory in full.  The file structure is created from a Dataset with define and then data can be
+	written whole variable at a time with write_variable or piece by piece, in any order, with write.  The
+	latter lets results be written as they are produced by GroupBy.apply.
+
+	encoding is a dictionary of per variable dictionaries of output options, the '*' entry gives the defaults
+	for all numeric variables and a variable's own entry adds to or overrides them.  Options are:
+
+	zlib: compress with zlib (True/False)
+	complevel: zlib compression level 1-9
+	shuffle: apply the HDF5 shuffle filter before compressing (True/False)
+	chunks: 'map' (one time step per chunk), 'timeseries' (full time extent per chunk) or a tuple of sizes
+	least_significant_digit: quantize values to this many decimal digits before compressing
+	significant_digits: keep this many significant digits (needs netCDF4 >= 1.6)
+	pack: 'int16' to store packed 16 bit integers with scale_factor/add_offset
+	scale_factor, add_offset: packing parameters, calculated from the data range if not given
+
+	The data range of a packed variable is only known once all its values are written, so without explicit
+	scale_factor and add_offset its values are held in memory and packed and written on close.
+	"""
+
+	# Default block size in bytes
+	blocksize = 64 * 1024 * 1024
+
+	# Encoding options passed straight to createVariable
+	create_options = ['zlib', 'complevel', 'shuffle', 'least_significant_digit', 'significant_digits']
+
+	def __init__(self, filename, format='NETCDF4', blocksize=None, encoding=None):
+		"""
+		filename: the file to create
+		format: NetCDF format (NETCDF4, NETCDF4_CLASSIC, NETCDF3_64BIT, ...)
+		blocksize: approximate number of bytes written per call
+		encoding: per variable output options, see above
+		"""
+
+		self.filename = filename
+		self.format = format
+		self.ncfile = netCDF4.Dataset(filename, 'w', format=format)
+		self.encoding = encoding if encoding else {}
+
+		# Values of packed variables held until close, keyed on name, see packing.pack_parameters
+		self.deferred = {}
+
+		if blocksize:
+			self.blocksize = blocksize
+
+	@classmethod
+	def parse_encoding(cls, specs):
+		"""
+		Parse command line encoding specifications of the form [variable:]option=value[,option=value...] into an
+		encoding dictionary.  Without a variable name the options apply to all variables.  Chunk sizes are
+		given as sizes separated by x, eg. chunks=1x100x100
+		"""
+
+		encoding = {}
+
+		for spec in specs:
+
+			if ':' in spec:
+				name, options = spec.split(':', 1)
+			else:
+				name, options = '*', spec
+
+			for option in options.split(','):
+				key, value = option.split('=', 1)
+
+				if value.lower() in ['true', 'yes']:
+					value = True
+				elif value.lower() in ['false', 'no']:
+					value = False
+				elif key == 'chunks' and 'x' in value:
+					value = tuple([int(size) for size in value.split('x')])
+				else:
+					# try and coerce to an integer, then a float, or leave as string
+					try:
+						value = int(value)
+					except ValueError:
+						try:
+							value = float(value)
+						except ValueError:
+							pass
+
+				encoding.setdefault(name, {})[key] = value
+
+		return encoding
+
+	def options(self, variable):
+		"""Return the encoding options for a variable"""
+
+		if variable.dtype in (object, str):
+			return {}
+
+		options = dict(self.encoding.get('*', {}))
+		options.update(self.encoding.get(variable.name, {}))
+
+		return options
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def define(self, dataset):
+		"""
+		Create the global attributes, dimensions and variables of dataset.  Dimensions that are unlimited in the
+		dataset are unlimited in the file.
+		"""
+
+		for key, value in dataset.attributes.items():
+			self.ncfile.setncattr(key, value)
+
+		for name, dim in dataset.dimensions.items():
+			logger.debug("writing dimension {} {}".format(name, dim))
+			self.ncfile.createDimension(name, None if dim.isunlimited else dim.size)
 
 		for name, variable in dataset._allvariables.items():
-			print 'writing variable ', name, variable, variable.dtype
+			self.create(variable)
 
-			if variable.dtype == object:
-				dtype = str
+	def create(self, variable):
+		"""Create a single variable, the _FillValue attribute has to be set at creation time"""
+
+		options = self.options(variable)
+		kwargs = dict([(key, options[key]) for key in self.create_options if key in options])
+		attributes = copy.copy(variable.attributes)
+
+		if variable.dtype in (object, str):
+			dtype = str
+			fill_value = None
+		else:
+			dtype = variable.dtype
+
+			fill_value = variable.attributes.get('_FillValue')
+			if fill_value is None and np.dtype(dtype).kind == 'f':
+				fill_value = variable._fillvalue
+
+		# Chunk shapes can be given or tuned for the expected access pattern
+		chunks = options.get('chunks')
+		if chunks in ['map', 'timeseries']:
+			itemsize = np.dtype(dtype).itemsize if dtype != str else 8
+			kwargs['chunksizes'] = chunking.chunk_sizes(variable.shape, itemsize, access=chunks)
+		elif chunks:
+			kwargs['chunksizes'] = tuple(chunks)
+
+		if 'chunksizes' in kwargs and len(kwargs['chunksizes']) != len(variable.shape):
+			del kwargs['chunksizes']
+
+		# Packing into integers replaces the type, fill value and packing attributes
+		pack = options.get('pack')
+		if pack:
+			if pack not in packing.types:
+				raise DatasetException("unsupported packing {} for variable {}".format(pack, variable.name))
+
+			dtype, fill_value = packing.types[pack][:2]
+
+			for key in ['valid_min', 'valid_max', 'valid_range', 'missing_value']:
+				attributes.pop(key, None)
+
+			# Without explicit parameters the values are held until close when their range is known
+			if 'scale_factor' in options or 'add_offset' in options:
+				attributes['scale_factor'] = np.float32(options.get('scale_factor', 1.0))
+				attributes['add_offset'] = np.float32(options.get('add_offset', 0.0))
 			else:
-				dtype = variable.dtype
+				self.deferred[variable.name] = (np.ma.masked_all(variable.shape, dtype=variable.dtype), pack)
 
-			try:
-				var = ncfile.createVariable(name, dtype, [dim.name for dim in variable.dimensions])
+		logger.debug("creating variable {} {} {}".format(variable.name, dtype, kwargs))
 
-				for key, value in variable.attributes.items():
-					var.setncattr(key, value)
+		try:
+			with netcdf_lock:
+				var = self.ncfile.createVariable(variable.name, dtype, [dim.name for dim in variable.dimensions], fill_value=fill_value, **kwargs)
 
-				var[:] = variable[:]
-			except:
-				print("{}.write: Error writing variable {}".format(cls.__name__, variable))
+				for key, value in attributes.items():
+					if key != '_FillValue':
+						var.setncattr(key, value)
+
+		except Exception as e:
+			logger.error("{}: error creating variable {}: {}".format(self.filename, variable, e))
+			raise DatasetException("error creating variable {} in {}: {}".format(variable.name, self.filename, e))
+
+		return var
+
+	def write(self, name, indices, values):
+		"""Write values to indices of variable name"""
+
+		if name in self.deferred:
+			self.deferred[name][0][indices] = values
+			return
+
+		try:
+			with instrument.stage('write') as timer, netcdf_lock:
+				timer.bytes = getattr(values, 'nbytes', 0)
+				self.ncfile.variables[name][indices] = values
+		except Exception as e:
+			logger.error("{}: error writing {}{}: {}".format(self.filename, name, indices, e))
+			raise DatasetException("error writing variable {} in {}: {}".format(name, self.filename, e))
+
+	def write_variable(self, variable):
+		"""Write all the values of variable in blocks along its leading dimension"""
+
+		logger.debug("writing variable {}".format(variable))
+
+		# Scalar variables are written in one go
+		if not len(variable.shape):
+			self.write(variable.name, slice(None), variable[:])
+			return
+
+		for block in variable.blocks(0, self.blocksize):
+			self.write(variable.name, block, variable[block])
+
+	def close(self):
+
+		with netcdf_lock:
+			# Packed variables held until now get their parameters from their full range
+			for name, (values, pack) in self.deferred.items():
+				scale_factor, add_offset = packing.pack_parameters(values, pack)
+
+				var = self.ncfile.variables[name]
+				var.setncattr('scale_factor', np.float32(scale_factor))
+				var.setncattr('add_offset', np.float32(add_offset))
+
+				if not len(values.shape):
+					var[...] = values
+					continue
+
+				row = int(np.prod(values.shape[1:])) * values.dtype.itemsize
+				for block in chunking.blocks(0, values.shape[0], 1, max(1, self.blocksize // max(row, 1))):
+					var[block] = values[block]
 
-		ncfile.close()
+			self.deferred = {}
+			self.ncfile.close()
 
 
 if __name__ == "__main__":
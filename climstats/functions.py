@@ -1,6 +1,4 @@
 import numpy as np
-import scipy.stats
-import matplotlib.pyplot as plt
 
 def make_percentile_function(percentile):
 
@@ -127,6 +125,9 @@ def spi(data, length, fit_start=None, fit_end=None):
 	result = np.empty(data.shape)
 	result[:] = 1e10
 
+	# scipy is slow to import and only needed here
+	import scipy.stats
+
 	length = int(length)
 
 	print('spi length', length)
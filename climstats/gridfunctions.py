@@ -1,7 +1,15 @@
+import os
+import hashlib
+import tempfile
+import logging
+
 import numpy as np
 from shapely.geometry import Polygon
 
 
+logger = logging.getLogger(__name__)
+
+
 def makegrid(latvar, lonvar):
 
 
@@ -59,4 +67,140 @@ def makegrid(latvar, lonvar):
 
 		polys.append(row)
 
-	return shape, polys
\ No newline at end of file
+	return shape, polys
+
+
+def grid_weights(polys, geometries):
+	"""
+	Area weights of the grid cell polygons (as returned by makegrid) for each of a list of geometries.  The
+	candidate cells of each geometry come from an STRtree of the cell polygons so only cells whose bounding
+	boxes overlap the geometry are tested.  Returns (features, cells, weights) arrays, the weight of flat
+	cell index cells[i] for geometry features[i], normalized so that the weights of each geometry sum to one.
+	"""
+
+	import shapely
+	from shapely.strtree import STRtree
+	from shapely.prepared import prep
+
+	flat = [poly for row in polys for poly in row]
+	tree = STRtree(flat)
+
+	# Shapely 2 queries return indices and works on arrays of geometries
+	vectorized = hasattr(shapely, 'contains_xy')
+	if vectorized:
+		cellarray = np.empty(len(flat), dtype=object)
+		cellarray[:] = flat
+		areas = shapely.area(cellarray)
+
+	# Shapely 1 queries return the geometries themselves
+	else:
+		positions = dict([(id(poly), i) for i, poly in enumerate(flat)])
+
+	features, cells, weights = [], [], []
+
+	for feature, geometry in enumerate(geometries):
+
+		if vectorized:
+			candidates = tree.query(geometry, predicate='intersects')
+			overlap = shapely.area(shapely.intersection(cellarray[candidates], geometry)) / areas[candidates]
+
+		else:
+			prepared = prep(geometry)
+			candidates = np.array([positions[id(poly)] for poly in tree.query(geometry) if prepared.intersects(poly)], dtype=np.int64)
+			overlap = np.array([flat[i].intersection(geometry).area / flat[i].area for i in candidates], dtype=np.float64)
+
+		# Cells that only touch the geometry have no weight
+		keep = overlap > 0
+		if not keep.any():
+			continue
+
+		features.append(np.repeat(feature, keep.sum()))
+		cells.append(np.asarray(candidates, dtype=np.int64)[keep])
+		weights.append(overlap[keep] / overlap[keep].sum())
+
+	if not features:
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+	return np.concatenate(features), np.concatenate(cells), np.concatenate(weights).astype(np.float32)
+
+
+def weights_matrix(features, cells, weights, shape):
+	"""
+	The (features, cells, weights) arrays of grid_weights as a scipy.sparse CSR matrix with a row for each
+	feature and a column for each flat cell index.  shape is (number of features,) + the grid (or stations)
+	shape.
+	"""
+
+	from scipy import sparse
+
+	return sparse.csr_matrix((np.asarray(weights, dtype=np.float64), (features, cells)), shape=(shape[0], int(np.prod(shape[1:]))))
+
+
+def area_means(matrix, data):
+	"""
+	Weighted means of a block of data (time first, then the grid or station dimensions) for every feature
+	with one sparse-dense product, matrix being a weights_matrix.  Masked cells are left out and the weights
+	of the remaining cells of each feature renormalized at each time step.  Returns a (time, features)
+	masked array, masked where a feature has no unmasked cells.
+	"""
+
+	data = np.ma.asarray(data)
+	flat = data.reshape((data.shape[0], -1))
+	valid = ~np.ma.getmaskarray(flat)
+
+	totals = matrix.dot(np.where(valid, np.ma.getdata(flat), 0).T.astype(np.float64))
+	norms = matrix.dot(valid.T.astype(np.float64))
+
+	means = totals / np.where(norms > 0, norms, 1.0)
+
+	return np.ma.masked_array(means.T, mask=(norms <= 0).T)
+
+
+def weights_key(latitudes, longitudes, geometries):
+	"""
+	Key of the weights of geometries on a grid (or stations), made of a sha1 hash of the coordinates and a
+	sha1 hash of the geometries
+	"""
+
+	grid = hashlib.sha1()
+	for values in (latitudes, longitudes):
+		values = np.ascontiguousarray(np.ma.filled(np.ma.asarray(values, dtype=np.float64), np.nan))
+		grid.update(repr(values.shape))
+		grid.update(values.tobytes())
+
+	shapes = hashlib.sha1()
+	for geometry in geometries:
+		shapes.update(geometry.wkb)
+
+	return "{}_{}".format(grid.hexdigest(), shapes.hexdigest())
+
+
+def load_weights(directory, key):
+	"""Load the (features, cells, weights) arrays saved under key in directory, or None if there are none"""
+
+	filename = os.path.join(directory, 'weights_{}.npz'.format(key))
+
+	if not os.path.exists(filename):
+		return None
+
+	try:
+		with np.load(filename) as saved:
+			return saved['features'], saved['cells'], saved['weights']
+	except Exception:
+		logger.warning("ignoring unreadable weights cache {}".format(filename))
+		return None
+
+
+def save_weights(directory, key, features, cells, weights):
+	"""Save (features, cells, weights) arrays under key in directory, written to a temporary file and renamed into place"""
+
+	if not os.path.exists(directory):
+		os.makedirs(directory)
+
+	filename = os.path.join(directory, 'weights_{}.npz'.format(key))
+	handle, temporary = tempfile.mkstemp(suffix='.npz', dir=directory)
+
+	with os.fdopen(handle, 'wb') as output:
+		np.savez(output, features=features, cells=cells, weights=weights)
+
+	os.rename(temporary, filename)
@@ -0,0 +1,143 @@
+"""
+Lightweight instrumentation of the processing stages (open, coordinate classification, grouping, reads,
+statistic calls and writes).  Each stage accumulates a call count, elapsed time and bytes processed and the
+totals can be dumped as JSON.  Instrumentation is off by default and then costs a single flag check per
+stage.  Stages may nest (eg. open includes the classification of the variables it loads) so their times
+don't add up to the wall time.
+
+	instrument.enable()
+
+	with instrument.stage('read') as timer:
+		data = variable[indices]
+		timer.bytes = data.nbytes
+
+	instrument.dump('profile.json')
+"""
+
+import json
+import time
+import threading
+
+
+# Instrumentation is off unless enabled
+enabled = False
+
+# Totals for each stage, see record
+stages = {}
+
+_lock = threading.Lock()
+_started = None
+
+
+class Timer(object):
+	"""Times one stage, set bytes to the number of bytes the stage processed"""
+
+	__slots__ = ('name', 'bytes', 'start')
+
+	def __init__(self, name):
+		self.name = name
+		self.bytes = 0
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, *args):
+		record(self.name, time.time() - self.start, self.bytes)
+
+
+class NullTimer(object):
+	"""Stands in for Timer when instrumentation is disabled"""
+
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		pass
+
+	def __setattr__(self, key, value):
+		pass
+
+
+_null = NullTimer()
+
+
+def enable(flag=True):
+	"""Turn instrumentation on (or off), totals are reset when turned on"""
+
+	global enabled, _started
+
+	if flag and not enabled:
+		reset()
+		_started = time.time()
+
+	enabled = flag
+
+
+def reset():
+	"""Clear all the totals"""
+
+	with _lock:
+		stages.clear()
+
+
+def stage(name):
+	"""Return a context manager timing the named stage"""
+
+	if not enabled:
+		return _null
+
+	return Timer(name)
+
+
+def record(name, seconds, nbytes=0):
+	"""Add one call of a stage taking seconds and processing nbytes bytes"""
+
+	if not enabled:
+		return
+
+	with _lock:
+		totals = stages.get(name)
+
+		if totals is None:
+			totals = stages[name] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0}
+
+		totals['calls'] += 1
+		totals['seconds'] += seconds
+		totals['bytes'] += int(nbytes)
+
+		if seconds > totals['max_seconds']:
+			totals['max_seconds'] = seconds
+
+
+def summary():
+	"""Return the totals of every stage along with derived means and rates"""
+
+	result = {}
+
+	with _lock:
+		for name, totals in stages.items():
+			totals = dict(totals)
+			totals['mean_seconds'] = totals['seconds'] / totals['calls'] if totals['calls'] else 0.0
+			totals['mb_per_second'] = totals['bytes'] / totals['seconds'] / 1e6 if totals['seconds'] else 0.0
+			result[name] = totals
+
+	return result
+
+
+def dump(filename, **info):
+	"""
+	Write the stage totals to filename as JSON.  Any keyword arguments are included as run information (eg.
+	the command line).
+	"""
+
+	content = {
+		'wall_seconds': time.time() - _started if _started else 0.0,
+		'info': info,
+		'stages': summary(),
+	}
+
+	with open(filename, 'w') as jsonfile:
+		json.dump(content, jsonfile, indent=1, sort_keys=True)
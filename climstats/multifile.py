@@ -0,0 +1,694 @@
+"""
+Multi-file aggregation of NetCDF files along a single (usually time) dimension.  An aggregation is described
+by a MultiFileIndex which can be saved as a JSON sidecar file so that large archives can be opened without
+scanning every member file.  MultiFileDataset presents the aggregation through the same interface as a
+netCDF4.Dataset and only opens member files when their data is actually read.
+"""
+
+import os
+import json
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import netCDF4
+
+from packing import unpack
+
+
+logger = logging.getLogger(__name__)
+
+
+class MultiFileException(Exception):
+	"""
+	General, very simple multi-file exception class
+	"""
+
+	def __init__(self, value):
+		self.value = value
+
+	def __str__(self):
+		return repr(self.value)
+
+
+def jsonable(value):
+	"""Convert numpy values (as found in NetCDF attributes) to plain python values"""
+
+	if isinstance(value, np.ndarray):
+		return value.tolist()
+	if isinstance(value, np.generic):
+		return value.item()
+
+	return value
+
+
+def dtype_name(dtype):
+	"""Return a JSON friendly name for a NetCDF variable dtype"""
+
+	if dtype == str:
+		return 'str'
+
+	return np.dtype(dtype).str
+
+
+def dtype_from_name(name):
+	"""Inverse of dtype_name"""
+
+	if name == 'str':
+		return str
+
+	return np.dtype(str(name))
+
+
+def read_piece(piece):
+	"""
+	Read one raw (not masked or scaled) hyperslab from a member file.  This is a module level function so that
+	it can be run by a process pool, piece is a (path, variable name, indices, take, axis) tuple where take
+	is an optional array of positions to take along axis after reading.
+	"""
+
+	path, name, indices, take, axis = piece
+
+	ncfile = netCDF4.Dataset(path)
+
+	try:
+		variable = ncfile.variables[name]
+		variable.set_auto_maskandscale(False)
+		data = np.asarray(variable[indices])
+	finally:
+		ncfile.close()
+
+	if take is not None:
+		data = np.take(data, take, axis=axis)
+
+	return data
+
+
+class MultiFileIndex(object):
+	"""
+	Describes the member files of an aggregation: for each file its path, mtime, offset and size along the
+	aggregation dimension, time range and values, and variable shapes.  The dimensions, variables and
+	attributes of the aggregation are taken from the first member.
+	"""
+
+	version = 1
+
+	def __init__(self, aggdim, dimensions, variables, attributes, members, timevar=None, path=None):
+
+		self.aggdim = aggdim
+		self.dimensions = dimensions
+		self.variables = variables
+		self.attributes = attributes
+		self.members = members
+		self.timevar = timevar
+		self.path = path
+		self.dirty = False
+
+		self._update_offsets()
+
+	def _update_offsets(self):
+
+		offset = 0
+		for member in self.members:
+			member['offset'] = offset
+			offset += member['size']
+
+		self.starts = np.array([member['offset'] for member in self.members], dtype=np.int64)
+		self.positions = dict([(member['path'], i) for i, member in enumerate(self.members)])
+		self.size = offset
+		self.dimensions[self.aggdim]['size'] = offset
+
+	@property
+	def filenames(self):
+		return [member['path'] for member in self.members]
+
+	@classmethod
+	def scan(cls, ncfile, path, aggdim, timevar=None, units=None, calendar=None):
+		"""
+		Build the member record for one open netCDF4.Dataset
+		"""
+
+		member = {
+			'path': path,
+			'mtime': os.path.getmtime(path),
+			'size': len(ncfile.dimensions[aggdim]),
+			'variables': dict([(name, list(variable.shape)) for name, variable in ncfile.variables.items()]),
+			'time': None,
+			'start': None,
+			'end': None,
+		}
+
+		if timevar and timevar in ncfile.variables:
+
+			values = np.ma.getdata(ncfile.variables[timevar][:]).astype(np.float64)
+
+			# Members may use different reference times so convert to the aggregation units
+			source_units = getattr(ncfile.variables[timevar], 'units', units)
+			if units and source_units != units:
+				values = netCDF4.date2num(netCDF4.num2date(values, source_units, calendar=calendar), units, calendar=calendar)
+
+			member['time'] = np.asarray(values, dtype=np.float64).tolist()
+
+			if len(values):
+				member['start'], member['end'] = float(values[0]), float(values[-1])
+
+		return member
+
+	@classmethod
+	def build(cls, filenames, aggdim=None):
+		"""
+		Build an index by scanning the metadata of every file in filenames.  The aggregation dimension
+		defaults to the unlimited dimension of the first file, or time if there is none.
+		"""
+
+		filenames = [os.path.abspath(filename) for filename in filenames]
+
+		if not filenames:
+			raise MultiFileException("no files to aggregate")
+
+		first = netCDF4.Dataset(filenames[0])
+
+		try:
+			if not aggdim:
+				unlimited = [name for name, dim in first.dimensions.items() if dim.isunlimited()]
+				aggdim = unlimited[0] if unlimited else 'time'
+
+			if aggdim not in first.dimensions:
+				raise MultiFileException("aggregation dimension {} not found in {}".format(aggdim, filenames[0]))
+
+			dimensions = OrderedDict()
+			for name, dim in first.dimensions.items():
+				dimensions[name] = {'size': len(dim), 'unlimited': dim.isunlimited() or name == aggdim}
+
+			variables = OrderedDict()
+			for name, variable in first.variables.items():
+				attrs = OrderedDict()
+				for key in variable.ncattrs():
+					attrs[key] = jsonable(variable.getncattr(key))
+
+				variables[name] = {
+					'dimensions': list(variable.dimensions),
+					'dtype': dtype_name(variable.dtype),
+					'attributes': attrs,
+				}
+
+			attributes = OrderedDict()
+			for key in first.ncattrs():
+				attributes[key] = jsonable(first.getncattr(key))
+
+		finally:
+			first.close()
+
+		# The time values of the aggregation dimension are held in the index
+		timevar = aggdim if aggdim in variables and variables[aggdim]['dimensions'] == [aggdim] else None
+		units = calendar = None
+		if timevar:
+			units = variables[timevar]['attributes'].get('units')
+			calendar = variables[timevar]['attributes'].get('calendar', 'standard')
+
+		members = []
+		for filename in filenames:
+
+			ncfile = netCDF4.Dataset(filename)
+
+			try:
+				members.append(cls.scan(ncfile, filename, aggdim, timevar=timevar, units=units, calendar=calendar))
+			finally:
+				ncfile.close()
+
+		# Order members along the aggregation dimension when we know their times
+		members.sort(key=lambda member: (member['start'] is None, member['start'], member['path']))
+
+		logger.info("built index of {} files aggregated along {}".format(len(members), aggdim))
+
+		return cls(aggdim, dimensions, variables, attributes, members, timevar=timevar)
+
+	def save(self, path=None):
+		"""Save the index as a JSON sidecar file"""
+
+		if path:
+			self.path = path
+
+		content = OrderedDict([
+			('version', self.version),
+			('aggdim', self.aggdim),
+			('timevar', self.timevar),
+			('dimensions', self.dimensions),
+			('attributes', self.attributes),
+			('variables', self.variables),
+			('members', self.members),
+		])
+
+		# Write to a temporary file and rename so readers never see a partial index
+		tmp = '{}.tmp{}'.format(self.path, os.getpid())
+		with open(tmp, 'w') as output:
+			json.dump(content, output)
+
+		os.rename(tmp, self.path)
+		self.dirty = False
+
+	@classmethod
+	def load(cls, path):
+		"""Load an index from a JSON sidecar file"""
+
+		with open(path) as source:
+			content = json.load(source, object_pairs_hook=OrderedDict)
+
+		if content.get('version') != cls.version:
+			raise MultiFileException("unsupported index version {} in {}".format(content.get('version'), path))
+
+		return cls(content['aggdim'], content['dimensions'], content['variables'], content['attributes'], content['members'], timevar=content['timevar'], path=path)
+
+	@classmethod
+	def open(cls, filenames, path, aggdim=None):
+		"""
+		Load the index at path if it describes exactly the given files, otherwise (re)build and save it.
+		Members modified since the index was saved are rescanned (see refresh) and the index saved again.
+		"""
+
+		filenames = [os.path.abspath(filename) for filename in filenames]
+
+		if os.path.exists(path):
+			try:
+				index = cls.load(path)
+			except (ValueError, KeyError, MultiFileException):
+				logger.warning("ignoring unreadable index {}".format(path))
+			else:
+				if set(index.filenames) == set(filenames) and (not aggdim or aggdim == index.aggdim):
+					if index.refresh():
+						index.save()
+					return index
+
+				logger.info("file list changed, rebuilding index {}".format(path))
+
+		index = cls.build(filenames, aggdim=aggdim)
+		index.save(path)
+
+		return index
+
+	def rescan(self, i, ncfile=None):
+		"""Return a new member record for member i, ncfile is the already open member file if there is one"""
+
+		member = self.members[i]
+
+		units = calendar = None
+		if self.timevar:
+			units = self.variables[self.timevar]['attributes'].get('units')
+			calendar = self.variables[self.timevar]['attributes'].get('calendar', 'standard')
+
+		if ncfile is not None:
+			return self.scan(ncfile, member['path'], self.aggdim, timevar=self.timevar, units=units, calendar=calendar)
+
+		source = netCDF4.Dataset(member['path'])
+		try:
+			return self.scan(source, member['path'], self.aggdim, timevar=self.timevar, units=units, calendar=calendar)
+		finally:
+			source.close()
+
+	def refresh(self):
+		"""
+		Rescan the members whose mtime has changed, unchanged members are only stat'ed.  A member that changed
+		size (typically the current file of a live archive being appended to) shifts the offsets of the
+		members after it, which are recalculated along with the size of the aggregation dimension.  Returns
+		True if any member changed.
+		"""
+
+		changed = False
+
+		for i, member in enumerate(self.members):
+			if os.path.getmtime(member['path']) == member['mtime']:
+				continue
+
+			updated = self.rescan(i)
+			if updated['size'] != member['size']:
+				logger.info("{} changed size along {} from {} to {}".format(member['path'], self.aggdim, member['size'], updated['size']))
+			else:
+				logger.info("{} modified".format(member['path']))
+
+			self.members[i] = updated
+			changed = True
+
+		if changed:
+			self._update_offsets()
+			self.dirty = True
+
+		return changed
+
+	def validate(self, i, ncfile=None):
+		"""
+		Check member i against its recorded mtime when it is first read, rescanning it if the file has changed
+		since the index was opened.  Values appended to a member since then lie beyond the shape the dataset
+		was opened with, so the member keeps its recorded size and the new values are picked up by the next
+		open (see refresh).  A member that shrank can't be read with the recorded offsets.  ncfile is the
+		already open member file if there is one.
+		"""
+
+		member = self.members[i]
+		mtime = os.path.getmtime(member['path'])
+
+		if mtime == member['mtime']:
+			return
+
+		updated = self.rescan(i, ncfile)
+
+		if updated['size'] < member['size']:
+			raise MultiFileException("{} shrank along {} from {} to {}, index {} must be rebuilt".format(member['path'], self.aggdim, member['size'], updated['size'], self.path))
+
+		if updated['size'] > member['size']:
+			logger.info("{} grew along {} since it was opened, the new values are read from the next open".format(member['path'], self.aggdim))
+			return
+
+		logger.info("{} modified, updating index".format(member['path']))
+
+		updated['offset'] = member['offset']
+		self.members[i] = updated
+		self.dirty = True
+
+		if self.path:
+			self.save()
+
+	def times(self):
+		"""Return the aggregated time values recorded in the index"""
+
+		values = []
+		for member in self.members:
+			values.extend(member['time'])
+
+		return np.array(values, dtype=np.float64)
+
+	def locate(self, positions):
+		"""Return the member index for each position along the aggregation dimension"""
+		return np.searchsorted(self.starts, positions, side='right') - 1
+
+
+class MultiFileDimension(object):
+	"""
+	Minimal stand in for netCDF4.Dimension
+	"""
+
+	def __init__(self, name, size, unlimited):
+		self.name = name
+		self.size = size
+		self._unlimited = unlimited
+
+	def __len__(self):
+		return self.size
+
+	def isunlimited(self):
+		return self._unlimited
+
+
+class MultiFileVariable(object):
+	"""
+	Stand in for netCDF4.Variable that reads hyperslabs from the member files of a MultiFileDataset
+	"""
+
+	def __init__(self, name, dataset):
+
+		self.name = name
+		self.dataset = dataset
+
+		spec = dataset.index.variables[name]
+		self.dimensions = tuple(spec['dimensions'])
+		self.dtype = dtype_from_name(spec['dtype'])
+		self._attributes = spec['attributes']
+		self.shape = tuple([dataset.index.dimensions[dim]['size'] for dim in self.dimensions])
+
+		if dataset.index.aggdim in self.dimensions:
+			self.axis = self.dimensions.index(dataset.index.aggdim)
+		else:
+			self.axis = None
+
+	def ncattrs(self):
+		return list(self._attributes.keys())
+
+	def getncattr(self, key):
+		return self._attributes[key]
+
+	def __getattr__(self, key):
+		try:
+			return self.__dict__['_attributes'][key]
+		except KeyError:
+			raise AttributeError(key)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def chunking(self):
+		"""Storage chunking of the first member file"""
+		return self.dataset.member(0).variables[self.name].chunking()
+
+	def set_var_chunk_cache(self, size=None, nelems=None, preemption=None):
+		"""Set the chunk cache of the variable in every member file opened from now on (and already open)"""
+
+		self.dataset.chunk_cache[self.name] = {'size': size, 'nelems': nelems, 'preemption': preemption}
+
+		for ncfile in self.dataset._open.values():
+			ncfile.variables[self.name].set_var_chunk_cache(size=size, nelems=nelems, preemption=preemption)
+
+	def _normalize(self, indices):
+		"""Return indices as a full length list"""
+
+		if type(indices) != tuple:
+			indices = (indices,)
+
+		indices = list(indices)
+
+		ellipsis = [i for i in range(len(indices)) if indices[i] is Ellipsis]
+		if ellipsis:
+			i = ellipsis[0]
+			indices[i:i+1] = [slice(None)] * (len(self.shape) - len(indices) + 1)
+
+		indices.extend([slice(None)] * (len(self.shape) - len(indices)))
+
+		return indices
+
+	def __getitem__(self, indices):
+
+		index = self.dataset.index
+		indices = self._normalize(indices)
+
+		# Variables that are not aggregated come from the first member
+		if self.axis is None:
+			raw = self.dataset.member(0).variables[self.name][tuple(indices)]
+			return unpack(raw, self._attributes, self.dtype)
+
+		# The time values are held by the index so no files need to be opened
+		if self.name == index.timevar:
+			values = np.ma.masked_array(index.times())
+			return values[indices[0]]
+
+		# Work out the positions along the aggregation dimension
+		select = indices[self.axis]
+		squeeze = False
+
+		if isinstance(select, slice):
+			positions = np.arange(*select.indices(self.shape[self.axis]))
+		elif isinstance(select, (int, long, np.integer)):
+			if select < 0:
+				select += self.shape[self.axis]
+			positions = np.array([select])
+			squeeze = True
+		else:
+			positions = np.asarray(select)
+			if positions.dtype == bool:
+				positions = positions.nonzero()[0]
+			positions = np.where(positions < 0, positions + self.shape[self.axis], positions)
+
+		# Integer indices before the aggregation axis remove dimensions from the result
+		outaxis = self.axis - len([i for i in indices[:self.axis] if isinstance(i, (int, long, np.integer))])
+
+		pieces = [self._piece(member, local, indices, squeeze, outaxis) for member, local in self._runs(positions)]
+
+		if not pieces:
+			empty = list(indices)
+			empty[self.axis] = slice(0, 0)
+			pieces = [self._piece(0, None, empty, False, outaxis)]
+
+		raw = self.dataset.read(pieces)
+
+		if len(raw) == 1:
+			raw = raw[0]
+		else:
+			raw = np.concatenate(raw, axis=outaxis)
+
+		return unpack(raw, self._attributes, self.dtype)
+
+	def _runs(self, positions):
+		"""Split positions into (member, local positions) runs of consecutive positions in the same member"""
+
+		index = self.dataset.index
+
+		if not len(positions):
+			return []
+
+		members = index.locate(positions)
+		breaks = np.nonzero(np.diff(members))[0] + 1
+
+		runs = []
+		for chunk_members, chunk_positions in zip(np.split(members, breaks), np.split(positions, breaks)):
+			member = int(chunk_members[0])
+			runs.append((member, chunk_positions - index.starts[member]))
+
+		return runs
+
+	def _piece(self, member, local, indices, squeeze, outaxis):
+		"""
+		Describe the read of one run of local positions from a member file, see read_piece
+		"""
+
+		indices = list(indices)
+		path = self.dataset.index.members[member]['path']
+
+		if local is None:
+			return (path, self.name, tuple(indices), None, outaxis)
+
+		if squeeze:
+			indices[self.axis] = int(local[0])
+			return (path, self.name, tuple(indices), None, outaxis)
+
+		# Contiguous runs are read as a slice, anything else as the enclosing slice and then taken
+		first, last = int(local.min()), int(local.max())
+		indices[self.axis] = slice(first, last+1)
+
+		if last - first + 1 == len(local) and (np.diff(local) > 0).all():
+			return (path, self.name, tuple(indices), None, outaxis)
+
+		return (path, self.name, tuple(indices), local - first, outaxis)
+
+
+class MultiFileDataset(object):
+	"""
+	Stand in for netCDF4.MFDataset backed by a MultiFileIndex.  Opening is quick when the index already
+	exists, the member files are only stat'ed (and just the modified ones rescanned) and are opened when their
+	data is read.  Unlike MFDataset any NetCDF format is accepted and the aggregation dimension does not need
+	to be unlimited.
+
+	With workers > 1, reads that span several member files are split into one piece per file and the pieces
+	are read in parallel by a pool of processes (or threads, which is only safe if the underlying NetCDF/HDF5
+	libraries are built thread safe).
+	"""
+
+	# Maximum number of member files held open at once
+	max_open = 32
+
+	def __init__(self, filenames, index=None, aggdim=None, workers=1, pool='process'):
+		"""
+		filenames: list of member filenames
+		index: path of the JSON sidecar index, created if it doesn't exist
+		aggdim: name of the aggregation dimension, defaults to the unlimited dimension
+		workers: number of parallel readers
+		pool: 'process' or 'thread'
+		"""
+
+		if index:
+			self.index = MultiFileIndex.open(filenames, index, aggdim=aggdim)
+		else:
+			self.index = MultiFileIndex.build(filenames, aggdim=aggdim)
+
+		self._open = OrderedDict()
+		self._validated = set()
+
+		# Chunk cache settings for each variable, applied as member files are opened
+		self.chunk_cache = {}
+
+		self.workers = workers
+		self.pooltype = pool
+		self._pool = None
+
+		self.dimensions = OrderedDict()
+		for name, dim in self.index.dimensions.items():
+			self.dimensions[name] = MultiFileDimension(name, dim['size'], dim['unlimited'])
+
+		self.variables = OrderedDict()
+		for name in self.index.variables.keys():
+			self.variables[name] = MultiFileVariable(name, self)
+
+	def ncattrs(self):
+		return list(self.index.attributes.keys())
+
+	def getncattr(self, key):
+		return self.index.attributes[key]
+
+	def member(self, i):
+		"""Return the open netCDF4.Dataset for member i, opening and validating it if needed"""
+
+		if i in self._open:
+			ncfile = self._open.pop(i)
+			self._open[i] = ncfile
+			return ncfile
+
+		ncfile = netCDF4.Dataset(self.index.members[i]['path'])
+		ncfile.set_auto_maskandscale(False)
+
+		for name, settings in self.chunk_cache.items():
+			ncfile.variables[name].set_var_chunk_cache(**settings)
+
+		if i not in self._validated:
+			self.index.validate(i, ncfile)
+			self._validated.add(i)
+
+		self._open[i] = ncfile
+
+		# Keep the number of open files bounded
+		while len(self._open) > self.max_open:
+			oldest = next(iter(self._open))
+			self._open.pop(oldest).close()
+
+		return ncfile
+
+	@property
+	def pool(self):
+		"""The reader pool, created on first use"""
+
+		if self._pool is None:
+			if self.pooltype == 'thread':
+				from multiprocessing.pool import ThreadPool
+				self._pool = ThreadPool(self.workers)
+			else:
+				from multiprocessing import Pool
+				self._pool = Pool(self.workers)
+
+		return self._pool
+
+	def read(self, pieces):
+		"""
+		Read a list of pieces (see read_piece) returning a list of raw arrays in the same order.  Several
+		pieces are read in parallel when we have more than one worker.
+		"""
+
+		members = self.index.positions
+
+		# Members are validated lazily the first time they are read
+		for piece in pieces:
+			i = members[piece[0]]
+			if i not in self._validated:
+				self.index.validate(i, self._open.get(i))
+				self._validated.add(i)
+
+		if self.workers > 1 and len(pieces) > 1:
+			return self.pool.map(read_piece, pieces)
+
+		result = []
+		for path, name, indices, take, axis in pieces:
+			data = np.asarray(self.member(members[path]).variables[name][indices])
+			if take is not None:
+				data = np.take(data, take, axis=axis)
+			result.append(data)
+
+		return result
+
+	def close(self):
+
+		for ncfile in self._open.values():
+			ncfile.close()
+
+		self._open = OrderedDict()
+
+		if self._pool is not None:
+			self._pool.close()
+			self._pool.join()
+			self._pool = None
+
+	def __repr__(self):
+		return "<{}: {} files along {}>".format(self.__class__.__name__, len(self.index.members), self.index.aggdim)
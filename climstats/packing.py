@@ -0,0 +1,94 @@
+"""
+CF packing of stored values.  unpack turns raw stored values into masked (and unpacked) values for the
+readers that don't go through the NetCDF library, and pack and pack_parameters pack values into small
+integer types with scale_factor and add_offset for the writers (see dataset.NetCDF4Writer and
+chunkstore.ChunkStoreWriter).
+"""
+
+import numpy as np
+import netCDF4
+
+
+def unpack(data, attributes, dtype):
+	"""
+	Apply CF masking (_FillValue, missing_value, valid_min/max/range) and scale_factor/add_offset packing to
+	raw values, for the readers of multi-file aggregations and chunk stores that read values raw.
+	"""
+
+	if dtype == str or data.dtype.kind not in 'fiu':
+		return data
+
+	data = np.asarray(data)
+	mask = np.zeros(data.shape, dtype=bool)
+
+	# Without an explicit _FillValue, NetCDF masks the default fill value for the type
+	fill = attributes.get('_FillValue')
+	if fill is None and data.dtype.itemsize > 1:
+		fill = netCDF4.default_fillvals.get(data.dtype.str[1:])
+
+	missing = attributes.get('missing_value')
+	missing = [] if missing is None else list(np.atleast_1d(missing))
+
+	for value in [fill] + missing:
+		if value is not None:
+			mask |= (data == value)
+
+	valid_range = attributes.get('valid_range')
+	valid_min, valid_max = attributes.get('valid_min'), attributes.get('valid_max')
+	if valid_range is not None:
+		valid_min, valid_max = valid_range
+
+	if valid_min is not None:
+		mask |= (data < valid_min)
+	if valid_max is not None:
+		mask |= (data > valid_max)
+
+	scale = attributes.get('scale_factor')
+	offset = attributes.get('add_offset')
+
+	if scale is not None or offset is not None:
+		packed = np.float32 if data.dtype.itemsize <= 2 else np.float64
+		data = data.astype(np.result_type(packed, np.asarray(scale if scale is not None else 1.0).dtype))
+		if scale is not None:
+			data *= scale
+		if offset is not None:
+			data += offset
+
+	return np.ma.masked_array(data, mask=mask)
+
+
+# Packed types with their fill value and the range of values available for data
+types = {
+	'int16': (np.int16, -32768, -32767, 32767),
+	'int8': (np.int8, -128, -127, 127),
+}
+
+
+def pack_parameters(values, pack):
+	"""
+	Work out scale_factor and add_offset to pack values into the given packed type from their data range
+	"""
+
+	dtype, fill, low, high = types[pack]
+
+	if not np.ma.count(values):
+		return 1.0, 0.0
+
+	vmin, vmax = values.min(), values.max()
+
+	scale_factor = float(vmax - vmin) / (high - low) if vmax > vmin else 1.0
+	add_offset = float(vmin) - low * scale_factor
+
+	return scale_factor, add_offset
+
+
+def pack(values, scale_factor, add_offset, dtype):
+	"""
+	Inverse of the scale_factor/add_offset part of unpack.  Masked values stay masked and the lowest value of
+	the type is left free for the fill value.
+	"""
+
+	info = np.iinfo(dtype)
+	packed = np.ma.round((np.ma.asarray(values, dtype=np.float64) - add_offset) / scale_factor)
+
+	return np.ma.clip(packed, info.min + 1, info.max).astype(dtype)
@@ -0,0 +1,137 @@
+"""
+Background prefetching of reads so that I/O (and decompression) of the next group or block overlaps with
+computation on the current one.
+"""
+
+import sys
+import threading
+import logging
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher(object):
+	"""
+	Iterates over (key, read(key)) for a sequence of keys.  With depth > 0 a background thread reads up to
+	depth items ahead into a bounded buffer while the caller works on the current item.  With depth == 0
+	items are simply read in turn.
+
+	memory is a soft cap on the bytes read ahead.  The size of an item is only known once it has been read,
+	so the reader waits for room before queueing an item rather than before reading it, and up to memory
+	plus one item can be held.  At least one item is always allowed so a single large item can't stall the
+	reader.
+
+	read runs on the background thread while the caller works on the main one, so a library that isn't thread
+	safe (such as NetCDF/HDF5) must be used under a lock by both, see dataset.netcdf_lock.
+	"""
+
+	# Marks the end of the items in the buffer
+	_done = object()
+
+	def __init__(self, read, keys, depth=1, memory=None):
+		"""
+		read: callable returning the data for a key
+		keys: iterable of keys
+		depth: number of items to read ahead
+		memory: soft limit on the number of bytes held in the buffer (None for no limit)
+		"""
+
+		self.read = read
+		self.keys = keys
+		self.depth = depth
+		self.memory = memory
+
+		self._buffered = 0
+		self._condition = threading.Condition()
+		self._stop = False
+		self._thread = None
+
+	def _size(self, data):
+		return getattr(data, 'nbytes', 0)
+
+	def _run(self):
+
+		try:
+			for key in self.keys:
+
+				data = self.read(key)
+				size = self._size(data)
+
+				# Wait for room under the memory cap
+				with self._condition:
+					while self.memory and self._buffered and self._buffered + size > self.memory and not self._stop:
+						self._condition.wait(0.1)
+
+					if self._stop:
+						return
+
+					self._buffered += size
+
+				self._queue.put((key, data, None))
+
+				if self._stop:
+					return
+
+		except:
+			self._queue.put((None, None, sys.exc_info()))
+			return
+
+		self._queue.put((self._done, None, None))
+
+	def __iter__(self):
+
+		# Nothing to overlap, just read in turn
+		if not self.depth:
+			for key in self.keys:
+				yield key, self.read(key)
+			return
+
+		self._queue = queue.Queue(maxsize=self.depth)
+		self._thread = threading.Thread(target=self._run, name='prefetch')
+		self._thread.daemon = True
+		self._thread.start()
+
+		try:
+			while True:
+				key, data, error = self._queue.get()
+
+				if error:
+					raise error[0], error[1], error[2]
+
+				if key is self._done:
+					break
+
+				with self._condition:
+					self._buffered -= self._size(data)
+					self._condition.notify()
+
+				yield key, data
+
+		finally:
+			self.close()
+
+	def close(self):
+		"""Stop the background reader, discarding anything already read"""
+
+		if self._thread is None:
+			return
+
+		self._stop = True
+
+		with self._condition:
+			self._condition.notify_all()
+
+		# Drain the buffer so a blocked reader can finish
+		while self._thread.is_alive():
+			try:
+				self._queue.get(timeout=0.1)
+			except queue.Empty:
+				pass
+
+		self._thread = None
@@ -0,0 +1,202 @@
+"""
+Disk backed masked arrays.  A ScratchArray keeps its values and its mask in two np.memmap files in a scratch
+directory so that variables larger than memory can be assembled and written out without swapping.  Only the
+pages actually touched are held in memory, and because the data lives in files a ScratchArray can be passed
+to worker processes (it pickles to its filenames) without copying.
+"""
+
+import os
+import tempfile
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class ScratchArray(object):
+	"""
+	A masked array backed by memory mapped data and mask files.  Indexing returns np.ma.MaskedArray views of
+	the mapped files, assignment accepts anything np.ma.masked_array would.  The files are removed when the
+	array that created them is closed or garbage collected, copies unpickled in other processes only map them.
+	"""
+
+	def __init__(self, shape, dtype=np.float32, directory=None, fill_value=None):
+		"""
+		shape: shape of the array, dimensions may be zero length
+		dtype: numpy data type of the values
+		directory: scratch directory for the files, defaults to the system temporary directory
+		fill_value: fill value of the masked arrays returned
+		"""
+
+		self.directory = directory
+		self.dtype = np.dtype(dtype)
+		self.fill_value = fill_value
+
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+
+		self.filenames = (self._tempfile('data'), self._tempfile('mask'))
+		self._owner = True
+
+		self._map(tuple(shape), 'w+')
+
+	def _tempfile(self, suffix):
+		handle, filename = tempfile.mkstemp(prefix='climstats_', suffix='.' + suffix, dir=self.directory)
+		os.close(handle)
+		return filename
+
+	def _map(self, shape, mode):
+		"""(Re)map the files with the given shape, files are grown as needed"""
+
+		self._shape = shape
+
+		# Zero sized arrays can't be mapped so they live in memory until they grow
+		if not int(np.prod(shape)):
+			self.data = np.empty(shape, dtype=self.dtype)
+			self.mask = np.zeros(shape, dtype=bool)
+			return
+
+		self.data = np.memmap(self.filenames[0], dtype=self.dtype, mode=mode, shape=shape)
+		self.mask = np.memmap(self.filenames[1], dtype=bool, mode=mode, shape=shape)
+
+	@property
+	def shape(self):
+		return self._shape
+
+	@property
+	def ndim(self):
+		return len(self._shape)
+
+	@property
+	def size(self):
+		return int(np.prod(self._shape))
+
+	@property
+	def nbytes(self):
+		return self.size * self.dtype.itemsize
+
+	def __len__(self):
+		return self._shape[0]
+
+	def __getitem__(self, indices):
+		return np.ma.masked_array(self.data[indices], mask=self.mask[indices], fill_value=self.fill_value)
+
+	def __setitem__(self, indices, value):
+		self.data[indices] = np.ma.getdata(value)
+		self.mask[indices] = np.ma.getmaskarray(value)
+
+	def __array__(self, dtype=None):
+		return np.asarray(self.data, dtype=dtype)
+
+	def filled(self, fill_value=None):
+		return self[...].filled(fill_value)
+
+	def resize(self, newshape, refcheck=False):
+		"""
+		Change the shape of the array keeping the values that lie within both shapes, new values are masked.
+		Growing only the leading dimension just extends the files, anything else is copied into new files one
+		leading index at a time.
+		"""
+
+		newshape = tuple(newshape)
+		oldshape = self._shape
+
+		if newshape == oldshape:
+			return
+
+		self.flush()
+
+		if len(newshape) == len(oldshape) and newshape[1:] == oldshape[1:] and int(np.prod(oldshape)):
+
+			# C order means the existing values keep their place when only the leading dimension changes
+			olddata, oldmask = self.data, self.mask
+			self.data = self.mask = None
+			del olddata, oldmask
+
+			for filename, itemsize in zip(self.filenames, [self.dtype.itemsize, 1]):
+				with open(filename, 'r+b') as scratchfile:
+					scratchfile.truncate(int(np.prod(newshape)) * itemsize)
+
+			self._map(newshape, 'r+')
+
+			if newshape[0] > oldshape[0]:
+				self.mask[oldshape[0]:] = True
+
+			return
+
+		# Otherwise copy the overlapping values into new files
+		old = ScratchArray(newshape, self.dtype, self.directory, self.fill_value)
+		old.filenames, self.filenames = self.filenames, old.filenames
+		old.data, self.data = self.data, old.data
+		old.mask, self.mask = self.mask, old.mask
+		old._shape, self._shape = self._shape, old._shape
+
+		self.mask[...] = True
+
+		overlap = [slice(0, min(a, b)) for a, b in zip(oldshape, newshape)]
+		if len(oldshape) == len(newshape) and int(np.prod([s.stop for s in overlap])):
+			for i in range(overlap[0].stop):
+				indices = tuple([i] + overlap[1:])
+				self.data[indices] = old.data[indices]
+				self.mask[indices] = old.mask[indices]
+
+		old.close()
+
+	def copy(self):
+		"""Return a new ScratchArray (in the same scratch directory) holding a copy of the values"""
+
+		new = ScratchArray(self._shape, self.dtype, self.directory, self.fill_value)
+
+		if self.size:
+			for i in range(self._shape[0]):
+				new.data[i] = self.data[i]
+				new.mask[i] = self.mask[i]
+
+		return new
+
+	def flush(self):
+		"""Flush changes to the files"""
+
+		for array in (self.data, self.mask):
+			if isinstance(array, np.memmap):
+				array.flush()
+
+	def close(self):
+		"""Unmap the files and remove them if this array created them"""
+
+		self.data = self.mask = None
+
+		if self._owner:
+			for filename in self.filenames:
+				try:
+					os.remove(filename)
+				except OSError:
+					pass
+
+			self._owner = False
+
+	def __del__(self):
+		try:
+			self.close()
+		except Exception:
+			pass
+
+	def __getstate__(self):
+		"""Pickle as the filenames so workers map the same files rather than copying the values"""
+
+		self.flush()
+
+		state = dict(self.__dict__)
+		state['data'] = state['mask'] = None
+		state['_owner'] = False
+
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._map(self._shape, 'r+')
+
+	def __repr__(self):
+		return "<{}: {} {} in {}>".format(self.__class__.__name__, self._shape, self.dtype, self.filenames[0])
@@ -0,0 +1,488 @@
+"""
+A long running statistics service.  Opening a dataset, classifying its coordinates and grouping a variable
+cost more than many statistics themselves, so the service keeps datasets open (with their coordinates in
+memory), keeps the groupings of recently used variables and keeps recent results within a memory budget.
+Requests are JSON over HTTP on localhost or on a Unix socket:
+
+	POST /statistic
+	{
+		"source": "/data/pr_*.nc",
+		"variable": "pr",
+		"aggregation": "time.yearmonth",
+		"statistic": "total",
+		"subset": {"latitude": [-35, -20], "time": ["1981-01-01", "1990-12-31"]},
+		"params": {"above": 1.0},
+		"format": "json"
+	}
+
+source, variable, aggregation and statistic are required.  The optional index, subset, scale, offset,
+tolerance, above, below and params are as for bin/climstats and format is json (the default) or netcdf.
+
+	GET /health      liveness check
+	GET /stats       cache and request counters
+
+The NetCDF library isn't thread safe so computations run one at a time, concurrency limits how many
+requests may be computing or waiting to compute and any more are refused with 503 (Service Unavailable).
+Cached results are returned without waiting.
+"""
+
+import os
+import sys
+import glob
+import json
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+
+try:
+	import BaseHTTPServer as server
+	import SocketServer as socketserver
+except ImportError:
+	import http.server as server
+	import socketserver
+
+import numpy as np
+import netCDF4
+
+import dataset
+import functions
+import grouping
+import batch
+
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceException(Exception):
+	"""
+	A request that can't be served, status is the HTTP status returned
+	"""
+
+	def __init__(self, value, status=400):
+		self.value = value
+		self.status = status
+
+	def __str__(self):
+		return repr(self.value)
+
+
+class LRUCache(object):
+	"""
+	A thread safe least recently used cache limited to a number of bytes (sizes are given when items are
+	added) and/or a number of entries.  evict is called with each value that is dropped.
+	"""
+
+	def __init__(self, budget=None, entries=None, evict=None):
+
+		self.budget = budget
+		self.entries = entries
+		self.evict = evict
+
+		self._items = OrderedDict()
+		self._lock = threading.Lock()
+
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+
+		with self._lock:
+			if key in self._items:
+				value, size = self._items.pop(key)
+				self._items[key] = (value, size)
+				self.hits += 1
+				return value
+
+			self.misses += 1
+			return None
+
+	def put(self, key, value, size=0):
+
+		evicted = []
+
+		with self._lock:
+			if key in self._items:
+				self.bytes -= self._items.pop(key)[1]
+
+			# Items bigger than the whole budget aren't kept
+			if self.budget is not None and size > self.budget:
+				return
+
+			self._items[key] = (value, size)
+			self.bytes += size
+
+			while len(self._items) > 1 and ((self.budget is not None and self.bytes > self.budget) or (self.entries and len(self._items) > self.entries)):
+				oldkey, (oldvalue, oldsize) = self._items.popitem(last=False)
+				self.bytes -= oldsize
+				evicted.append(oldvalue)
+
+		if self.evict:
+			for value in evicted:
+				self.evict(value)
+
+	def clear(self):
+
+		with self._lock:
+			values = [value for value, size in self._items.values()]
+			self._items.clear()
+			self.bytes = 0
+
+		if self.evict:
+			for value in values:
+				self.evict(value)
+
+	def __len__(self):
+		return len(self._items)
+
+	def stats(self):
+		return {'entries': len(self._items), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+def result_json(ds, name):
+	"""Encode the result variable name of ds and its coordinates as JSON, masked values are null"""
+
+	variable = ds.variables[name]
+
+	def values(data):
+		values = np.array(np.ma.getdata(data), dtype=object)
+		values[np.ma.getmaskarray(data)] = None
+		return values.tolist()
+
+	coords = OrderedDict()
+	for coordname, coord in variable.coords.items():
+		entry = {
+			'name': coord.name,
+			'dimensions': [dim.name for dim in coord.dimensions],
+			'units': coord.attributes.get('units'),
+			'values': values(coord[:]),
+		}
+
+		# Times are also given as ISO dates
+		if coordname == 'time' and 'units' in coord.attributes:
+			dates = netCDF4.num2date(np.ma.getdata(coord[:]), coord.attributes['units'], coord.attributes.get('calendar', 'standard'))
+			entry['dates'] = [date.isoformat() for date in np.ravel(dates)]
+
+		coords[coordname] = entry
+
+	content = OrderedDict([
+		('variable', name),
+		('dimensions', [dim.name for dim in variable.dimensions]),
+		('shape', list(variable.shape)),
+		('attributes', dict([(key, np.asarray(value).tolist()) for key, value in variable.attributes.items()])),
+		('coords', coords),
+		('data', values(variable[:])),
+	])
+
+	return json.dumps(content)
+
+
+def result_netcdf(ds):
+	"""Encode ds as the bytes of a NetCDF file"""
+
+	handle, filename = tempfile.mkstemp(prefix='climstats_', suffix='.nc')
+	os.close(handle)
+
+	try:
+		dataset.NetCDF4Dataset.write(ds, filename)
+		with open(filename, 'rb') as ncfile:
+			return ncfile.read()
+	finally:
+		os.remove(filename)
+
+
+class Service(object):
+	"""
+	Computes and caches statistics requests.  Datasets are kept open (up to datasets of them), each with the
+	groupings of up to groupings recently used (variable, subset, aggregation) combinations, and encoded
+	results are kept up to memory bytes.
+	"""
+
+	formats = {'json': 'application/json', 'netcdf': 'application/x-netcdf'}
+
+	def __init__(self, datasets=8, groupings=32, memory=256 * 1024 * 1024, concurrency=2, workers=1):
+
+		self.groupings = groupings
+		self.workers = workers
+
+		self.datasets = LRUCache(entries=datasets, evict=self._close)
+		self.results = LRUCache(budget=memory)
+
+		# Computations are serialised on the NetCDF library, _slots bounds how many may queue for it
+		self._compute = threading.Lock()
+		self._slots = threading.Semaphore(concurrency)
+
+		self.counters = {'requests': 0, 'computed': 0, 'cached': 0, 'refused': 0, 'failed': 0}
+		self._counters = threading.Lock()
+
+	def _count(self, name):
+		with self._counters:
+			self.counters[name] += 1
+
+	def _close(self, entry):
+		try:
+			entry['dataset'].close()
+		except Exception:
+			pass
+
+	def validate(self, request):
+		"""Check a request and fill in its defaults"""
+
+		if not isinstance(request, dict):
+			raise ServiceException("request must be a JSON object")
+
+		missing = [key for key in ['source', 'variable', 'aggregation', 'statistic'] if not request.get(key)]
+		if missing:
+			raise ServiceException("missing {}".format(', '.join(missing)))
+
+		request = dict(request)
+		for key, default in [('index', None), ('subset', {}), ('scale', 1.0), ('offset', 0.0), ('tolerance', 1.0), ('above', None), ('below', None), ('params', {}), ('format', 'json')]:
+			if request.get(key) is None:
+				request[key] = default
+
+		# Wrongly typed values would otherwise fail deep inside the computation
+		for key in ['source', 'variable', 'aggregation', 'statistic', 'format']:
+			if not isinstance(request[key], basestring):
+				raise ServiceException("{} must be a string".format(key))
+
+		if request['index'] is not None and not isinstance(request['index'], basestring):
+			raise ServiceException("index must be a string")
+
+		for key in ['subset', 'params']:
+			if not isinstance(request[key], dict):
+				raise ServiceException("{} must be an object".format(key))
+
+		for key in ['scale', 'offset', 'tolerance']:
+			if isinstance(request[key], bool) or not isinstance(request[key], (int, long, float)):
+				raise ServiceException("{} must be a number".format(key))
+
+		if request['statistic'] not in functions.registry:
+			raise ServiceException("unknown statistic {}".format(request['statistic']))
+
+		parts = request['aggregation'].split('.')
+		if len(parts) != 2 or not all(parts):
+			raise ServiceException("aggregation {} is not of the form coordinate.grouping".format(request['aggregation']))
+
+		if not callable(getattr(grouping, parts[1], None)):
+			raise ServiceException("unknown grouping {}".format(parts[1]))
+
+		if request['format'] not in self.formats:
+			raise ServiceException("unknown format {}, use one of {}".format(request['format'], ', '.join(sorted(self.formats))))
+
+		return request
+
+	def files(self, request):
+		"""
+		The source files of a request with their modification times, changed files then get new dataset and
+		result cache entries
+		"""
+
+		filenames = sorted(glob.glob(request['source']))
+		if not filenames:
+			raise ServiceException("no files match {}".format(request['source']), status=404)
+
+		return tuple([(filename, os.path.getmtime(filename)) for filename in filenames])
+
+	def open(self, files, index):
+		"""The cache entry of an open dataset, opened if it isn't already"""
+
+		key = (files, index)
+		entry = self.datasets.get(key)
+
+		if entry is None:
+			logger.info("opening {} files from {}".format(len(files), files[0][0]))
+			ds = dataset.NetCDF4Dataset([filename for filename, mtime in files], index=index, workers=self.workers)
+			entry = {'dataset': ds, 'groups': LRUCache(entries=self.groupings)}
+			self.datasets.put(key, entry)
+
+		return entry
+
+	def groups(self, entry, request):
+		"""The grouping (and threshold cache) of the subset variable, grouped if it isn't already"""
+
+		subset = dict([(name, tuple(value) if isinstance(value, list) else value) for name, value in request['subset'].items()])
+		key = (request['variable'], tuple(sorted(subset.items())), request['aggregation'])
+
+		grouped = entry['groups'].get(key)
+
+		if grouped is None:
+			try:
+				variable = entry['dataset'].variables[request['variable']]
+			except KeyError:
+				raise ServiceException("no variable {} in {}".format(request['variable'], request['source']), status=404)
+
+			if subset:
+				try:
+					variable = variable.subset(**subset)
+				except (ValueError, TypeError) as e:
+					raise ServiceException("can't subset {} by {}: {}".format(request['variable'], request['subset'], e))
+
+			coordinate = request['aggregation'].split('.')[0]
+			if coordinate not in variable.coords:
+				raise ServiceException("no coordinate {} for {}".format(coordinate, request['variable']), status=404)
+
+			grouped = {'groups': variable.groupby(request['aggregation']), 'variable': variable, 'thresholds': {}}
+			if grouped['groups'] is None:
+				raise ServiceException("can't group by {}".format(request['aggregation']))
+
+			entry['groups'].put(key, grouped)
+
+		return grouped
+
+	def compute(self, request, files):
+		"""Compute the result dataset of a request"""
+
+		entry = self.open(files, request['index'])
+		grouped = self.groups(entry, request)
+
+		params = dict(request['params'])
+		for name in ['above', 'below']:
+			if request[name] is not None:
+				params[name] = batch.threshold(grouped['variable'], request[name], request['scale'], request['offset'], grouped['thresholds'])
+
+		statistic = functions.registry[request['statistic']]
+
+		return grouped['groups'].apply(statistic['function'], name=request['variable'], outunits=statistic['units'],
+			tolerance=request['tolerance'], scale=request['scale'], offset=request['offset'], **params)
+
+	def handle(self, request):
+		"""Serve a statistic request, returns the content type and the encoded result"""
+
+		self._count('requests')
+
+		request = self.validate(request)
+		files = self.files(request)
+
+		key = (files, json.dumps(request, sort_keys=True))
+
+		body = self.results.get(key)
+		if body is not None:
+			self._count('cached')
+			return self.formats[request['format']], body
+
+		if not self._slots.acquire(False):
+			self._count('refused')
+			raise ServiceException("busy, try again later", status=503)
+
+		try:
+			with self._compute:
+
+				# Another request may have computed it while this one waited
+				body = self.results.get(key)
+
+				if body is None:
+					try:
+						result = self.compute(request, files)
+
+						if request['format'] == 'json':
+							body = result_json(result, request['variable'])
+						else:
+							body = result_netcdf(result)
+
+					except ServiceException:
+						raise
+
+					except Exception:
+						self._count('failed')
+						logger.exception("request failed")
+						raise ServiceException("{}: {}".format(sys.exc_info()[0].__name__, sys.exc_info()[1]), status=500)
+
+					self._count('computed')
+					self.results.put(key, body, len(body))
+
+		finally:
+			self._slots.release()
+
+		return self.formats[request['format']], body
+
+	def stats(self):
+
+		with self._counters:
+			counters = dict(self.counters)
+
+		counters['datasets'] = self.datasets.stats()
+		counters['results'] = self.results.stats()
+
+		return counters
+
+	def close(self):
+		self.results.clear()
+		self.datasets.clear()
+
+
+class Handler(server.BaseHTTPRequestHandler):
+	"""Maps the HTTP API onto the server's Service"""
+
+	def address_string(self):
+		# Unix socket clients have no address
+		return self.client_address[0] if self.client_address else 'local'
+
+	def log_message(self, format, *args):
+		logger.info("{} {}".format(self.address_string(), format % args))
+
+	def respond(self, status, content_type, body):
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def error(self, status, message):
+		self.respond(status, 'application/json', json.dumps({'error': message}))
+
+	def do_GET(self):
+
+		if self.path == '/health':
+			self.respond(200, 'application/json', json.dumps({'status': 'ok'}))
+		elif self.path == '/stats':
+			self.respond(200, 'application/json', json.dumps(self.server.service.stats()))
+		else:
+			self.error(404, "unknown path {}".format(self.path))
+
+	def do_POST(self):
+
+		if self.path != '/statistic':
+			return self.error(404, "unknown path {}".format(self.path))
+
+		try:
+			length = int(self.headers.get('Content-Length', 0))
+			request = json.loads(self.rfile.read(length))
+		except ValueError:
+			return self.error(400, "request is not valid JSON")
+
+		try:
+			content_type, body = self.server.service.handle(request)
+		except ServiceException as e:
+			return self.error(e.status, e.value)
+		except Exception:
+			logger.exception("error handling request")
+			return self.error(500, "{}: {}".format(sys.exc_info()[0].__name__, sys.exc_info()[1]))
+
+		self.respond(200, content_type, body)
+
+
+class HTTPServer(socketserver.ThreadingMixIn, server.HTTPServer):
+	daemon_threads = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+def serve(service, host='127.0.0.1', port=8642, path=None):
+	"""
+	Create the server for service listening on host:port, or on the Unix socket path.  Call serve_forever
+	on the result to start serving.
+	"""
+
+	if path:
+		if os.path.exists(path):
+			os.remove(path)
+		httpd = UnixHTTPServer(path, Handler)
+	else:
+		httpd = HTTPServer((host, port), Handler)
+
+	httpd.service = service
+
+	return httpd
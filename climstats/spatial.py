@@ -0,0 +1,233 @@
+"""
+Spatial lookups.  A PointIndex maps (latitude, longitude) points to the nearest cells of a grid, or the
+nearest features of a station dataset, in one vectorized query.  Rectilinear grids (one dimensional latitude
+and longitude coordinates on different dimensions) are searched per axis, with a direct calculation when the
+spacing is regular.  Curvilinear grids and station coordinates are searched with a KD-tree of points on the
+unit sphere (scipy's cKDTree, or a blockwise brute force search without scipy).
+
+	index = spatial.PointIndex(latitudes, longitudes, dimensions)
+	cells, distances = index.query([-33.9, -26.2], [18.4, 28.0])
+"""
+
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+# Mean earth radius in km
+radius = 6371.0
+
+# Points per block of the brute force nearest neighbour search
+brute_block = 256
+
+
+def haversine(lat1, lon1, lat2, lon2):
+	"""Great circle distances in km between arrays of points given in degrees"""
+
+	lat1, lon1, lat2, lon2 = [np.radians(np.asarray(value, dtype=np.float64)) for value in (lat1, lon1, lat2, lon2)]
+
+	a = np.sin((lat2 - lat1) / 2.0)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0)**2
+
+	return 2.0 * radius * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def xyz(latitudes, longitudes):
+	"""Points on the unit sphere as an (n, 3) array"""
+
+	lat = np.radians(np.asarray(latitudes, dtype=np.float64).ravel())
+	lon = np.radians(np.asarray(longitudes, dtype=np.float64).ravel())
+
+	return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def nearest(coordinate, values):
+	"""
+	Indices of the nearest values of a one dimensional coordinate (in any order), with a direct calculation
+	for regularly spaced coordinates
+	"""
+
+	coordinate = np.asarray(coordinate, dtype=np.float64)
+	values = np.asarray(values, dtype=np.float64)
+
+	if len(coordinate) == 1:
+		return np.zeros(values.shape, dtype=np.int64)
+
+	step = np.diff(coordinate)
+	if np.allclose(step, step[0], rtol=1e-5, atol=0.0) and step[0] != 0:
+		return np.clip(np.rint((values - coordinate[0]) / step[0]), 0, len(coordinate) - 1).astype(np.int64)
+
+	order = np.argsort(coordinate, kind='mergesort')
+	ordered = coordinate[order]
+
+	position = np.clip(np.searchsorted(ordered, values), 1, len(ordered) - 1)
+	position -= (values - ordered[position - 1]) < (ordered[position] - values)
+
+	return order[position]
+
+
+class PointIndex(object):
+	"""
+	Maps points to the nearest cells of latitude and longitude coordinates.  latitudes and longitudes are the
+	coordinate values and dimensions the names of the dimensions of each of them, which decides how they
+	are searched (see the module documentation).  The spatial dimensions of the index are in the order they
+	first appear.
+	"""
+
+	def __init__(self, latitudes, longitudes, dimensions):
+		"""
+		latitudes, longitudes: coordinate values, one or two dimensional
+		dimensions: (latitude dimension names, longitude dimension names)
+		"""
+
+		self.latitudes = np.ma.filled(np.ma.asarray(latitudes, dtype=np.float64), np.nan)
+		self.longitudes = np.ma.filled(np.ma.asarray(longitudes, dtype=np.float64), np.nan)
+
+		latdims, londims = [list(dims) for dims in dimensions]
+
+		self.dimensions = []
+		for name in latdims + londims:
+			if name not in self.dimensions:
+				self.dimensions.append(name)
+
+		self.rectilinear = len(latdims) == 1 and len(londims) == 1 and latdims != londims
+		self._tree = None
+
+		if self.rectilinear:
+			self.shape = (len(self.latitudes), len(self.longitudes))
+
+			# Queries are wrapped to within 180 degrees of the middle of the grid longitudes
+			self._center = (np.nanmin(self.longitudes) + np.nanmax(self.longitudes)) / 2.0
+
+		else:
+			if self.latitudes.shape != self.longitudes.shape:
+				raise ValueError("latitude and longitude shapes {} and {} don't match".format(self.latitudes.shape, self.longitudes.shape))
+
+			self.shape = self.latitudes.shape
+			self._valid = np.flatnonzero(np.isfinite(self.latitudes.ravel()) & np.isfinite(self.longitudes.ravel()))
+			self._points = xyz(self.latitudes.ravel()[self._valid], self.longitudes.ravel()[self._valid])
+
+	def _search(self, points):
+		"""Nearest of the index points to each of points (on the unit sphere), as flat indices"""
+
+		if self._tree is None:
+			try:
+				from scipy.spatial import cKDTree
+			except ImportError:
+				self._tree = False
+			else:
+				self._tree = cKDTree(self._points)
+
+		if self._tree is not False:
+			return self._valid[self._tree.query(points)[1]]
+
+		result = np.empty(len(points), dtype=np.int64)
+		for start in range(0, len(points), brute_block):
+			block = points[start:start + brute_block]
+			result[start:start + brute_block] = np.argmax(np.dot(block, self._points.T), axis=1)
+
+		return self._valid[result]
+
+	def query(self, latitudes, longitudes, max_distance=None):
+		"""
+		Find the nearest cell to each point.  Returns a tuple with an index array for each of the spatial
+		dimensions and an array of the distances (in km) to the cell centres.  Points further than max_distance
+		km from their cell get index -1.
+		"""
+
+		latitudes = np.atleast_1d(np.asarray(latitudes, dtype=np.float64))
+		longitudes = np.atleast_1d(np.asarray(longitudes, dtype=np.float64))
+
+		if self.rectilinear:
+			longitudes = self._center - 180.0 + np.mod(longitudes - (self._center - 180.0), 360.0)
+
+			cells = (nearest(self.latitudes, latitudes), nearest(self.longitudes, longitudes))
+			distances = haversine(latitudes, longitudes, self.latitudes[cells[0]], self.longitudes[cells[1]])
+
+		else:
+			flat = self._search(xyz(latitudes, longitudes))
+			cells = np.unravel_index(flat, self.shape)
+			distances = haversine(latitudes, longitudes, self.latitudes.ravel()[flat], self.longitudes.ravel()[flat])
+
+		cells = tuple([np.asarray(cell, dtype=np.int64) for cell in cells])
+
+		if max_distance is not None:
+			far = distances > max_distance
+			for cell in cells:
+				cell[far] = -1
+
+		return cells, distances
+
+
+def locate_points(longitudes, latitudes, geometries):
+	"""
+	Find which of a list of shapely (multi)polygons contains each point.  Points are first culled with array
+	comparisons against the bounding boxes of the geometries, the remaining candidates are tested with
+	vectorized predicates where shapely has them (one STRtree query of all the points in shapely 2,
+	shapely.vectorized on prepared geometries in shapely 1) or else one at a time against the prepared
+	geometry.  Returns the index of the first geometry containing each point, -1 for points in none of them.
+	"""
+
+	import shapely
+	from shapely.prepared import prep
+
+	x = np.asarray(longitudes, dtype=np.float64).ravel()
+	y = np.asarray(latitudes, dtype=np.float64).ravel()
+
+	result = np.empty(len(x), dtype=np.int64)
+	result[:] = -1
+
+	if not len(geometries) or not len(x):
+		return result
+
+	bounds = np.array([geometry.bounds for geometry in geometries], dtype=np.float64)
+
+	# Only points within the overall bounds can be in any geometry
+	candidates = np.flatnonzero((x >= bounds[:, 0].min()) & (y >= bounds[:, 1].min()) & (x <= bounds[:, 2].max()) & (y <= bounds[:, 3].max()))
+
+	if not len(candidates):
+		return result
+
+	# Shapely 2 queries all the candidate points against a tree of the geometries at once
+	if hasattr(shapely, 'contains_xy'):
+		from shapely.strtree import STRtree
+
+		tree = STRtree(list(geometries))
+		points, found = tree.query(shapely.points(x[candidates], y[candidates]), predicate='within')
+
+		# The first geometry for each point is kept
+		first = np.empty(len(candidates), dtype=np.int64)
+		first[:] = len(geometries)
+		np.minimum.at(first, points, found)
+
+		result[candidates] = np.where(first < len(geometries), first, -1)
+
+		return result
+
+	try:
+		from shapely import vectorized
+	except ImportError:
+		vectorized = None
+
+	for index, geometry in enumerate(geometries):
+
+		west, south, east, north = bounds[index]
+
+		# Candidates not yet placed that lie in this geometry's bounding box
+		inside = candidates[(result[candidates] < 0) & (x[candidates] >= west) & (x[candidates] <= east) & (y[candidates] >= south) & (y[candidates] <= north)]
+		if not len(inside):
+			continue
+
+		prepared = prep(geometry)
+
+		if vectorized is not None:
+			contained = vectorized.contains(prepared, x[inside], y[inside])
+		else:
+			from shapely.geometry import Point
+			contained = np.array([prepared.contains(Point(px, py)) for px, py in zip(x[inside], y[inside])], dtype=bool)
+
+		result[inside[contained]] = index
+
+	return result
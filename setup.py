@@ -10,7 +10,7 @@ setup(
       author_email='cjack@csag.uct.ac.za',
       license='Apache',
       packages=['climstats'],
-      scripts=['bin/climstats', 'bin/areastats'],
+      scripts=['bin/climstats', 'bin/climstats-batch', 'bin/climstats-service', 'bin/areastats'],
       install_requires=[
       		'netCDF4',
       		'numpy',
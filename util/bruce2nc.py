@@ -2,103 +2,225 @@ import sys
 import numpy
 import datetime
 import glob
+import itertools
+import multiprocessing
 import netCDF4
 
 calendars = ['standard', 'noleap', '360_day']
 fill_value = 1e10
 
-sourcepath = sys.argv[1]
-outfilename = sys.argv[2]
-varname = sys.argv[3]
+# With --ragged the stations are written as a CF contiguous ragged array, each station's values one after the
+# other with a row_size per station, rather than padded out to a dense (time, feature) array
+ragged = '--ragged' in sys.argv
+argv = [arg for arg in sys.argv if arg != '--ragged']
+
+sourcepath = argv[1]
+outfilename = argv[2]
+varname = argv[3]
+
+# Optional scratch directory, the data is then assembled in memory mapped files rather than in memory
+scratchdir = argv[4] if len(argv) > 4 and argv[4] else None
+
+# The ragged layout is written station by station and never assembled
+if ragged and scratchdir:
+	print("a scratch directory is only used for the dense layout, not with --ragged")
+	sys.exit(1)
+
+# Optional number of processes parsing files, defaults to one per CPU
+workers = int(argv[5]) if len(argv) > 5 else multiprocessing.cpu_count()
 
 time_units = 'days since 1800-01-01'
 
-filenames = glob.glob(sourcepath + '/*.txt')
+# Sorted so that the station order in the output doesn't depend on the directory listing
+filenames = sorted(glob.glob(sourcepath + '/*.txt'))
 
 def date_fromlong(longdate):
-	
+
 	year = int(longdate/1000000)
 	month = int((longdate - year*1000000)/10000)
 	day = int((longdate - year*1000000 - month*10000)/100)
 	hour = int(longdate - year*1000000 - month*10000 - day*100)
-	
+
 
 	return datetime.datetime(year, month, day, hour)
 
-def bruce_to_series(file, metaonly=True):
-	
-	lines = file.readlines()
-	
+def bruce_header(lines):
+	"""Parse the three header lines of a station file"""
+
 	ID, latitude, longitude, altitude = tuple(lines[0].split())
-	
+
 	parts = lines[1].split()
 	startdate, enddate = (date_fromlong(long(parts[0])), date_fromlong(long(parts[1])))
 	calendar = calendars[int(parts[2])]
-	
-	name = lines[2].strip().strip('_')
 
-	print ID, name, latitude, longitude, altitude, startdate, enddate
-		
-	if not metaonly:
-		values = numpy.array([float(line) for line in lines[3:]])
-		values[values < -90] = fill_value
-	else:
-		values = None
+	name = lines[2].strip().strip('_')
 
-	return ID, name, latitude, longitude, altitude, startdate, enddate, calendar, values
-	
+	return ID, name, latitude, longitude, altitude, startdate, enddate, calendar
 
-global_startdate = datetime.datetime(2200,12,31)
-global_enddate = datetime.datetime(1800,1,1)
+def bruce_to_series(filename):
+	"""
+	Read one station file in a single pass, the header from the first three lines and then the values in
+	bulk.  Runs in the worker processes so returns the error message rather than raising.
+	"""
 
-# Quick meta-data pass
-count = 0
-for filename in filenames:
-	print filename
 	try:
-		file = open(filename)
+		with open(filename) as file:
+			header = bruce_header([file.readline() for line in range(3)])
+			values = numpy.fromstring(file.read(), dtype=numpy.float64, sep=' ')
 	except:
-		print("cannot open file {}".format(filename))
-		continue
-	
-	try:
-		ID, name, latitude, longitude, elevation, startdate, enddate, calendar, values = bruce_to_series(file)
-	except:
-		print("cannot parse file: {}".format(sys.exc_info()))
+		return filename, None, None, "cannot parse file {}: {}".format(filename, sys.exc_info()[1])
+
+	values = values.astype(numpy.float32)
+	values[values < -90] = fill_value
+
+	return filename, header, values, None
+
+
+def write_ragged(data_var, time_var, rowsize_var, stations, starts, start_timeval):
+	"""
+	Write each station's values and times at its offset along the sample dimension, in blocks of about 64MB.
+	Stations are dropped from the list as they are written.
+	"""
+
+	rowsize_var[:] = numpy.array([len(values) for header, values in stations])
+
+	position = 0
+	buffered = []
+	for index in range(len(stations)):
+		header, values = stations[index]
+		stations[index] = (header, None)
+		buffered.append((starts[index], values))
+
+		size = sum([len(values) for start, values in buffered])
+		if size * 4 >= 64 * 1024 * 1024 or index == len(stations) - 1:
+			data_var[position:position+size] = numpy.concatenate([values for start, values in buffered])
+			time_var[position:position+size] = numpy.concatenate([start_timeval + start + numpy.arange(len(values)) for start, values in buffered])
+			position += size
+			buffered = []
+
+def write_dense(data_var, time_var, stations, starts, start_timeval, days, scratchdir):
+	"""
+	Assemble the dense (time, feature) array, in memory or in a scratch file, and write it.  Stations are
+	dropped from the list as they are placed.
+	"""
+
+	count = len(stations)
+
+	if scratchdir:
+		from climstats.scratch import ScratchArray
+		scratch_tmp = ScratchArray((days, count), dtype=numpy.float32, directory=scratchdir)
+		data_tmp = scratch_tmp.data
+	else:
+		data_tmp = numpy.empty((days, count), dtype=numpy.float32)
+	data_tmp[:] = fill_value
+	print "data_tmp: ", data_tmp.shape
+
+	# Each station's series is placed at its offset and then dropped
+	for index in range(count):
+		header, values = stations[index]
+		stations[index] = (header, None)
+
+		data_tmp[starts[index]:starts[index] + len(values), index] = values
+
+	# Write in blocks of time steps so a scratch backed array is never read into memory in full
+	block = max(1, (64 * 1024 * 1024) // (4 * max(count, 1)))
+	for start in range(0, days, block):
+		data_var[start:start+block] = data_tmp[start:start+block]
+
+	time_var[:] = start_timeval + numpy.arange(days)
+
+	if scratchdir:
+		scratch_tmp.close()
+
+
+# Parse all the files in parallel, imap keeps the results in file order
+stations = []
+pool = multiprocessing.Pool(workers) if workers > 1 else None
+results = pool.imap(bruce_to_series, filenames, chunksize=8) if pool else itertools.imap(bruce_to_series, filenames)
+
+for filename, header, values, error in results:
+
+	if error:
+		print(error)
 		continue
 
-	file.close()
-	
-	if startdate < global_startdate:
-		global_startdate = startdate
-		
-	if enddate > global_enddate:
-		global_enddate = enddate
-		
-	count += 1
+	ID, name, latitude, longitude, elevation, startdate, enddate, calendar = header
+	print ID, name, latitude, longitude, elevation, startdate, enddate
+
+	stations.append((header, values))
+
+if pool:
+	pool.close()
+	pool.join()
+
+global_startdate = min([header[5] for header, values in stations])
+global_enddate = max([header[6] for header, values in stations])
+
+# As before the time coordinate uses the calendar of the last station
+calendar = stations[-1][0][7]
 
-print "Found %d features" % (count)
 print "Date range: %s - %s" % (repr(global_startdate), repr(global_enddate))
 
 time_units = "days since {:4d}-{:02d}-{:02d} 12:00".format(global_startdate.year, global_startdate.month, global_startdate.day)
 
+# Offsets of every station's first and last value from the global start, one date2num call per calendar
+starts = numpy.zeros(len(stations), dtype=numpy.int64)
+ends = numpy.zeros(len(stations), dtype=numpy.int64)
+for station_calendar in set([header[7] for header, values in stations]):
+	members = [index for index, (header, values) in enumerate(stations) if header[7] == station_calendar]
+	origin = netCDF4.date2num(global_startdate, time_units, station_calendar)
+	starts[members] = numpy.rint(netCDF4.date2num([stations[index][0][5] for index in members], time_units, station_calendar) - origin)
+	ends[members] = numpy.rint(netCDF4.date2num([stations[index][0][6] for index in members], time_units, station_calendar) - origin)
+
+# The values must cover the header dates exactly (fromstring stops quietly at anything that isn't a number)
+keep = []
+for index, (header, values) in enumerate(stations):
+	if len(values) != ends[index] - starts[index] + 1:
+		print("cannot parse station {}: {} values for {} days".format(header[0], len(values), ends[index] - starts[index] + 1))
+	else:
+		keep.append(index)
+
+stations = [stations[index] for index in keep]
+starts = starts[keep]
+count = len(stations)
+
+print "Found %d features" % (count)
+
 #days = (global_enddate - global_startdate).days + 1
-days = netCDF4.date2num(global_enddate, time_units, calendar) - netCDF4.date2num(global_startdate, time_units, calendar) + 1
+days = int(netCDF4.date2num(global_enddate, time_units, calendar) - netCDF4.date2num(global_startdate, time_units, calendar) + 1)
 print '%d days in date range' % (days)
 
 
 # Create netcdf output file
 outdata = netCDF4.Dataset(outfilename, 'w', format='NETCDF4')
 
-# Create dimensions
-time_dim = outdata.createDimension('time', days)
-feature_dim = outdata.createDimension('feature', count)
+# Create dimensions and the variables, the ragged layout has a sample dimension holding all the values
+if ragged:
+	samples = sum([len(values) for header, values in stations])
+	print '%d values' % (samples)
+
+	obs_dim = outdata.createDimension('obs', samples)
+	feature_dim = outdata.createDimension('feature', count)
 
-# Create the variables
-time_var = outdata.createVariable('time', 'f4', ('time',))
-time_var.units = time_units
-data_var = outdata.createVariable(varname, 'f4', ('time', 'feature',), zlib=True, fill_value=1e10)
-data_var.coordinates = 'latitude longitude'
+	time_var = outdata.createVariable('time', 'f4', ('obs',), zlib=True)
+	time_var.units = time_units
+	data_var = outdata.createVariable(varname, 'f4', ('obs',), zlib=True, fill_value=1e10)
+	data_var.coordinates = 'time latitude longitude'
+
+	rowsize_var = outdata.createVariable('row_size', 'i4', ('feature',))
+	rowsize_var.long_name = 'number of observations for this station'
+	rowsize_var.sample_dimension = 'obs'
+
+	outdata.featureType = 'timeSeries'
+
+else:
+	time_dim = outdata.createDimension('time', days)
+	feature_dim = outdata.createDimension('feature', count)
+
+	time_var = outdata.createVariable('time', 'f4', ('time',))
+	time_var.units = time_units
+	data_var = outdata.createVariable(varname, 'f4', ('time', 'feature',), zlib=True, fill_value=1e10)
+	data_var.coordinates = 'latitude longitude'
 
 latitude_var = outdata.createVariable('latitude', 'f4', ('feature',))
 latitude_var.units = 'degrees_north'
@@ -113,70 +235,19 @@ elevation_var.positive = 'up'
 id_var = outdata.createVariable('id', str, ('feature',))
 name_var = outdata.createVariable('name', str, ('feature',))
 
-# We repopulate the meta-data just in case the ordering of the file listing has changed!
-
-# Slower full data read
-index = 0
-data_tmp = numpy.empty((days, count), dtype=numpy.float32)
-data_tmp[:] = fill_value
-print "data_tmp: ", data_tmp.shape
-
-for filename in filenames:
-	
-	try:
-		file = open(filename)
-	except:
-		continue
-	
-	try:
-		ID, name, latitude, longitude, elevation, startdate, enddate, calendar, values = bruce_to_series(file, metaonly=False)
-	except:
-		continue
+# Station metadata is written in one go
+latitude_var[:] = numpy.array([float(header[2]) for header, values in stations])
+longitude_var[:] = numpy.array([float(header[3]) for header, values in stations])
+elevation_var[:] = numpy.array([float(header[4]) for header, values in stations])
+id_var[:] = numpy.array([header[0] for header, values in stations], dtype=object)
+name_var[:] = numpy.array([unicode(header[1], errors='ignore') for header, values in stations], dtype=object)
 
-	file.close()
-	
-	#startdate_offset = (startdate - global_startdate).days
-	#enddate_offset = (enddate - global_startdate).days
-	startdate_offset = netCDF4.date2num(startdate, time_units, calendar) - netCDF4.date2num(global_startdate, time_units, calendar)
-	enddate_offset = netCDF4.date2num(enddate, time_units, calendar) - netCDF4.date2num(global_startdate, time_units, calendar)
-	print startdate_offset, enddate_offset
-	
-	#print startdate_offset, enddate_offset, days
-	#data_var[index,startdate_offset:enddate_offset+1] = values
-	#print data_tmp.shape
-	#print len(values)
-	#print data_tmp[startdate_offset:enddate_offset+1, index].shape
-	data_tmp[startdate_offset:enddate_offset+1, index] = values
-
-
-	latitude_var[index] = float(latitude)
-	longitude_var[index] = float(longitude)
-	elevation_var[index] = float(elevation)
-	id_var[index] = ID
-	name_var[index] = unicode(name, errors='ignore')
-	
-	index += 1
-
-data_var[:] = data_tmp
-
-#date = global_startdate
-#time_values = []
-#while (date <= global_enddate):
-#	time_values.append(netCDF4.date2num(date, time_units, calendar))
-#	date = date + datetime.timedelta(1)
-
-time_values = []
 start_timeval = netCDF4.date2num(global_startdate, time_units, calendar)
-for i in range(0,int(days)):
-	time_values.append(start_timeval + i)
-	
-	
-time_var[:] = numpy.array(time_values)
 time_var.calendar = calendar
 
-outdata.close()
-	
+if ragged:
+	write_ragged(data_var, time_var, rowsize_var, stations, starts, start_timeval)
+else:
+	write_dense(data_var, time_var, stations, starts, start_timeval, days, scratchdir)
 
-	
-	
-	
+outdata.close()
@@ -4,6 +4,7 @@ import datetime
 import glob
 import netCDF4
 
+from climstats import dataset
 
 startdate = datetime.datetime(1960,1,1,12)
 enddate = datetime.datetime(2015,12,31,12)
@@ -16,17 +17,14 @@ sourcefilename = sys.argv[1]
 targetfilename = sys.argv[3]
 varname = sys.argv[2]
 
-geometry = None
+geometries = None
 
 
 if len(sys.argv) > 4:
 	
-	import shapely
 	import ogr
 	from shapely.wkb import loads
-	from shapely.ops import cascaded_union
-	from shapely import speedups
-	speedups.enable()	
+	from climstats import spatial
 
 	shapefilename = sys.argv[4]
 	shapefile = ogr.Open(shapefilename)
@@ -41,9 +39,13 @@ if len(sys.argv) > 4:
 
 			geometries.append(loads(feature.GetGeometryRef().ExportToWkb()))
 
-	geometry = cascaded_union(geometries)
-	bounds = geometry.bounds
-	print "Got geometry with bounds: ", bounds
+	# The polygons are tested individually (see spatial.locate_points) rather than merged into one complex geometry
+	bounds = numpy.array([geometry.bounds for geometry in geometries])
+	print "Got %d geometries with bounds: " % len(geometries), (bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max())
+
+
+# Approximate number of bytes read at a time when streaming through the data
+blocksize = 64 * 1024 * 1024
 
 
 source = netCDF4.Dataset(sourcefilename)
@@ -56,9 +58,9 @@ global_enddate_value = time_vals[-1]
 print time_vals
 print "Date range: %s - %s" % (netCDF4.num2date(global_startdate_value, time_units), netCDF4.num2date(global_enddate_value, time_units))
 
-latitude_var = source.variables['latitude']
-longitude_var = source.variables['longitude']
-elevation_var = source.variables['elevation']
+latitudes = source.variables['latitude'][:]
+longitudes = source.variables['longitude'][:]
+elevations = source.variables['elevation'][:]
 id_var = source.variables['id'][:]
 print id_var.shape
 name_var = source.variables['name'][:]
@@ -67,59 +69,62 @@ startdate_value = netCDF4.date2num(startdate, time_units)
 enddate_value = netCDF4.date2num(enddate, time_units)
 print startdate_value, enddate_value
 
-start_index = numpy.argmax((time_vals == startdate_value))
-end_index = numpy.argmax((time_vals == enddate_value))
-if end_index == 0:
-    end_index = len(time_vals)-1
+# Time values are increasing so the date bounds are found by bisection, dates outside the source clip to its range
+start_index = numpy.searchsorted(time_vals, startdate_value, side='left')
+end_index = numpy.searchsorted(time_vals, enddate_value, side='right') - 1
 print "Start_index, end_index", start_index, end_index
 
-#print "Filter index range: %d - %d" % (startdate_index, enddate_index)
+if end_index < start_index:
+	print "No time steps between %s and %s" % (startdate, enddate)
+	sys.exit(1)
 
 data_var = source.variables[varname]
+steps = end_index - start_index + 1
 
-alldata = data_var[start_index:end_index+1,:]
+# Chunk aligned blocks of about blocksize bytes along time (see Variable.blocks) restricted to the time window
+variable = dataset.NetCDF4Dataset([sourcefilename]).variables[varname]
+blocks = [slice(max(block.start, start_index), min(block.stop, end_index + 1)) for block in variable.blocks(0, blocksize)]
+blocks = [block for block in blocks if block.start < block.stop]
 
-selection = []
+# Count the valid values of every feature in one streaming pass over the time window
+valid = numpy.zeros(data_var.shape[1], dtype=numpy.int64)
+for block in blocks:
+	valid += numpy.ma.count(variable[block, :], axis=0)
+
+percent = 100.0 * valid / steps
+
+# Screen all the features at once
+selected = numpy.ones(len(valid), dtype=bool)
+
+if threshold:
+	selected &= percent >= threshold
+
+if elevation_gte:
+	selected &= numpy.ma.filled(elevations >= elevation_gte, False)
+
+if elevation_lte:
+	selected &= numpy.ma.filled(elevations <= elevation_lte, False)
+
+if geometries:
+	candidates = numpy.flatnonzero(selected)
+	selected[candidates] = spatial.locate_points(longitudes[candidates], latitudes[candidates], geometries) >= 0
+
+selection = numpy.flatnonzero(selected)
+
+for feature in selection:
+	print "%-15s\t%-25s\t%.2f\t%d" % (id_var[feature], name_var[feature].encode('utf-8', errors='ignore'), elevations[feature], percent[feature])
 
-for feature in range(0, id_var.shape[0]):
-	values = alldata[:,feature]
-	
-	if not len(values):
-		continue
-	
-	valid = len(values[~values.mask])
-	percent = 100.0* valid/alldata.shape[0]
-    
-	if threshold:
-		if percent < threshold:
-			continue
-			
-	if elevation_gte:
-		if elevation_var[feature] < elevation_gte:
-			continue
-			
-	if elevation_lte:
-		if elevation_var[feature] > elevation_lte:
-			continue
-			
-	if geometry:
-		point = shapely.geometry.Point(longitude_var[feature], latitude_var[feature])
-		if not point.within(geometry):
-			continue
-
-	print "%-15s\t%-25s\t%.2f\t%d" % (id_var[feature], name_var[feature].encode('utf-8', errors='ignore'), elevation_var[feature], percent)
-#	print "%20s\t%.2f\t%d" % (id_var[feature], elevation_var[feature], percent)
-
-	selection.append(feature)
-			
-		
 print len(selection)
 
+if not len(selection):
+	print "No features selected"
+	sys.exit(1)
+
 # Create netcdf output file
 target = netCDF4.Dataset(targetfilename, 'w', format='NETCDF4')
 
 # Create dimensions
-target_time_dim = target.createDimension('time', end_index - start_index + 1)
+target_time_dim = target.createDimension('time', steps)
 target_feature_dim = target.createDimension('feature', len(selection))
 
 # Create the variables
@@ -130,38 +135,34 @@ target_time_var[:] = time_vals[start_index:end_index+1]
 
 target_latitude_var = target.createVariable('latitude', 'f4', ('feature',))
 target_latitude_var.units = 'degrees_north'
-target_latitude_var[:] = latitude_var[selection]
+target_latitude_var[:] = latitudes[selection]
 
 target_longitude_var = target.createVariable('longitude', 'f4', ('feature',))
 target_longitude_var.units = 'degrees_east'
-target_longitude_var[:] = longitude_var[selection]
+target_longitude_var[:] = longitudes[selection]
 
 target_elevation_var = target.createVariable('elevation', 'f4', ('feature',))
 target_elevation_var.units = 'meters'
 target_elevation_var.positive = 'up'
-target_elevation_var[:] = elevation_var[selection]
+target_elevation_var[:] = elevations[selection]
 
 target_id_var = target.createVariable('id', str, ('feature',))
-i = 0
-for item in id_var[selection]:
-	target_id_var[i] = str(id_var[selection][i])
-	i += 1
+target_id_var[:] = numpy.array([str(value) for value in id_var[selection]], dtype=object)
 
 target_name_var = target.createVariable('name', str, ('feature',))
-i = 0
-for item in name_var[selection]:
-	target_name_var[i] = unicode(name_var[selection][i])
-	i += 1
+target_name_var[:] = numpy.array([unicode(value) for value in name_var[selection]], dtype=object)
 
 
 target_data_var = target.createVariable(varname, 'f4', ('time', 'feature',), zlib=True, fill_value=1e10)
 attr_names = data_var.ncattrs()
 for name in attr_names:
-	target_data_var.setncattr(name, data_var.getncattr(name))
-	
-print target_data_var.shape, alldata.shape
-target_data_var[:] = alldata[:,selection]
+	if name != '_FillValue':
+		target_data_var.setncattr(name, data_var.getncattr(name))
 
-	
+print target_data_var.shape
 
+# Copy the selected features in a second streaming pass
+for block in blocks:
+	target_data_var[block.start - start_index:block.stop - start_index] = variable[block, :][:, selection]
 
+target.close()
@@ -14,19 +14,26 @@ times = variable.coords['time']
 realtimes = netCDF4.num2date(times[:], times.attributes['units'])
 print realtimes[0], realtimes[-1]
 
-ids = ds.ancil['id']
-print ids[:]
-names = ds.ancil['name']
+# Gridded datasets have no station ids or names
+ids = ds.ancil.get('id')
+names = ds.ancil.get('name')
 
 if len(sys.argv) < 4:
 	for name in names:
 		print name, ids[list(names[:]).index(name)]
 
 else:
-	index = list(ids[:]).index(sys.argv[3])
-	#print names[index]
+	# A location given as latitude,longitude is looked up with the point index, anything else is a station id
+	try:
+		latitude, longitude = [float(value) for value in sys.argv[3].split(',')]
+	except ValueError:
+		index = list(ids[:]).index(sys.argv[3])
+		#print names[index]
+
+		values = variable[:,index]
+	else:
+		values = variable.extract_points([latitude], [longitude])[..., 0]
 
-	values = variable[:,index]
 	print values
 
 	if len(sys.argv) > 4: